@@ -1,24 +1,36 @@
 import streamlit as st
-import tempfile
 
-from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.callbacks import get_openai_callback
-from langchain.callbacks import get_openai_callback
-
-from llm_chains.rag import RAG
-from llm_chains.spendings import SpendingClient, Spendings, SpendingsMeta, spend_helper
+from llm_chains import services
+from llm_chains.spendings import Spendings, SpendingsMeta, spend_helper, rollup_helper
 from llm_chains.citation_styles import SummaryCitation
+from llm_chains.tracing import tracer
+from llm_chains.concurrency import llm_limiter
+from llm_chains.loaders import PdfBuffer
 
 st.set_page_config(page_title="Scientific Summarizer", layout="wide")
 
-vectorstore = Chroma(collection_name="langchain", embedding_function=OpenAIEmbeddings(), persist_directory="./chroma_db")
-spending_client = SpendingClient(client_name="spendings")
-model = ChatOpenAI(temperature = 0.0, model="gpt-4o-mini")
-sum_assistant = RAG(model, vectorstore, spending_client)
-chain = sum_assistant.create_graph()
 
-tab1, tab2 = st.tabs(["Summary", "Spendings"])
+def show_thumbnails(pdfs: list[PdfBuffer]):
+    """
+    Shows the first page of every upload, rendered from the upload buffer once per file content.
+    """
+    thumbnails = st.session_state.setdefault("thumbnails", {})
+    try:
+        from llm_chains.pdf_processing import pdf_page_to_png
+
+        for pdf in pdfs:
+            if pdf.sha256 not in thumbnails:
+                thumbnails[pdf.sha256] = pdf_page_to_png(pdf)
+    except ImportError:
+        # PyMuPDF and Pillow are not in the minimal requirements
+        return
+    st.image([thumbnails[pdf.sha256] for pdf in pdfs], caption=[pdf.name for pdf in pdfs], width=120)
+
+
+# Models, stores and the compiled graph are built once per process on first use, see llm_chains.services
+spending_client = services.spending_client()
+
+tab1, tab2, tab3 = st.tabs(["Summary", "Spendings", "Performance"])
 
 with tab1:
     st.header("Summary")
@@ -27,40 +39,93 @@ with tab1:
     st.markdown("Slider below inderectly define size of summary. The more the value, the more the number of " +
                 "chunks is used as context.")
     size = st.slider("Choose the size of context", 0, 100, 5)
+    token_budget = st.number_input("Token budget of the context (0 - no limit)", 0, 128000, 0, step=500)
+    use_mmr = st.checkbox("Drop redundant chunks (MMR)")
+    only_session = st.checkbox("Search only the papers uploaded in this session", value=True)
+    per_paper_k = st.number_input("Maximum chunks per paper (0 - no limit)", 0, 100, 0)
+    map_reduce = st.checkbox("Summarize every paper separately, then merge (faster for large contexts)")
+    retrieval = st.selectbox("Retrieval", ["hybrid", "vector", "lexical"],
+                             help="hybrid fuses the embedding search with exact term matching (BM25)")
     # Input for the question
     question = st.text_input("Enter your question about the document:")
 
     # Button to process the input
     if st.button("Generate Summary"):
         if uploaded_files and question:
-            with tempfile.TemporaryDirectory() as temp_dir:  # Create a temporary directory
-                for uploaded_file in uploaded_files:
-                    # Save each uploaded file to the temporary directory
-                    temp_file_path = f"{temp_dir}/{uploaded_file.name}"
-                    with open(temp_file_path, "wb") as temp_file:
-                        temp_file.write(uploaded_file.read())
-                    # load the PDF and store it in the vectorstore
-                    docs = sum_assistant.load_pdf(temp_file_path)
-                    meta = sum_assistant.metadata_from_pdf(docs)
-                    sum_assistant.store_pdf(docs, meta)
-            with get_openai_callback() as cb:
-                config = {"configurable": {"chunk_nums": size}}
-                result = chain.invoke({"question": question}, config=config)
-                spending_client.add_spending(Spendings(cost=SpendingsMeta.from_api_response(cb)))
+            sum_assistant = services.rag()
+            # The uploads are parsed from memory, only very large files are spilled to a temporary file
+            pdfs = [PdfBuffer(uploaded_file, name=uploaded_file.name) for uploaded_file in uploaded_files]
+            # the buffers are hashed while they are read, then thumbnailed and parsed without reading the uploads again
+            show_thumbnails(pdfs)
+            # load the PDFs concurrently and store them in the vectorstore, files seen before are skipped.
+            # The work runs in the shared event loop, so the other sessions are not blocked meanwhile
+            records = services.run_async(sum_assistant.aingest_many(pdfs))
+            # Papers of this session, the retrieval can be scoped to them instead of the whole database
+            st.session_state.setdefault("paper_hashes", set()).update(record.meta_hash for record in records)
+            st.subheader("Summary")
+            placeholder = st.empty()
+            config = {"configurable": {"chunk_nums": size, "token_budget": token_budget or None, "mmr": use_mmr,
+                                       "retrieval": retrieval, "per_paper_k": per_paper_k or None,
+                                       "hashes": sorted(st.session_state["paper_hashes"]) if only_session else None,
+                                       "mode": "map_reduce" if map_reduce else "stuff", "stream_answer": True}}
+            # read before answering, an answer generated while another session stores papers is not cached
+            corpus_version = sum_assistant.corpus_version()
+            citation_client = sum_assistant.cached_answer(question, config, corpus_version)
+            if citation_client is None:
+                from langchain_community.callbacks import get_openai_callback
+
+                model = services.chat_model()
+                citation_client = SummaryCitation(question=question)
+                with get_openai_callback() as cb:
+                    # Render the answer while it is generated, citations arrive with the last chunk
+                    for mode, chunk in services.iterate_async(services.graph().astream(
+                            {"question": question}, config=config, stream_mode=["updates", "custom"])):
+                        citation_client.update(mode, chunk)
+                        placeholder.write(citation_client.answer)
+                    spending_client.add_spending(Spendings(
+                        cost=SpendingsMeta.from_api_response(cb), operation="summary", model=model.model_name,
+                        doc_hash=";".join(sorted(citation_client.context))))
+                sum_assistant.cache_answer(question, config, citation_client, corpus_version)
 
-            citation_client = SummaryCitation.parse_summary(result)
             summary = citation_client.style()
             # Display the result
-            st.subheader("Summary")
-            st.write(summary)
+            placeholder.write(summary)
+            if citation_client.context_stats:
+                st.caption("Context: {tokens} tokens, {tokens_saved} tokens saved by packing, "
+                           "{chunks_dropped} chunks dropped by the budget.".format(**citation_client.context_stats))
         else:
             st.error("Please upload a PDF file and enter a question.")
 
 with tab2:
-    data = spend_helper(spending_client)
-
     st.header("Spendings")
     st.write("Here are your recent spendings.")
-    # Display spending information
-    st.subheader("Spending Information")
-    st.dataframe(data, use_container_width=True)
+    # Display spending information, the totals are precomputed and only the latest rows of the ledger are read
+    st.subheader("Totals by day, operation and model")
+    st.dataframe(rollup_helper(spending_client), use_container_width=True)
+    st.subheader("Latest spendings")
+    st.dataframe(spend_helper(spending_client, tail=200), use_container_width=True)
+    # Nothing was ingested by this process before the RAG service is built
+    sum_assistant = services.loaded("rag")
+    if sum_assistant is not None:
+        stats = sum_assistant.metadata_stats
+        st.caption(f"Metadata LLM call avoided for {stats.llm_avoided} of {stats.papers} papers, "
+                   f"{stats.fields_local} fields extracted locally, {stats.fields_llm} by the LLM.")
+        if sum_assistant.dedup_index is not None:
+            dedup = sum_assistant.dedup_index.stats()
+            st.caption(f"Near-duplicate chunks: {dedup.duplicates} of {dedup.chunks} ({dedup.ratio:.0%}) linked to "
+                       f"stored vectors instead of being embedded.")
+
+with tab3:
+    st.header("Performance")
+    st.write("Latency of every ingest and query stage in seconds, since the start of the process.")
+    stages = tracer.summary()
+    if stages:
+        import pandas as pd
+
+        st.dataframe(pd.DataFrame(stages).fillna(0), use_container_width=True)
+        st.download_button("Download Prometheus metrics", tracer.to_prometheus(), file_name="metrics.prom")
+    else:
+        st.info("Nothing measured yet.")
+    limiter = llm_limiter.stats()
+    st.caption("Model requests: {in_flight} in flight, {peak} at most (cap {max_concurrency}), "
+               "{waits} had to wait for a slot.".format(**limiter))
@@ -0,0 +1,76 @@
+"""
+Compares the PDF text-extraction backends on a generated corpus, reporting pages/second and peak RSS.
+Every backend runs in a fresh process, so the RSS of one run does not leak into the next.
+With --sources path memory the uploads are simulated: the PDF bytes are either written to a temporary file,
+hashed and parsed from it (the former app path) or hashed and parsed from memory with a PdfBuffer.
+
+Usage (from src/): python -m benchmarks.bench_loaders --files 20 --pages 30
+"""
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+
+from llm_chains.loaders import LOADER_BACKENDS, PdfBuffer, get_loader_backend
+from llm_chains.pdf_processing import make_hash_from_file
+
+from .corpus import write_pdf_corpus
+
+
+def as_upload(content: bytes, num: int, source: str, temp_dir: str) -> str | PdfBuffer:
+    """
+    Turns the bytes of an upload into what the backend parses, hashing it like the ingest does.
+    """
+    if source == "memory":
+        pdf = PdfBuffer(content, name=f"{num}.pdf")
+    else:
+        pdf = f"{temp_dir}/{num}.pdf"
+        with open(pdf, "wb") as f:
+            f.write(content)
+    make_hash_from_file(pdf)
+    return pdf
+
+
+def run_backend(name: str, paths: list[str], source: str, queue: multiprocessing.Queue):
+    backend = get_loader_backend(name)
+    # the simulated uploads are held in memory, like the Streamlit ones
+    contents = [open(path, "rb").read() for path in paths] if source != "file" else []
+    n_pages, n_chars = 0, 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        for num, path in enumerate(paths):
+            pdf = path if source == "file" else as_upload(contents[num], num, source, temp_dir)
+            for page in backend.lazy_load(pdf):
+                n_pages += 1
+                n_chars += len(page.page_content)
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is reported in KiB on Linux
+    queue.put((n_pages, n_chars, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--backends", nargs="+", default=list(LOADER_BACKENDS))
+    parser.add_argument("--sources", nargs="+", default=["file"], choices=["file", "path", "memory"],
+                        help="file - parse the corpus files, path/memory - simulated uploads, see above")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = write_pdf_corpus(temp_dir, args.files, args.pages)
+        for name in args.backends:
+            for source in args.sources:
+                queue = context.Queue()
+                process = context.Process(target=run_backend, args=(name, paths, source, queue))
+                process.start()
+                n_pages, n_chars, elapsed, peak_rss = queue.get()
+                process.join()
+                print(f"{name:<10} {source:<7} pages={n_pages:<6} chars={n_chars:<10} pages/s={n_pages / elapsed:>10.1f} "
+                      f"peak RSS={peak_rss:>8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
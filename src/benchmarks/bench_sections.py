@@ -0,0 +1,71 @@
+"""
+Compares the list based section extraction with the streaming pipeline on synthetic pages.
+
+Usage (from src/): python -m benchmarks.bench_sections --pages 100 300 1000
+"""
+import argparse
+import re
+import time
+import tracemalloc
+
+from llm_chains.pdf_processing import iter_chunks, iter_sections
+
+from .corpus import iter_synthetic_pages, synthetic_pages
+
+
+META = {"author": "Name, Family", "title": "Synthetic", "journal": "Bench", "year": "2025",
+        "volume": "1", "number": "1", "pages": "1-2", "doi": "10.0/bench"}
+
+
+def legacy_extract_titles_and_sections(pages, metadata_extra, meta_hash):
+    # Implementation before the streaming pipeline, kept as the reference point
+    title_pattern = r'^(?:\d+\.?\s*|\bI\b\s*)?[A-Z][A-Za-z\-:]*\s*(?:[Aa][Nn][Dd]\s+[A-Z][A-Za-z\-:]*\s*)?$'
+    metadata = {i: j for i, j in pages[0].metadata.items() if i not in ["page_label", "page"]}
+    metadata["hash"] = meta_hash
+    metadata.update(metadata_extra)
+    sections = []
+    current_title = None
+    current_content = []
+    for page in pages:
+        for line in page.page_content.split('\n'):
+            if re.match(title_pattern, line.strip()):
+                if current_title:
+                    sections.append({'title': current_title, 'metadata': metadata,
+                                     'content': "\n".join(current_content)})
+                current_title = line.strip()
+                current_content = []
+            else:
+                current_content.append(line.strip())
+    if current_title:
+        sections.append({'title': current_title, 'metadata': metadata, 'content': "\n".join(current_content)})
+    return sections
+
+
+def measure(name, n_pages, run):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} pages={n_pages:<6} items={count:<6} pages/s={n_pages / elapsed:>10.1f} "
+          f"peak={peak / 2 ** 20:>8.2f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 300, 1000])
+    args = parser.parse_args()
+
+    for n_pages in args.pages:
+        # Pages are produced lazily for the streaming run, like PyPDFLoader.lazy_load()
+        measure("legacy", n_pages,
+                lambda: len(legacy_extract_titles_and_sections(synthetic_pages(n_pages), META, "bench")))
+        measure("streaming", n_pages,
+                lambda: sum(1 for _ in iter_sections(iter_synthetic_pages(n_pages), META, "bench")))
+        measure("chunks", n_pages,
+                lambda: sum(1 for _ in iter_chunks(iter_synthetic_pages(n_pages), META, "bench")))
+
+
+if __name__ == "__main__":
+    main()
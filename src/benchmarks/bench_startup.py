@@ -0,0 +1,76 @@
+"""
+Measures the cold start of the app: import time of the modules in a fresh interpreter, the heavy libraries
+they pull in, and the first render and rerun of app.py with the Streamlit testing harness.
+
+Usage (from src/): python -m benchmarks.bench_startup --repeat 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ["app_imports", "llm_chains.services", "llm_chains.spendings", "llm_chains.citation_styles",
+           "llm_chains.rag"]
+HEAVY = ["langchain", "langchain_openai", "langchain_community", "langgraph", "chromadb", "citeproc", "fitz",
+         "pandas"]
+# Everything app.py imports before the first widget is drawn
+APP_IMPORTS = ("import streamlit; from llm_chains import services, spendings, citation_styles, tracing, concurrency, loaders")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(module: str) -> dict:
+    statement = APP_IMPORTS if module == "app_imports" else f"import {module}"
+    out = subprocess.run([sys.executable, "-c", PROBE.format(statement=statement, heavy=HEAVY)],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def render_time(app_path: str, timeout: float) -> tuple[float, float] | None:
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return None
+    app = AppTest.from_file(app_path, default_timeout=timeout)
+    start = time.perf_counter()
+    app.run()
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    app.run()
+    return first, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--app", default="app.py")
+    parser.add_argument("--timeout", type=float, default=60.)
+    args = parser.parse_args()
+
+    for module in MODULES:
+        try:
+            runs = [import_time(module) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<30} failed: {e.stderr.strip().splitlines()[-1]}")
+            continue
+        median = statistics.median(run["seconds"] for run in runs)
+        print(f"{module:<30} import={1000 * median:>8.1f} ms  heavy={','.join(runs[0]['heavy']) or '-'}")
+
+    times = render_time(args.app, args.timeout)
+    if times is None:
+        print("streamlit is not installed, first render skipped")
+    else:
+        print(f"{'app first render':<30} {1000 * times[0]:>8.1f} ms")
+        print(f"{'app rerun':<30} {1000 * times[1]:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Compares Chroma with the quantized memory-mapped store (llm_chains/quantized_store.py) on synthetic chunks:
+build time, size on disk, cold open time, queries per second, recall@k against an exact float32 search
+and peak RSS. Every build and every query run happens in a fresh process, so the numbers do not leak
+into each other and the open is really cold (apart from the page cache).
+
+Usage (from src/): python -m benchmarks.bench_vectorstores --chunks 50000 --queries 200 --k 10
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from .corpus import synthetic_text
+from .fakes import HashEmbeddings
+
+# name -> quantized store settings, None is Chroma
+BACKENDS = {
+    "chroma": None,
+    "int8": {"quantization": "int8", "rerank": False},
+    "int8+rerank": {"quantization": "int8", "rerank": True},
+    "float16": {"quantization": "float16", "rerank": False},
+    "int8+ivf": {"quantization": "int8", "rerank": True, "index": "ivf"},
+}
+
+
+def open_store(name: str, directory: str, embeddings: HashEmbeddings):
+    if BACKENDS[name] is None:
+        from langchain_chroma import Chroma
+
+        return Chroma(collection_name="bench", embedding_function=embeddings, persist_directory=directory)
+    from llm_chains.quantized_store import QuantizedVectorStore
+
+    return QuantizedVectorStore(embeddings, directory, **BACKENDS[name])
+
+
+def build(name: str, directory: str, texts: list[str], dim: int, batch_size: int, queue: multiprocessing.Queue):
+    store = open_store(name, directory, HashEmbeddings(dim))
+    start = time.perf_counter()
+    for offset in range(0, len(texts), batch_size):
+        batch = texts[offset:offset + batch_size]
+        store.add_texts(batch, [{"hash": f"paper{num % 100}"} for num in range(offset, offset + len(batch))],
+                        ids=[str(num) for num in range(offset, offset + len(batch))])
+    queue.put(time.perf_counter() - start)
+
+
+def query(name: str, directory: str, queries: list[str], truth: list[list[int]], dim: int, k: int,
+          queue: multiprocessing.Queue):
+    embeddings = HashEmbeddings(dim)
+    vectors = [embeddings.embed_query(text) for text in queries]
+    start = time.perf_counter()
+    store = open_store(name, directory, embeddings)
+    # the first search pays what remains of the cold open (index load, page faults)
+    store.similarity_search_by_vector(vectors[0], k)
+    open_s = time.perf_counter() - start
+    hits, start = 0, time.perf_counter()
+    for vector, expected in zip(vectors, truth):
+        found = store.similarity_search_by_vector(vector, k)
+        hits += len({int(doc.id) for doc in found} & set(expected))
+    elapsed = time.perf_counter() - start
+    queue.put((open_s, len(vectors) / elapsed, hits / (k * len(vectors)), peak_rss_mb()))
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak RSS of this process. ru_maxrss survives the exec of a spawned child, so it would report
+    the peak of the parent, VmHWM starts again with the new address space.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_child(context, target, *args):
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def directory_size(path: str) -> float:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--save", help="write the metrics to this JSON file")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = [" ".join(synthetic_text(rng, 4)) for _ in range(args.chunks)]
+    queries = [" ".join(synthetic_text(rng, 1)) for _ in range(args.queries)]
+    # Exact float32 neighbours, the reference of the recall
+    embeddings = HashEmbeddings(args.dim)
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    truth = [np.argsort(-(matrix @ np.asarray(embeddings.embed_query(q), dtype=np.float32)))[:args.k].tolist()
+             for q in queries]
+    del matrix
+
+    context = multiprocessing.get_context("spawn")
+    metrics = {}
+    print(f"{'backend':<12} {'build s':>8} {'disk MiB':>9} {'open s':>7} {'QPS':>8} {'recall':>7} {'RSS MiB':>8}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in args.backends:
+            directory = os.path.join(temp_dir, name)
+            build_s = run_child(context, build, name, directory, texts, args.dim, args.batch_size)
+            open_s, qps, recall, rss = run_child(context, query, name, directory, queries, truth, args.dim, args.k)
+            disk = directory_size(directory)
+            metrics[name] = {"build_s": build_s, "disk_mb": disk, "open_s": open_s, "qps": qps,
+                             "recall": recall, "peak_rss_mb": rss}
+            print(f"{name:<12} {build_s:>8.2f} {disk:>9.1f} {open_s:>7.3f} {qps:>8.1f} {recall:>7.3f} {rss:>8.1f}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
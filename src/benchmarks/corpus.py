@@ -0,0 +1,80 @@
+import random
+from typing import Iterator
+
+from langchain_core.documents import Document
+
+
+WORDS = (
+    "protein binding affinity cell membrane receptor signal pathway expression sample analysis "
+    "temperature pressure catalyst reaction yield spectrum model parameter error measurement method "
+    "result figure table dataset training accuracy baseline significant increase decrease observed"
+).split()
+
+SECTION_TITLES = ["Abstract", "Introduction", "Methods", "Results", "Discussion", "Conclusion", "References"]
+
+
+def synthetic_text(rng: random.Random, n_lines: int, words_per_line: int = 12) -> list[str]:
+    lines = []
+    for _ in range(n_lines):
+        line = " ".join(rng.choice(WORDS) for _ in range(words_per_line))
+        lines.append(line.capitalize() + ".")
+    return lines
+
+
+def iter_synthetic_pages(n_pages: int, lines_per_page: int = 45, seed: int = 0,
+                         revision: int = 0) -> Iterator[Document]:
+    """
+    Generates Document pages shaped like the output of PyPDFLoader, with a section title every few pages.
+    A revision above 0 changes one word per page, like a later version of the same paper.
+    """
+    rng = random.Random(seed)
+    edits = random.Random(f"{seed}-{revision}")
+    for num in range(n_pages):
+        lines = synthetic_text(rng, lines_per_page)
+        if revision:
+            line = edits.randrange(len(lines))
+            words = lines[line].split()
+            words[edits.randrange(len(words))] = edits.choice(WORDS)
+            lines[line] = " ".join(words)
+        if num % 3 == 0:
+            title = SECTION_TITLES[(num // 3) % len(SECTION_TITLES)]
+            lines.insert(rng.randrange(len(lines)), title)
+        metadata = {"source": "synthetic.pdf", "total_pages": n_pages, "page": num, "page_label": str(num + 1)}
+        yield Document(page_content="\n".join(lines), metadata=metadata)
+
+
+def synthetic_pages(n_pages: int, lines_per_page: int = 45, seed: int = 0) -> list[Document]:
+    return list(iter_synthetic_pages(n_pages, lines_per_page, seed))
+
+
+def write_pdf(path: str, n_pages: int, lines_per_page: int = 45, seed: int = 0, title: str = "Synthetic paper",
+              revision: int = 0):
+    """
+    Writes a text PDF with the synthetic pages, used to benchmark the text-extraction backends.
+    """
+    import fitz  # PyMuPDF
+
+    pdf = fitz.open()
+    pdf.set_metadata({"title": title, "author": "Bench Author", "creationDate": "D:20250101000000"})
+    for page_doc in iter_synthetic_pages(n_pages, lines_per_page, seed, revision):
+        page = pdf.new_page()
+        page.insert_text((50, 50), page_doc.page_content, fontsize=8)
+    pdf.save(path)
+    pdf.close()
+
+
+def write_pdf_corpus(directory: str, n_files: int, n_pages: int, seed: int = 0, versions: int = 1) -> list[str]:
+    """
+    Writes n_files synthetic PDFs into the directory and returns their paths. With versions above 1
+    every paper is also written in slightly revised versions under another title, like a preprint
+    and its published version.
+    """
+    paths = []
+    for revision in range(versions):
+        for num in range(n_files):
+            suffix = f"_v{revision}" if revision else ""
+            path = f"{directory}/paper_{num}{suffix}.pdf"
+            title = f"Synthetic paper {num}" + (f", version {revision + 1}" if revision else "")
+            write_pdf(path, n_pages, seed=seed + num, title=title, revision=revision)
+            paths.append(path)
+    return paths
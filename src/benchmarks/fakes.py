@@ -0,0 +1,128 @@
+"""
+Deterministic local stand-ins for ChatOpenAI, OpenAIEmbeddings and the persistent Chroma directory,
+so the whole RAG pipeline can be benchmarked offline.
+"""
+import hashlib
+import json
+import math
+import re
+import tempfile
+import time
+from typing import Any, Iterator
+
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def tool_call_arguments(text: str, function: dict) -> dict:
+    """
+    Valid arguments of a tool call built from the prompt text: QuotedAnswer citing the hashes of the given
+    sources, otherwise bibliographic fields derived from the paper text.
+    """
+    if function["name"] == "QuotedAnswer":
+        hashes = list(dict.fromkeys(re.findall(r"Hash: (\w+)", text)))
+        words = text.split()
+        answer = " ".join(words[-60:]) + " " + " ".join(f"[{num + 1}]" for num in range(len(hashes)))
+        citations = [{"source_id": num + 1, "hash": h} for num, h in enumerate(hashes)]
+        return {"answer": answer, "citations": citations}
+
+    # Bibliographic fields, different for every paper so the metadata hashes do not collide
+    digest = _digest(text)
+    values = {
+        "author": f"Name{digest[:4]} Family{digest[4:8]}; Name{digest[8:12]} Family{digest[12:16]}",
+        "title": f"Synthetic paper {digest[:8]}",
+        "journal": "Journal of Benchmarks",
+        "year": str(1990 + int(digest[:4], 16) % 35),
+        "volume": str(int(digest[4:6], 16)),
+        "number": str(int(digest[6:7], 16)),
+        "pages": "1-10",
+        "doi": f"10.0000/{digest[:12]}",
+    }
+    return {field: values.get(field, digest[:8]) for field in function["parameters"]["properties"]}
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering every tool call with valid arguments built from the prompt: Bibcitation fields
+    derived from the paper text, QuotedAnswer citing the hashes of the given sources. Supports streaming.
+    """
+    latency: float = 0.
+    stream_chunk_size: int = 16
+    model_name: str = "fake-chat"
+    temperature: float = 0.
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools: list, tool_choice: Any = None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _tool_call(self, messages: list[BaseMessage], tools: list[dict]) -> tuple[str, dict]:
+        function = tools[0]["function"]
+        text = "\n".join(str(message.content) for message in messages)
+        return function["name"], tool_call_arguments(text, function)
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager=None,
+                  tools: list[dict] | None = None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        if not tools:
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content="fake answer"))])
+        name, args = self._tool_call(messages, tools)
+        message = AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": "call_0"}])
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager=None,
+                tools: list[dict] | None = None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        name, args = self._tool_call(messages, tools)
+        payload = json.dumps(args)
+        pieces = range(0, len(payload), self.stream_chunk_size)
+        for num, start in enumerate(pieces):
+            # the latency is spread over the tokens, the first token arrives after one share of it
+            time.sleep(self.latency / max(len(pieces), 1))
+            chunk = {"name": name if num == 0 else None, "args": payload[start:start + self.stream_chunk_size],
+                     "id": "call_0" if num == 0 else None, "index": 0}
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[chunk]))
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Embeddings built from the hashes of the words of the text, texts sharing words get similar vectors.
+    """
+
+    def __init__(self, size: int = 256, latency: float = 0., model: str = "fake-embedding"):
+        self.size = size
+        self.latency = latency
+        self.model = model
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.] * self.size
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int(_digest(word)[:8], 16)
+            vector[digest % self.size] += 1. if digest & 1 << 31 else -1.
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+
+def temporary_chroma(embeddings: Embeddings, directory: str | None = None) -> Chroma:
+    """
+    Creates a persistent Chroma collection in a temporary directory.
+    """
+    directory = directory or tempfile.mkdtemp(prefix="sciart-chroma-")
+    return Chroma(collection_name="langchain", embedding_function=embeddings, persist_directory=directory)
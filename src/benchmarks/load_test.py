@@ -0,0 +1,258 @@
+"""
+Load test of concurrent sessions against a local stand-in of the OpenAI API.
+
+The stand-in server answers /v1/chat/completions (tool calls, JSON schema and streamed responses) and
+/v1/embeddings after a configurable latency, like a remote model. The corpus is ingested locally with the fakes,
+then every session asks its questions through the real ChatOpenAI and OpenAIEmbeddings clients with pooled
+keep-alive connections, once with the sync graph in threads and once with the async graph in one event loop.
+Reports the throughput, the p50/p95/p99 latency and the peak number of model requests in flight.
+
+Usage (from src/):
+    python -m benchmarks.load_test --sessions 1 4 16 32 --questions 4 --latency 0.2 --max-concurrency 16
+"""
+import argparse
+import asyncio
+import base64
+import json
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_chains.concurrency import llm_limiter
+from llm_chains.ingest_cache import IngestCache
+from llm_chains.lexical_index import LexicalIndex
+from llm_chains.rag import RAG
+from llm_chains.spendings import SpendingClient
+from llm_chains.tracing import percentile
+
+from .corpus import write_pdf_corpus
+from .fakes import FakeChatModel, HashEmbeddings, temporary_chroma, tool_call_arguments
+from .run import QUESTIONS
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible endpoints, answers are built by the same logic as the fake chat model.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, the clients reuse their connections
+    latency = 0.
+    embeddings = HashEmbeddings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.latency)
+        if self.path.endswith("/embeddings"):
+            self.send_json(self.embed(body))
+        elif body.get("stream"):
+            self.stream_completion(body)
+        else:
+            self.send_json(self.completion(body))
+
+    def send_json(self, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def embed(self, body: dict) -> dict:
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = []
+        for num, vector in enumerate(self.embeddings.embed_documents(texts)):
+            if body.get("encoding_format") == "base64":
+                vector = base64.b64encode(struct.pack(f"{len(vector)}f", *vector)).decode()
+            data.append({"object": "embedding", "index": num, "embedding": vector})
+        tokens = sum(len(text.split()) for text in texts)
+        return {"object": "list", "data": data, "model": body["model"],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    @staticmethod
+    def arguments(body: dict) -> tuple[str, dict, bool]:
+        text = "\n".join(str(message.get("content") or "") for message in body["messages"])
+        if body.get("tools"):
+            function = body["tools"][0]["function"]
+            return function["name"], tool_call_arguments(text, function), True
+        schema = body["response_format"]["json_schema"]
+        function = {"name": schema["name"], "parameters": schema["schema"]}
+        return schema["name"], tool_call_arguments(text, function), False
+
+    @staticmethod
+    def usage(body: dict, arguments: str) -> dict:
+        prompt = sum(len(str(message.get("content") or "").split()) for message in body["messages"])
+        completion = len(arguments.split())
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def completion(self, body: dict) -> dict:
+        name, args, tool = self.arguments(body)
+        arguments = json.dumps(args)
+        if tool:
+            message = {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_0", "type": "function", "function": {"name": name, "arguments": arguments}}]}
+        else:
+            message = {"role": "assistant", "content": arguments}
+        return {"id": "chatcmpl-0", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool else "stop"}],
+                "usage": self.usage(body, arguments)}
+
+    def stream_completion(self, body: dict):
+        name, args, _ = self.arguments(body)
+        arguments = json.dumps(args)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices: list, usage: dict | None = None):
+            payload = {"id": "chatcmpl-0", "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": body["model"], "choices": choices, "usage": usage}
+            self.write_chunk(f"data: {json.dumps(payload)}\n\n")
+
+        for start in range(0, len(arguments), 16):
+            call = {"index": 0, "function": {"arguments": arguments[start:start + 16]}}
+            if start == 0:
+                call.update(id="call_0", type="function", function={"name": name, "arguments": arguments[:16]})
+            event([{"index": 0, "delta": {"tool_calls": [call]}, "finish_reason": None}])
+        event([{"index": 0, "delta": {}, "finish_reason": "tool_calls"}])
+        if body.get("stream_options", {}).get("include_usage"):
+            event([], self.usage(body, arguments))
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+
+def start_server(latency: float) -> ThreadingHTTPServer:
+    handler = type("Handler", (StandInHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def ingest_corpus(directory: str, n_papers: int, n_pages: int) -> list[str]:
+    """
+    Ingests the corpus with the local fakes, returns the metadata hashes of the papers.
+    """
+    rag = RAG(FakeChatModel(), temporary_chroma(HashEmbeddings(), f"{directory}/chroma"),
+              SpendingClient(client_name="load_test"), IngestCache(f"{directory}/ingest_cache.sqlite"),
+              lexical_index=LexicalIndex(f"{directory}/lexical_index.sqlite"))
+    records = rag.ingest_many(write_pdf_corpus(directory, n_papers, n_pages))
+    return [record.meta_hash for record in records]
+
+
+def served_rag(directory: str, base_url: str, http_client, http_async_client) -> RAG:
+    """
+    RAG over the ingested corpus, the chat model and the query embeddings go through the stand-in server.
+    """
+    from langchain_chroma import Chroma
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+    clients = {"base_url": base_url, "api_key": "test", "http_client": http_client,
+               "http_async_client": http_async_client}
+    embeddings = OpenAIEmbeddings(check_embedding_ctx_length=False, **clients)
+    vectorstore = Chroma(collection_name="langchain", embedding_function=embeddings,
+                         persist_directory=f"{directory}/chroma")
+    return RAG(ChatOpenAI(model="gpt-4o-mini", temperature=0., stream_usage=True, **clients), vectorstore,
+               SpendingClient(client_name="load_test"), lexical_index=LexicalIndex(f"{directory}/lexical_index.sqlite"))
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict[str, float]:
+    latencies = sorted(latencies)
+    return {"requests_per_s": len(latencies) / elapsed,
+            "p50_ms": 1000 * percentile(latencies, 0.50),
+            "p95_ms": 1000 * percentile(latencies, 0.95),
+            "p99_ms": 1000 * percentile(latencies, 0.99),
+            "peak_in_flight": llm_limiter.stats()["peak"]}
+
+
+def run_sync(graph, sessions: int, questions: int, config: dict) -> dict[str, float]:
+    def session(num: int) -> list[float]:
+        latencies = []
+        for question in range(questions):
+            start = time.perf_counter()
+            graph.invoke({"question": QUESTIONS[(num + question) % len(QUESTIONS)]}, config=config)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    llm_limiter.reset_stats()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(sessions) as pool:
+        latencies = [latency for result in pool.map(session, range(sessions)) for latency in result]
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def run_async(graph, sessions: int, questions: int, config: dict) -> dict[str, float]:
+    async def session(num: int) -> list[float]:
+        latencies = []
+        for question in range(questions):
+            start = time.perf_counter()
+            await graph.ainvoke({"question": QUESTIONS[(num + question) % len(QUESTIONS)]}, config=config)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    llm_limiter.reset_stats()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(session(num) for num in range(sessions)))
+    return summarize([latency for result in results for latency in result], time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--questions", type=int, default=4, help="questions asked in a row by every session")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the stand-in server takes per request")
+    parser.add_argument("--papers", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=4)
+    parser.add_argument("--chunk-nums", type=int, default=8)
+    parser.add_argument("--retrieval", default="hybrid", choices=["vector", "lexical", "hybrid"])
+    parser.add_argument("--mode", default="stuff", choices=["stuff", "map_reduce"])
+    parser.add_argument("--stream", action="store_true", help="stream the answers")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="cap of model requests in flight")
+    args = parser.parse_args()
+
+    import httpx
+
+    if args.max_concurrency:
+        llm_limiter.resize(args.max_concurrency)
+    server = start_server(args.latency)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    config = {"configurable": {"chunk_nums": args.chunk_nums, "retrieval": args.retrieval, "mode": args.mode,
+                               "stream_answer": args.stream}}
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.)
+
+    with tempfile.TemporaryDirectory() as directory:
+        ingest_corpus(directory, args.papers, args.pages)
+        http_client = httpx.Client(limits=limits)
+
+        async def measure() -> dict[int, tuple[dict, dict]]:
+            # The async client lives in this loop, so every async run shares its connections
+            async with httpx.AsyncClient(limits=limits) as http_async_client:
+                graph = served_rag(directory, base_url, http_client, http_async_client).create_graph()
+                results = {}
+                for sessions in args.sessions:
+                    sync = await asyncio.to_thread(run_sync, graph, sessions, args.questions, config)
+                    results[sessions] = sync, await run_async(graph, sessions, args.questions, config)
+                return results
+
+        results = asyncio.run(measure())
+        http_client.close()
+    server.shutdown()
+
+    print(f"{'sessions':>8} {'mode':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak':>5}")
+    for sessions, runs in results.items():
+        for mode, metrics in zip(["sync", "async"], runs):
+            print(f"{sessions:>8} {mode:>6} {metrics['requests_per_s']:>8.2f} {metrics['p50_ms']:>8.0f} "
+                  f"{metrics['p95_ms']:>8.0f} {metrics['p99_ms']:>8.0f} {metrics['peak_in_flight']:>5}")
+
+
+if __name__ == "__main__":
+    main()
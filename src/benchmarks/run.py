@@ -0,0 +1,160 @@
+"""
+Offline end-to-end benchmark of the RAG pipeline with fake LLM and embedding stand-ins.
+
+Measures the ingest throughput, the query latency against corpus size and chunk_nums, and the peak memory.
+With --baseline the run fails (exit code 1) when a metric regresses by more than --threshold.
+
+Usage (from src/):
+    python -m benchmarks.run --papers 5 20 --pages 12 --chunk-nums 4 16 64 --save results.json
+    python -m benchmarks.run --papers 5 20 --pages 12 --chunk-nums 4 16 64 --baseline results.json --threshold 0.2
+"""
+import argparse
+import json
+import resource
+import sys
+import tempfile
+import time
+
+from llm_chains.dedup import NearDuplicateIndex
+from llm_chains.ingest_cache import IngestCache
+from llm_chains.lexical_index import LexicalIndex
+from llm_chains.partitioning import PartitionedVectorStore
+from llm_chains.quantized_store import QuantizedVectorStore
+from llm_chains.rag import RAG
+from llm_chains.spendings import SpendingClient
+from llm_chains.tracing import QUANTILES, percentile
+
+from .corpus import write_pdf_corpus
+from .fakes import FakeChatModel, HashEmbeddings, temporary_chroma
+
+
+QUESTIONS = [
+    "How does temperature change the reaction yield?",
+    "What is known about receptor binding affinity?",
+    "Which methods were used to measure protein expression?",
+    "How accurate is the model compared to the baseline?",
+    "What pathway signal was observed in the cell membrane?",
+]
+
+
+def build_rag(directory: str, args: argparse.Namespace) -> RAG:
+    embeddings = HashEmbeddings(latency=args.embedding_latency)
+    if args.vectorstore != "chroma":
+        def collection(name: str) -> QuantizedVectorStore:
+            return QuantizedVectorStore(embeddings, f"{directory}/vectors/{name}", quantization=args.vectorstore)
+
+        vectorstore = (PartitionedVectorStore({f"langchain_{num}": collection(f"langchain_{num}")
+                                               for num in range(args.shards)})
+                       if args.shards > 1 else collection("langchain"))
+    elif args.shards > 1:
+        vectorstore = PartitionedVectorStore.from_chroma(embeddings, f"{directory}/chroma", shards=args.shards)
+    else:
+        vectorstore = temporary_chroma(embeddings, f"{directory}/chroma")
+    return RAG(
+        FakeChatModel(latency=args.llm_latency),
+        vectorstore,
+        SpendingClient(client_name="bench"),
+        IngestCache(f"{directory}/ingest_cache.sqlite"),
+        loader=args.backend,
+        lexical_index=LexicalIndex(f"{directory}/lexical_index.sqlite"),
+        dedup_index=NearDuplicateIndex(f"{directory}/dedup_index.sqlite") if args.dedup else None,
+    )
+
+
+def bench_corpus(n_papers: int, args: argparse.Namespace) -> dict[str, float]:
+    metrics = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_pdf_corpus(directory, n_papers, args.pages, versions=args.versions)
+        rag = build_rag(directory, args)
+
+        start = time.perf_counter()
+        records = rag.ingest_many(paths, max_workers=args.workers)
+        elapsed = time.perf_counter() - start
+        metrics[f"ingest/{n_papers}/papers_per_s"] = len(paths) / elapsed
+        metrics[f"ingest/{n_papers}/pages_per_s"] = len(paths) * args.pages / elapsed
+        if rag.dedup_index is not None:
+            metrics[f"ingest/{n_papers}/duplicate_chunks"] = rag.dedup_index.stats().duplicates
+            metrics[f"ingest/{n_papers}/stored_chunks"] = rag.dedup_index.stats().unique
+
+        chain = rag.create_graph()
+        for chunk_nums in args.chunk_nums:
+            config = {"configurable": {"chunk_nums": chunk_nums, "retrieval": args.retrieval,
+                                       "per_paper_k": args.per_paper_k, "mode": args.mode,
+                                       "hashes": [record.meta_hash for record in records[:args.scope]] or None}}
+            latencies = []
+            for num in range(args.queries):
+                start = time.perf_counter()
+                chain.invoke({"question": QUESTIONS[num % len(QUESTIONS)]}, config=config)
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            for name, q in QUANTILES.items():
+                metrics[f"query/{n_papers}/{chunk_nums}/{name}_ms"] = 1000 * percentile(latencies, float(q))
+    return metrics
+
+
+def compare(metrics: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """
+    Returns the metrics worse than the baseline by more than the threshold.
+    Throughputs (per_s) must not drop, latencies and memory must not grow.
+    """
+    regressions = []
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        change = value / base - 1
+        worse = -change if name.endswith("_per_s") else change
+        if worse > threshold:
+            regressions.append(f"{name}: {base:.2f} -> {value:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--papers", type=int, nargs="+", default=[5, 20])
+    parser.add_argument("--pages", type=int, default=12)
+    parser.add_argument("--chunk-nums", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--llm-latency", type=float, default=0.)
+    parser.add_argument("--embedding-latency", type=float, default=0.)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--retrieval", default="vector", choices=["vector", "lexical", "hybrid"])
+    parser.add_argument("--mode", default="stuff", choices=["stuff", "map_reduce"])
+    parser.add_argument("--vectorstore", default="chroma", choices=["chroma", "int8", "float16"],
+                        help="Chroma or the quantized memory-mapped store")
+    parser.add_argument("--shards", type=int, default=1, help="split the vectorstore into this many collections")
+    parser.add_argument("--scope", type=int, default=0, help="search only the first N papers, 0 - all of them")
+    parser.add_argument("--per-paper-k", type=int, default=None)
+    parser.add_argument("--versions", type=int, default=1, help="versions of every paper, e.g. preprint and published")
+    parser.add_argument("--dedup", action="store_true", help="skip embedding near-duplicate chunks")
+    parser.add_argument("--backend", default=None, help="PDF backend, see llm_chains.loaders")
+    parser.add_argument("--save", help="write the metrics to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    metrics = {}
+    for n_papers in args.papers:
+        metrics.update(bench_corpus(n_papers, args))
+    # ru_maxrss is reported in KiB on Linux, the ingest workers are counted separately
+    metrics["memory/peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    metrics["memory/peak_rss_workers_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    for name, value in metrics.items():
+        print(f"{name:<40} {value:>12.2f}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(metrics, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(metrics, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions above {:.0%}:".format(args.threshold))
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("\nNo regression above {:.0%}.".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
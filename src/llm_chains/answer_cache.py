@@ -0,0 +1,134 @@
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import RunnableConfig
+
+from .citation_styles import SummaryCitation
+from .embedding_cache import normalize_text
+
+
+# Configurable keys which change how the answer is delivered, not the answer itself
+IGNORED_CONFIG_KEYS = {"stream_answer"}
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.
+
+
+class AnswerCache:
+    """
+    Persistent cache of finished summaries in front of the compiled graph.
+
+    Entries are keyed on the normalized question, the configurable part of the config, the model settings
+    and the corpus version, which is bumped every time new chunks are stored. With an embedding function the
+    cache also matches near-duplicate questions whose similarity is above the threshold.
+    """
+
+    def __init__(self, path: str = "./answer_cache.sqlite", embeddings: Embeddings | None = None,
+                 similarity_threshold: float = 0.95):
+        self.path = path
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    question TEXT NOT NULL,
+                    embedding BLOB,
+                    summary TEXT NOT NULL,
+                    created REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS corpus (id INTEGER PRIMARY KEY, version INTEGER NOT NULL)")
+            self._conn.execute("INSERT OR IGNORE INTO corpus (id, version) VALUES (0, 0)")
+
+    @property
+    def corpus_version(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT version FROM corpus WHERE id = 0").fetchone()[0]
+
+    def bump_corpus_version(self) -> int:
+        """
+        Invalidates every cached answer, called whenever the vectorstore content changes.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE corpus SET version = version + 1 WHERE id = 0")
+            version = self._conn.execute("SELECT version FROM corpus WHERE id = 0").fetchone()[0]
+            self._conn.execute("DELETE FROM answers WHERE version < ?", (version,))
+        return version
+
+    def make_scope(self, config: RunnableConfig, model_settings: dict, version: int) -> str:
+        configurable = {
+            key: value for key, value in config.get("configurable", {}).items() if key not in IGNORED_CONFIG_KEYS
+        }
+        scope = json.dumps([configurable, model_settings, version], sort_keys=True, default=str)
+        return hashlib.sha256(scope.encode()).hexdigest()
+
+    def get(self, question: str, config: RunnableConfig, model_settings: dict,
+            version: int | None = None) -> SummaryCitation | None:
+        """
+        Returns the cached summary for the question or None on a miss.
+
+        The corpus version should be read before the lookup and passed on to put with the new answer,
+        so an answer generated while new chunks were stored is never cached under the newer version.
+        """
+        question = normalize_text(question).lower()
+        if version is None:
+            version = self.corpus_version
+        scope = self.make_scope(config, model_settings, version)
+        key = hashlib.sha256(f"{scope}\0{question}".encode()).hexdigest()
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None and self.embeddings is not None:
+                candidates = self._conn.execute(
+                    "SELECT summary, embedding FROM answers WHERE scope = ? AND embedding IS NOT NULL", (scope,)
+                ).fetchall()
+            else:
+                candidates = []
+        if row is not None:
+            return SummaryCitation.model_validate_json(row[0])
+        if not candidates:
+            return None
+
+        query = self.embeddings.embed_query(question)
+        best_score, best_summary = 0., None
+        for summary, blob in candidates:
+            score = cosine_similarity(query, array("f", blob).tolist())
+            if score > best_score:
+                best_score, best_summary = score, summary
+        if best_score >= self.similarity_threshold:
+            return SummaryCitation.model_validate_json(best_summary)
+        return None
+
+    def put(self, question: str, config: RunnableConfig, model_settings: dict, summary: SummaryCitation,
+            version: int):
+        """
+        Caches the summary generated over the given corpus version, it is dropped if the corpus changed since.
+        """
+        question = normalize_text(question).lower()
+        scope = self.make_scope(config, model_settings, version)
+        key = hashlib.sha256(f"{scope}\0{question}".encode()).hexdigest()
+        embedding = None
+        if self.embeddings is not None:
+            embedding = array("f", self.embeddings.embed_query(question)).tobytes()
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT version FROM corpus WHERE id = 0").fetchone()[0] != version:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, scope, version, question, embedding, summary, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, scope, version, question, embedding, summary.model_dump_json(), time.time()),
+            )
@@ -0,0 +1,228 @@
+"""
+Headless batch runner: answers a JSON lines file of questions over the stored corpus, concurrently,
+under request-per-minute and token-per-minute limits, and streams the results as JSON lines.
+
+Every input line holds a "question", an optional "id" and any key of the configurable graph config
+("chunk_nums", "token_budget", "retrieval", "hashes", ...), missing keys take the command line defaults.
+
+Usage (from src/):
+    python -m llm_chains.batch questions.jsonl -o results.jsonl --concurrency 8 --rpm 500 --tpm 200000
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import AsyncIterator, Iterable
+
+from langchain_core.runnables.config import RunnableConfig
+
+from .citation_styles import SummaryCitation
+from .context_postprocessing import count_tokens
+from .spendings import Spendings, SpendingsMeta
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests and the tokens sent per minute, both refilled continuously.
+    Waiting callers are served in arrival order, so a large request is not starved by small ones.
+    """
+
+    def __init__(self, requests_per_minute: int = 500, tokens_per_minute: int = 200_000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        # a request larger than the bucket could never start, it waits for a full bucket instead
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60 / self.requests_per_minute,
+                           (tokens - self._tokens) * 60 / self.tokens_per_minute)
+                await asyncio.sleep(wait)
+
+    def settle(self, estimated: int, actual: int):
+        """
+        Corrects the token bucket once the real usage of a request is known.
+        """
+        self._refill()
+        self._tokens = min(self.tokens_per_minute, self._tokens + estimated - actual)
+
+
+def retryable_errors() -> tuple[type[Exception], ...]:
+    """
+    Returns the API errors worth retrying: rate limits, timeouts, connection and server errors.
+    """
+    try:
+        import openai
+    except ImportError:
+        return ()
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class BatchRunner:
+    """
+    Runs many questions through the compiled graph concurrently. Answers already in the answer cache are
+    returned without calling the model, new answers are cached and their spendings recorded.
+    """
+
+    def __init__(self, rag, graph=None, max_concurrency: int = 8, limiter: RateLimiter | None = None,
+                 max_retries: int = 5, base_delay: float = 1., max_delay: float = 60.,
+                 completion_tokens: int = 800, chunk_tokens: int = 250, style_name: str = 'harvard1'):
+        self.rag = rag
+        self.graph = graph or rag.create_graph()
+        self.max_concurrency = max_concurrency
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completion_tokens = completion_tokens
+        self.chunk_tokens = chunk_tokens
+        self.style_name = style_name
+
+    def estimate_tokens(self, question: str, config: RunnableConfig) -> int:
+        """
+        Upper estimate of the tokens of one request: prompt, retrieved context and answer.
+        """
+        configurable = config["configurable"]
+        context = configurable.get("token_budget") or configurable.get("chunk_nums", 4) * self.chunk_tokens
+        return count_tokens(question) + context + self.completion_tokens
+
+    async def run_one(self, item: dict, defaults: dict) -> dict:
+        item_id = item.get("id")
+        question = item["question"]
+        config = {"configurable": {**defaults, **{k: v for k, v in item.items() if k not in ["id", "question"]}}}
+        result = {"id": item_id, "question": question}
+        start = time.perf_counter()
+
+        # read before the lookup, an answer generated while papers are ingested is not cached as current
+        version = self.rag.corpus_version()
+        summary = self.rag.cached_answer(question, config, version)
+        attempts, cost = 0, SpendingsMeta.empty()
+        if summary is None:
+            from langchain_community.callbacks import get_openai_callback
+
+            estimated = self.estimate_tokens(question, config)
+            errors = retryable_errors()
+            while True:
+                attempts += 1
+                await self.limiter.acquire(estimated)
+                try:
+                    # the callback context is copied into every task, so each question counts its own usage
+                    with get_openai_callback() as cb:
+                        response = await self.graph.ainvoke({"question": question}, config=config)
+                    break
+                except errors as e:
+                    if attempts > self.max_retries:
+                        result.update(error=f"{type(e).__name__}: {e}", attempts=attempts,
+                                      latency_s=time.perf_counter() - start)
+                        return result
+                    # exponential backoff with full jitter
+                    await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts)))
+            self.limiter.settle(estimated, cb.total_tokens)
+            cost = SpendingsMeta.from_api_response(cb)
+            summary = SummaryCitation.parse_summary(response)
+            self.rag.spendings.add_spending(Spendings(
+                cost=cost, operation="summary", model=self.rag.model_settings()["model"],
+                doc_hash=";".join(sorted(summary.context))))
+            self.rag.cache_answer(question, config, summary, version)
+
+        result.update(
+            answer=summary.answer,
+            citations=[citation.hash for citation in summary.citations],
+            text=summary.style(self.style_name),
+            cost=cost.model_dump(),
+            cache_hit=attempts == 0,
+            attempts=attempts,
+            latency_s=time.perf_counter() - start,
+        )
+        return result
+
+    async def run(self, items: Iterable[dict], **defaults) -> AsyncIterator[dict]:
+        """
+        Yields the result of every item as soon as it is done, at most max_concurrency questions run at once.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(item: dict) -> dict:
+            async with semaphore:
+                try:
+                    return await self.run_one(item, defaults)
+                except Exception as e:
+                    return {"id": item.get("id"), "question": item.get("question"), "error": f"{type(e).__name__}: {e}"}
+
+        tasks = [asyncio.create_task(bounded(item)) for item in items]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+
+def read_jsonl(path: str) -> list[dict]:
+    items = []
+    with open(path) as f:
+        for num, line in enumerate(f, start=1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault("id", num)
+                items.append(item)
+    return items
+
+
+async def run_file(runner: BatchRunner, input_path: str, output, **defaults) -> int:
+    failed = 0
+    async for result in runner.run(read_jsonl(input_path), **defaults):
+        failed += "error" in result
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSON lines file of questions")
+    parser.add_argument("-o", "--output", help="JSON lines file of results, standard output by default")
+    parser.add_argument("--chunk-nums", type=int, default=4)
+    parser.add_argument("--retrieval", default="hybrid", choices=["vector", "lexical", "hybrid"])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=int, default=500, help="requests per minute")
+    parser.add_argument("--tpm", type=int, default=200_000, help="tokens per minute")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--style", default="harvard1", help="citation style of the text field")
+    args = parser.parse_args()
+
+    from . import services
+
+    runner = BatchRunner(services.rag(), services.graph(), max_concurrency=args.concurrency,
+                         limiter=RateLimiter(args.rpm, args.tpm), max_retries=args.max_retries,
+                         style_name=args.style)
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        # the shared loop of the services, where the pooled async HTTP client lives
+        failed = services.run_async(run_file(runner, args.input, output, chunk_nums=args.chunk_nums,
+                                             retrieval=args.retrieval))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    if failed:
+        print(f"{failed} questions failed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 from pydantic import BaseModel, Field
 
-from citeproc import CitationStylesStyle, CitationStylesBibliography
-from citeproc import Citation, CitationItem, formatter
-from citeproc.source.json import CiteProcJSON
+if TYPE_CHECKING:
+    from citeproc import CitationStylesStyle, CitationStylesBibliography
 
 from langchain_core.documents import Document
 
 from .objects import QuotedAnswer, LlmCitation
+from .tracing import tracer
 
 
 class SummaryCitation(BaseModel):
@@ -14,9 +18,10 @@ class SummaryCitation(BaseModel):
     Class to represent a summary with citations.
     """
     question: str
-    context: dict[str, Document]
-    answer: str
-    citations: list[LlmCitation]
+    context: dict[str, Document] = Field(default_factory=dict)
+    answer: str = ""
+    citations: list[LlmCitation] = Field(default_factory=list)
+    context_stats: dict[str, int] = Field(default_factory=dict)
 
     @classmethod
     def parse_summary(cls, response: dict[str, str | list[Document] | QuotedAnswer]) -> "SummaryCitation":
@@ -27,52 +32,167 @@ class SummaryCitation(BaseModel):
         context = {i.metadata["hash"]:i for i in response["context"]}
         answer = response["answer"].answer
         citations = response["answer"].citations
-        return cls(question=question, context=context, answer=answer, citations=citations)
+        context_stats = response.get("context_stats", {})
+        return cls(question=question, context=context, answer=answer, citations=citations,
+                   context_stats=context_stats)
+
+    def update(self, mode: str, chunk: dict) -> "SummaryCitation":
+        """
+        Merges one chunk of the graph stream (stream_mode=["updates", "custom"]) into the summary.
+        Partial answers replace the text, node updates bring the context and the final citations.
+        """
+        if mode == "custom":
+            if chunk.get("answer"):
+                self.answer = chunk["answer"]
+            return self
+
+        for update in chunk.values():
+            if not update:
+                continue
+            if "context" in update:
+                self.context = {i.metadata["hash"]: i for i in update["context"]}
+            if "answer" in update:
+                self.answer = update["answer"].answer
+                self.citations = update["answer"].citations
+            if "context_stats" in update:
+                self.context_stats = update["context_stats"]
+        return self
     
     def style(self, style_name: str = 'harvard1') -> str:
         """
         Returns a string representation of the SummaryCitation object.
         """
-        # Format the citations using the default style
-        bibliography = self.format_citations(style_name)
-        citations = "\n".join([str(item) for item in bibliography.bibliography()])
-        return f"Summary: \n\n{self.answer}\n\n\n\nCitations: \n\n{citations}"
+        return self.style_many([style_name])[style_name]
 
-    def format_citations(self, style_name: str = 'harvard1') -> str:
+    def style_many(self, style_names: list[str]) -> dict[str, str]:
         """
-        Formats the citations in the specified style.
+        Returns the string representation in every requested style, the CSL entries are built once.
         """
+        # Format the citations using the default style
+        with tracer.span("citation_style") as span:
+            entries = self.csl_entries()
+            result = {}
+            for style_name in style_names:
+                citations = "\n".join(render_bibliography(entries, style_name).values())
+                result[style_name] = f"Summary: \n\n{self.answer}\n\n\n\nCitations: \n\n{citations}"
+            span.count("citations", len(entries) * len(style_names))
+        return result
 
-        def warn(citation_item):
-            print("WARNING: Reference with key '{}' not found in the bibliography."
-                .format(citation_item.key))
-        
+    def csl_entries(self) -> list[dict]:
+        """
+        Returns the CSL entries of the cited papers, one per paper.
+        """
         # We need to retrive paper metadata from the database
         # and format it in a way that citeproc can understand
-        csl_entries = []
+        entries = {}
         for entry in self.citations:
-            cit_meta = self.context[entry.hash].metadata
-            csl_entries.append({
-                "id": entry.hash,
-                "type": "article-journal",
-                "title": cit_meta.get("title"),
-                "author": [
-                    {"given": name.split()[0], "family": name.split()[-1]}
-                    for name in cit_meta.get("author").split(";")
-                ],
-                "issued": {"date-parts": [[int(cit_meta.get("year"))]]},
-                "container-title": cit_meta.get("journal"),
-                "volume": cit_meta.get("volume"),
-                "issue": cit_meta.get("number"),
-                "page": cit_meta.get("pages"),
-                "DOI": cit_meta.get("doi")
-            })
-
-        # Step 3: Load CSL style and generate bibliography
-        bib_source = CiteProcJSON(csl_entries)
-        style = CitationStylesStyle(style_name, validate=False)
-        bibliography = CitationStylesBibliography(style, bib_source, formatter.plain)
-        citation = Citation([CitationItem(entry["id"]) for entry in csl_entries])
-        bibliography.register(citation)
-        bibliography.cite(citation, warn)
-        return bibliography
+            if entry.hash in self.context and entry.hash not in entries:
+                entries[entry.hash] = csl_entry(entry.hash, self.context[entry.hash].metadata)
+        return list(entries.values())
+
+    def format_citations(self, style_name: str = 'harvard1') -> "CitationStylesBibliography":
+        """
+        Formats the citations in the specified style.
+        """
+        with _render_lock:
+            return _bibliography(self.csl_entries(), style_name)
+
+
+# citeproc keeps the formatter on the parsed style, so a shared style is rendered by one thread at a time
+_render_lock = threading.RLock()
+# Chunk metadata fields which make up the CSL entry of a paper
+CSL_FIELDS = ("author", "title", "journal", "volume", "number", "pages", "doi", "year")
+
+
+@lru_cache(maxsize=32)
+def load_style(style_name: str) -> "CitationStylesStyle":
+    """
+    Parses the CSL style once per process.
+    """
+    from citeproc import CitationStylesStyle
+
+    return CitationStylesStyle(style_name, validate=False)
+
+
+def csl_entry(doc_hash: str, metadata: dict[str, str]) -> dict:
+    """
+    Builds the CSL entry of a paper from its chunk metadata, memoized by the document hash and the paper fields.
+    """
+    return _csl_entry(doc_hash, tuple(metadata.get(field) for field in CSL_FIELDS))
+
+
+@lru_cache(maxsize=4096)
+def _csl_entry(doc_hash: str, values: tuple) -> dict:
+    metadata = dict(zip(CSL_FIELDS, values))
+    authors = []
+    for name in (metadata["author"] or "").split(";"):
+        parts = name.split()
+        if parts:
+            authors.append({"given": parts[0], "family": parts[-1]})
+    year = str(metadata["year"] or "").strip()
+    entry = {
+        "id": doc_hash,
+        "type": "article-journal",
+        "title": metadata["title"],
+        "author": authors,
+        "container-title": metadata["journal"],
+        "volume": metadata["volume"],
+        "issue": metadata["number"],
+        "page": metadata["pages"],
+        "DOI": metadata["doi"]
+    }
+    if year.isdigit():
+        entry["issued"] = {"date-parts": [[int(year)]]}
+    return entry
+
+
+def _warn(citation_item):
+    print("WARNING: Reference with key '{}' not found in the bibliography."
+        .format(citation_item.key))
+
+
+def _bibliography(entries: list[dict], style_name: str) -> "CitationStylesBibliography":
+    from citeproc import CitationStylesBibliography, Citation, CitationItem, formatter
+    from citeproc.source.json import CiteProcJSON
+
+    # Step 3: Load CSL style and generate bibliography
+    bib_source = CiteProcJSON(entries)
+    bibliography = CitationStylesBibliography(load_style(style_name), bib_source, formatter.plain)
+    citation = Citation([CitationItem(entry["id"]) for entry in entries])
+    bibliography.register(citation)
+    bibliography.cite(citation, _warn)
+    return bibliography
+
+
+def render_bibliography(entries: list[dict], style_name: str = 'harvard1') -> dict[str, str]:
+    """
+    Renders the CSL entries in one pass.
+
+    Returns:
+        dict[str, str]: Formatted reference by lowercased entry id, in bibliography order.
+    """
+    if not entries:
+        return {}
+    with _render_lock:
+        bibliography = _bibliography(entries, style_name)
+        return dict(zip(bibliography.keys, (str(item) for item in bibliography.bibliography())))
+
+
+def style_summaries(summaries: list[SummaryCitation], style_name: str = 'harvard1') -> list[str]:
+    """
+    Returns the string representation of several summaries, their references are rendered in a single pass.
+    """
+    entries = {}
+    for summary in summaries:
+        for entry in summary.csl_entries():
+            entries.setdefault(entry["id"], entry)
+    with tracer.span("citation_style") as span:
+        rendered = render_bibliography(list(entries.values()), style_name)
+        span.count("citations", len(entries))
+
+    result = []
+    for summary in summaries:
+        keys = {entry["id"].lower() for entry in summary.csl_entries()}
+        citations = "\n".join(text for key, text in rendered.items() if key in keys)
+        result.append(f"Summary: \n\n{summary.answer}\n\n\n\nCitations: \n\n{citations}")
+    return result
@@ -0,0 +1,171 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
+
+if TYPE_CHECKING:
+    from langchain_core.runnables import Runnable
+
+
+class ConcurrencyLimiter:
+    """
+    Process-wide cap on the number of model requests in flight, shared by threads and event loops.
+
+    Waiters are served first come, first served. A thread blocks until a slot is handed to it,
+    a coroutine awaits a future, so waiting never holds a worker thread of the event loop.
+    """
+
+    def __init__(self, max_concurrency: int = 16):
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.peak = 0
+        self.waits = 0
+        self._available = max_concurrency
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    def resize(self, max_concurrency: int):
+        """
+        Changes the cap, requests in flight above a lowered cap finish normally.
+        """
+        with self._lock:
+            self._available += max_concurrency - self.max_concurrency
+            self.max_concurrency = max_concurrency
+            grow = max(self._available, 0)
+        for _ in range(grow):
+            if not self._wake_one():
+                break
+
+    def _try_acquire(self) -> bool:
+        # called with the lock held
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            return True
+        self.waits += 1
+        return False
+
+    def _wake_one(self) -> bool:
+        """
+        Hands a free slot to the oldest waiter. Returns False if nobody waits.
+        """
+        with self._lock:
+            if self._available <= 0 or not self._waiters:
+                return False
+            self._available -= 1
+            waiter = self._waiters.popleft()
+        self._handover(waiter)
+        return True
+
+    def _handover(self, waiter):
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._resolve, future)
+            except RuntimeError:
+                # the loop of the waiter is closed, nobody will take the slot
+                self.release(counted=False)
+
+    def _resolve(self, future: asyncio.Future):
+        # runs in the loop of the waiter, a cancelled waiter passes the slot on
+        if future.cancelled():
+            self.release(counted=False)
+        else:
+            future.set_result(None)
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            future = asyncio.get_running_loop().create_future()
+            waiter = (asyncio.get_running_loop(), future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            # A slot handed over before the task resumed must be passed on, a cancelled future
+            # passes its slot on in _resolve
+            if not queued and future.done() and not future.cancelled():
+                self.release(counted=False)
+            raise
+
+    def release(self, counted: bool = True):
+        with self._lock:
+            if counted:
+                self.in_flight -= 1
+            if self._available < 0 or not self._waiters:
+                self._available += 1
+                return
+            waiter = self._waiters.popleft()
+        self._handover(waiter)
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    @contextmanager
+    def limit(self) -> Iterator[None]:
+        self.acquire()
+        self._enter()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def alimit(self) -> AsyncIterator[None]:
+        await self.aacquire()
+        self._enter()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def reset_stats(self):
+        with self._lock:
+            self.peak = self.in_flight
+            self.waits = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"max_concurrency": self.max_concurrency, "in_flight": self.in_flight, "peak": self.peak,
+                    "waits": self.waits}
+
+
+def limited(runnable: "Runnable", limiter: "ConcurrencyLimiter | None" = None) -> "Runnable":
+    """
+    Wraps the runnable so every call (also every item of batch and abatch) takes a slot of the limiter.
+    """
+    from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+    limiter = limiter or llm_limiter
+
+    def call(value, config: RunnableConfig):
+        with limiter.limit():
+            return runnable.invoke(value, config)
+
+    async def acall(value, config: RunnableConfig):
+        async with limiter.alimit():
+            return await runnable.ainvoke(value, config)
+
+    return RunnableLambda(call, afunc=acall, name=runnable.get_name())
+
+
+# Shared by every session of the process, the cap is set with the SCIART_MAX_CONCURRENCY environment variable
+llm_limiter = ConcurrencyLimiter(int(os.environ.get("SCIART_MAX_CONCURRENCY", "16")))
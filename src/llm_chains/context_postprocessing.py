@@ -1,5 +1,7 @@
 from collections import defaultdict
+from functools import lru_cache
 from typing_extensions import List, TypedDict
+from pydantic import BaseModel
 
 from langchain_core.documents import Document
 
@@ -31,3 +33,139 @@ def format_docs_with_id(docs: list[Document]) -> str:
                 )
             )
     return "\n\n" + "\n\n".join(formatted)
+
+
+class PackedContext(BaseModel):
+    """
+    Class to represent the context sent to the LLM and what packing saved.
+    """
+    text: str
+    tokens: int
+    tokens_raw: int
+    chunks_used: int
+    chunks_dropped: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_raw - self.tokens
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # tiktoken is optional and may fail to fetch its vocabulary offline
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of the text with the gpt-4o tokenizer, or estimates them when tiktoken is not available.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def limit_per_paper(docs: list[Document], per_paper_k: int) -> list[Document]:
+    """
+    Keeps at most per_paper_k chunks of every paper, in retrieval order, so one long paper cannot fill the context.
+    """
+    counts = defaultdict(int)
+    kept = []
+    for doc in docs:
+        counts[doc.metadata.get("hash")] += 1
+        if counts[doc.metadata.get("hash")] <= per_paper_k:
+            kept.append(doc)
+    return kept
+
+
+def merge_adjacent_chunks(docs: list[Document]) -> list[Document]:
+    """
+    Merges overlapping or adjacent chunks of the same paper section into a single snippet,
+    so the splitter overlap is sent only once. Chunks without position metadata are kept as they are.
+    """
+    groups = defaultdict(list)
+    standalone = []
+    for doc in docs:
+        if doc.metadata.get("section") is None or doc.metadata.get("start_index") is None:
+            standalone.append(doc)
+        else:
+            groups[(doc.metadata["hash"], doc.metadata["section"])].append(doc)
+
+    merged = []
+    for group in groups.values():
+        group = sorted(group, key=lambda d: d.metadata["start_index"])
+        current = group[0]
+        current_end = current.metadata["start_index"] + len(current.page_content)
+        for doc in group[1:]:
+            start = doc.metadata["start_index"]
+            end = start + len(doc.page_content)
+            if end <= current_end:
+                continue
+            if start <= current_end:
+                content = current.page_content + doc.page_content[current_end - start:]
+            elif start - current_end <= 2:
+                # only the separator removed by the splitter lies between the chunks
+                content = current.page_content + " " + doc.page_content
+            else:
+                merged.append(current)
+                current, current_end = doc, end
+                continue
+            current = Document(page_content=content, metadata=current.metadata)
+            current_end = end
+        merged.append(current)
+    return merged + standalone
+
+
+def pack_context(docs: list[Document], token_budget: int | None = None) -> PackedContext:
+    """
+    Packs the retrieved chunks into the LLM context: chunks are taken in retrieval order while they fit
+    in the token budget, neighbouring chunks are merged and every paper gets a single header.
+
+    Args:
+        docs (list[Document]): Retrieved chunks, the most relevant first.
+        token_budget (int | None): Maximum number of context tokens, no limit if None.
+
+    Returns:
+        PackedContext: Formatted context with its token count and the count of the unpacked format.
+    """
+    header = "Source ID: {num}\nHash: {hash}\nAuthors: {author}\nArticle Snippets:\n"
+    selected = []
+    used = 0
+    source_ids = {}
+    for doc in docs:
+        cost = count_tokens(doc.page_content)
+        if doc.metadata["hash"] not in source_ids:
+            cost += count_tokens(header.format(num=len(source_ids) + 1, hash=doc.metadata["hash"],
+                                               author=doc.metadata["author"]))
+        if token_budget and used + cost > token_budget:
+            continue
+        if doc.metadata["hash"] not in source_ids:
+            source_ids[doc.metadata["hash"]] = len(source_ids) + 1
+        selected.append(doc)
+        used += cost
+
+    snippets = defaultdict(list)
+    for doc in merge_adjacent_chunks(selected):
+        snippets[doc.metadata["hash"]].append(doc)
+
+    formatted = []
+    for meta_hash, num in source_ids.items():
+        # snippets are written in reading order of the paper
+        paper = sorted(snippets[meta_hash],
+                       key=lambda d: (d.metadata.get("section", 0), d.metadata.get("start_index", 0)))
+        content = "\n\n".join(doc.page_content for doc in paper)
+        formatted.append(header.format(num=num, hash=meta_hash, author=paper[0].metadata["author"]) + content)
+
+    text = "\n\n" + "\n\n".join(formatted)
+    return PackedContext(
+        text=text,
+        tokens=count_tokens(text),
+        tokens_raw=count_tokens(format_docs_with_id(docs)),
+        chunks_used=len(selected),
+        chunks_dropped=len(docs) - len(selected),
+    )
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.documents import Document
+from pydantic import BaseModel
+
+
+WORD_PATTERN = re.compile(r"\w+")
+# Parameters of the universal hash functions, the same for every process so the signatures stay comparable
+_MAX_PERMUTATIONS = 256
+_PERMUTATIONS = np.random.default_rng(1).integers(1, 2 ** 63, size=(2, _MAX_PERMUTATIONS), dtype=np.uint64)
+
+
+def shingles(text: str, size: int = 5) -> set[str]:
+    """
+    Returns the overlapping word n-grams of the lowercased text, short texts give a single shingle.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[num:num + size]) for num in range(len(words) - size + 1)}
+
+
+def minhash(text: str, num_perm: int = 128, shingle_size: int = 5) -> np.ndarray | None:
+    """
+    Returns the MinHash signature of the text: for every hash function the minimum over the shingles.
+    The share of equal values of two signatures estimates the Jaccard similarity of their shingle sets.
+    """
+    grams = shingles(text, shingle_size)
+    if not grams:
+        return None
+    values = np.fromiter((int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=8).digest(), "little")
+                          for gram in grams), dtype=np.uint64, count=len(grams))
+    a, b = _PERMUTATIONS[:, :num_perm]
+    # multiply-shift hashing, uint64 arithmetic wraps around, the high bits are kept
+    return ((values[:, None] * a + b) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+
+
+class DedupStats(BaseModel):
+    """
+    Counters of the chunks checked by the near-duplicate index.
+    """
+    chunks: int = 0
+    duplicates: int = 0
+
+    @property
+    def unique(self) -> int:
+        return self.chunks - self.duplicates
+
+    @property
+    def ratio(self) -> float:
+        return self.duplicates / self.chunks if self.chunks else 0.
+
+
+class NearDuplicateIndex:
+    """
+    Persistent MinHash/LSH index of the vectorstore chunks, stored in SQLite.
+
+    Every stored chunk keeps its signature and one LSH bucket per band, chunks sharing a bucket are candidates
+    and are compared on the full signature. A new chunk whose estimated Jaccard similarity with a stored chunk
+    reaches the threshold is not embedded, it is linked to the stored vector under the hash and metadata
+    of its own paper instead, so a preprint and its published version share their vectors.
+    """
+
+    def __init__(self, path: str = "./dedup_index.sqlite", threshold: float = 0.85, num_perm: int = 128,
+                 bands: int = 32, shingle_size: int = 5):
+        if num_perm % bands or num_perm > _MAX_PERMUTATIONS:
+            raise ValueError(f"num_perm must be a multiple of bands and at most {_MAX_PERMUTATIONS}")
+        self.path = path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS signatures (
+                    id TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    signature BLOB NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS buckets (
+                    bucket INTEGER NOT NULL,
+                    id TEXT NOT NULL,
+                    PRIMARY KEY (bucket, id)
+                ) WITHOUT ROWID"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS links (
+                    id TEXT PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    similarity REAL NOT NULL,
+                    metadata TEXT NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS signatures_hash ON signatures (hash)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_id ON buckets (id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS links_hash ON links (hash)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS links_target ON links (target)")
+
+    def _buckets(self, signature: np.ndarray) -> list[int]:
+        rows = self.num_perm // self.bands
+        # the band number is part of the key, so equal rows of different bands do not collide
+        return [int.from_bytes(hashlib.blake2b(bytes([band]) + signature[band * rows:(band + 1) * rows].tobytes(),
+                                               digest_size=8).digest(), "little", signed=True)
+                for band in range(self.bands)]
+
+    def _best_match(self, signature: np.ndarray, buckets: list[int],
+                    staged: dict[int, list[tuple[str, np.ndarray]]]) -> tuple[str, float] | None:
+        candidates = {chunk_id: sig for bucket in buckets for chunk_id, sig in staged.get(bucket, [])}
+        placeholders = ",".join("?" * len(buckets))
+        rows = self._conn.execute(
+            f"SELECT id, signature FROM signatures WHERE id IN "
+            f"(SELECT id FROM buckets WHERE bucket IN ({placeholders}))", buckets).fetchall()
+        candidates.update((chunk_id, np.frombuffer(blob, dtype=np.uint32)) for chunk_id, blob in rows)
+        best = None
+        for chunk_id, sig in candidates.items():
+            similarity = float(np.mean(sig == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = chunk_id, similarity
+        return best
+
+    def deduplicate(self, ids: list[str], docs: list[Document]) -> list[bool]:
+        """
+        Registers the chunks under the given IDs and returns for every chunk whether it must be stored.
+        Near duplicates of stored chunks, or of earlier chunks of the same call, are linked to them instead
+        and their IDs are never written to the vectorstore.
+        """
+        keep, signature_rows, bucket_rows, link_rows = [], [], [], []
+        staged: dict[int, list[tuple[str, np.ndarray]]] = {}
+        with self._lock:
+            for chunk_id, doc in zip(ids, docs):
+                signature = minhash(doc.page_content, self.num_perm, self.shingle_size)
+                if signature is None:
+                    keep.append(True)
+                    continue
+                buckets = self._buckets(signature)
+                match = self._best_match(signature, buckets, staged)
+                if match is not None:
+                    link_rows.append((chunk_id, match[0], doc.metadata.get("hash", ""), match[1],
+                                      json.dumps(doc.metadata)))
+                    keep.append(False)
+                    continue
+                keep.append(True)
+                signature_rows.append((chunk_id, doc.metadata.get("hash", ""), signature.tobytes()))
+                for bucket in buckets:
+                    staged.setdefault(bucket, []).append((chunk_id, signature))
+                    bucket_rows.append((bucket, chunk_id))
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO signatures (id, hash, signature) VALUES (?, ?, ?)",
+                                       signature_rows)
+                self._conn.executemany("INSERT OR IGNORE INTO buckets (bucket, id) VALUES (?, ?)", bucket_rows)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO links (id, target, hash, similarity, metadata) VALUES (?, ?, ?, ?, ?)",
+                    link_rows)
+        return keep
+
+    def forget(self, ids: list[str]):
+        """
+        Drops the chunks and the links to them, e.g. when writing them to the vectorstore failed.
+        """
+        with self._lock, self._conn:
+            self._forget(ids)
+
+    def forget_hash(self, meta_hash: str):
+        """
+        Drops the chunks of the paper and its links, e.g. when its vectors are no longer in the vectorstore.
+        """
+        with self._lock, self._conn:
+            self._forget([row[0] for row in self._conn.execute("SELECT id FROM signatures WHERE hash = ?",
+                                                               (meta_hash,))])
+            self._conn.execute("DELETE FROM links WHERE hash = ?", (meta_hash,))
+
+    def retain(self, ids: set[str]) -> int:
+        """
+        Drops the chunks missing from the given vectorstore IDs and the links to them, e.g. after the vectorstore
+        was reset. Returns the number of dropped chunks.
+        """
+        with self._lock, self._conn:
+            missing = [row[0] for row in self._conn.execute("SELECT id FROM signatures") if row[0] not in ids]
+            self._forget(missing)
+        return len(missing)
+
+    def clear(self):
+        with self._lock, self._conn:
+            for table in ["signatures", "buckets", "links"]:
+                self._conn.execute(f"DELETE FROM {table}")
+
+    def __len__(self) -> int:
+        """
+        Number of registered chunks stored in the vectorstore, the links are not counted.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM signatures").fetchone()[0]
+
+    def _forget(self, ids: list[str]):
+        # called with the lock held, sqlite limits the number of bound parameters, so delete in slices
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for table in ["signatures", "buckets", "links"]:
+                self._conn.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", part)
+            self._conn.execute(f"DELETE FROM links WHERE target IN ({placeholders})", part)
+
+    def linked(self, hashes: list[str]) -> dict[str, tuple[str, dict]]:
+        """
+        Returns the stored chunks linked to the given papers: ID -> (hash of the stored chunk, linked metadata).
+        """
+        if not hashes:
+            return {}
+        placeholders = ",".join("?" * len(hashes))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT l.target, s.hash, l.metadata FROM links l JOIN signatures s ON s.id = l.target "
+                f"WHERE l.hash IN ({placeholders})", list(hashes)).fetchall()
+        linked = {}
+        for chunk_id, meta_hash, metadata in rows:
+            linked.setdefault(chunk_id, (meta_hash, json.loads(metadata)))
+        return linked
+
+    def stats(self) -> DedupStats:
+        with self._lock:
+            stored, duplicates = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM signatures), (SELECT COUNT(*) FROM links)").fetchone()
+        return DedupStats(chunks=stored + duplicates, duplicates=duplicates)
+
+
+def resolve_links(docs: list[Document], hashes: list[str], linked: dict[str, tuple[str, dict]]) -> list[Document]:
+    """
+    Keeps the retrieved chunks of the given papers. A chunk of another paper is kept only if a chunk of one
+    of the given papers was linked to it, it then carries the metadata of that paper, so the citation is right.
+    """
+    scope = set(hashes)
+    resolved = []
+    for doc in docs:
+        if doc.metadata.get("hash") in scope:
+            resolved.append(doc)
+        elif doc.id in linked:
+            resolved.append(Document(id=doc.id, page_content=doc.page_content, metadata=linked[doc.id][1]))
+    return resolved
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.embeddings import Embeddings
+
+# Lookups made while this is False are not counted as hits or misses, see CachedEmbeddings.uncounted
+_COUNTED: ContextVar[bool] = ContextVar("embedding_cache_counted", default=True)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes the chunk text so whitespace differences from the PDF parser do not change the cache key.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embedding function backed by a persistent, size-bounded LRU cache on local disk.
+
+    Documents and queries are cached under a hash of the normalized text plus the model name,
+    so only texts never embedded by this model reach the underlying embeddings.
+    """
+
+    def __init__(self, embeddings: Embeddings, path: str = "./embedding_cache.sqlite",
+                 max_entries: int = 200_000, model_name: str | None = None):
+        self.embeddings = embeddings
+        self.path = path
+        self.max_entries = max_entries
+        self.model_name = model_name or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys, vectors, missing = self._split(texts)
+        if missing:
+            self._merge(vectors, missing, self.embeddings.embed_documents(list(missing.values())))
+        return [vectors[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # the SQLite reads and writes run in threads, the event loop is shared by every session
+        keys, vectors, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            new_vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            await asyncio.to_thread(self._merge, vectors, missing, new_vectors)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key, vector = self._query_lookup(text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store({key: vector})
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key, vector = await asyncio.to_thread(self._query_lookup, text)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._store, {key: vector})
+        return vector
+
+    def uncached(self, texts: list[str]) -> list[str]:
+        """
+        Returns the distinct texts which would be sent to the underlying embeddings.
+        """
+        keys = {self.make_key(text): text for text in texts}
+        key_list = list(keys)
+        with self._lock:
+            found = set()
+            for start in range(0, len(key_list), 500):
+                part = key_list[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                found.update(row[0] for row in self._conn.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({placeholders})", part))
+        return [text for key, text in keys.items() if key not in found]
+
+    @contextmanager
+    def uncounted(self):
+        """
+        Lookups inside the block, also in threads started with asyncio.to_thread, leave the hit/miss counters
+        unchanged, e.g. when the vectors were just fetched and the vectorstore embeds the same texts again.
+        """
+        token = _COUNTED.set(False)
+        try:
+            yield
+        finally:
+            _COUNTED.reset(token)
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the hit/miss counters of this process and the number of cached vectors.
+        """
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.,
+                "size": size,
+            }
+
+    def _split(self, texts: list[str]) -> tuple[list[str], dict[str, list[float]], dict[str, str]]:
+        keys = [self.make_key(text) for text in texts]
+        vectors = self._lookup(keys)
+        # Embed every missing text once, even if it appears several times in the batch
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if not _COUNTED.get():
+            return keys, vectors, missing
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return keys, vectors, missing
+
+    def _merge(self, vectors: dict[str, list[float]], missing: dict[str, str], new_vectors: list[list[float]]):
+        computed = dict(zip(missing.keys(), new_vectors))
+        self._store(computed)
+        vectors.update(computed)
+
+    def _query_lookup(self, text: str) -> tuple[str, list[float] | None]:
+        key = self.make_key(text)
+        vector = self._lookup([key]).get(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return key, vector
+
+    def _lookup(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        now = time.time()
+        with self._lock, self._conn:
+            # sqlite limits the number of bound parameters, so query in slices
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                )
+        return found
+
+    def _store(self, vectors: dict[str, list[float]]):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in vectors.items()],
+            )
+            # Evict the least recently used vectors above the size limit
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if size > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (size - self.max_entries,),
+                )
@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+
+class IngestRecord(BaseModel):
+    """
+    Class to represent the ingest state of a single PDF file.
+    """
+    file_hash: str
+    meta_hash: str
+    metadata: dict[str, str]
+    status: str = "pending"
+    updated: datetime = Field(default_factory=datetime.now)
+
+
+class IngestCache:
+    """
+    Persistent cache of already ingested PDF files, keyed on the SHA-256 of the raw file bytes.
+
+    A record is written as soon as the bibliographic metadata is extracted (status "pending")
+    and is promoted to "stored" once the chunks are in the vectorstore.
+    """
+    PENDING = "pending"
+    STORED = "stored"
+
+    def __init__(self, path: str = "./ingest_cache.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS ingest (
+                    file_hash TEXT PRIMARY KEY,
+                    meta_hash TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated TEXT NOT NULL
+                )"""
+            )
+
+    def get(self, file_hash: str) -> IngestRecord | None:
+        """
+        Returns the cached record for the file hash or None if the file was never seen.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_hash, meta_hash, metadata, status, updated FROM ingest WHERE file_hash = ?",
+                (file_hash,),
+            ).fetchone()
+        if row is None:
+            return None
+        return IngestRecord(
+            file_hash=row[0],
+            meta_hash=row[1],
+            metadata=json.loads(row[2]),
+            status=row[3],
+            updated=datetime.fromisoformat(row[4]),
+        )
+
+    def put(self, record: IngestRecord) -> IngestRecord:
+        """
+        Inserts or replaces the record of the file.
+        """
+        record.updated = datetime.now()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingest (file_hash, meta_hash, metadata, status, updated) VALUES (?, ?, ?, ?, ?)",
+                (record.file_hash, record.meta_hash, json.dumps(record.metadata), record.status,
+                 record.updated.isoformat()),
+            )
+        return record
+
+    def mark_stored(self, record: IngestRecord) -> IngestRecord:
+        record.status = self.STORED
+        return self.put(record)
+
+    def forget(self, file_hash: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM ingest WHERE file_hash = ?", (file_hash,))
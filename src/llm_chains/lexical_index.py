@@ -0,0 +1,167 @@
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+from langchain_core.documents import Document
+
+
+# Keeps gene names, compound IDs and acronyms such as "IL-6", "BRCA1" or "Ti3C2" as single terms
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be been by can did do does for from had has have how in into is it its of on or "
+    "that the their them then there these they this to was were what when where which who why will with".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits the text into lowercased terms. Compound terms are kept whole and also indexed by their parts,
+    so "IL-6" matches both "il-6" and "il".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        terms.append(token)
+        parts = re.split(r"[-_.]", token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOPWORDS)
+    return terms
+
+
+class LexicalIndex:
+    """
+    Persistent BM25 inverted index of the vectorstore chunks, stored in SQLite.
+
+    Chunks are indexed under the same IDs as in the vectorstore, together with the paper hash,
+    so the lexical hits can be fetched back from the vectorstore and fused with the vector results.
+    """
+
+    def __init__(self, path: str = "./lexical_index.sqlite", k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    length INTEGER NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS postings (
+                    term TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    tf INTEGER NOT NULL,
+                    PRIMARY KEY (term, id)
+                ) WITHOUT ROWID"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+            # Corpus statistics of BM25, updated in the transaction of every write, so every connection
+            # to the file sees the same values. Indexes written before the table existed are counted once
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (id INTEGER PRIMARY KEY, chunks INTEGER NOT NULL, "
+                "total_length INTEGER NOT NULL)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO stats (id, chunks, total_length) "
+                "SELECT 0, COUNT(*), COALESCE(SUM(length), 0) FROM chunks"
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._stats()[0]
+
+    def _stats(self) -> tuple[int, int]:
+        # called with the lock held
+        return self._conn.execute("SELECT chunks, total_length FROM stats WHERE id = 0").fetchone()
+
+    def add(self, ids: list[str], docs: list[Document]):
+        """
+        Indexes the chunks under the given IDs. Chunks already indexed are replaced.
+        """
+        chunk_rows, posting_rows = [], []
+        for chunk_id, doc in zip(ids, docs):
+            terms = Counter(tokenize(doc.page_content))
+            chunk_rows.append((chunk_id, doc.metadata.get("hash", ""), sum(terms.values())))
+            posting_rows.extend((term, chunk_id, tf) for term, tf in terms.items())
+
+        with self._lock, self._conn:
+            self._delete(ids)
+            self._conn.executemany("INSERT INTO chunks (id, hash, length) VALUES (?, ?, ?)", chunk_rows)
+            self._conn.executemany("INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)", posting_rows)
+            self._conn.execute("UPDATE stats SET chunks = chunks + ?, total_length = total_length + ? WHERE id = 0",
+                               (len(chunk_rows), sum(row[2] for row in chunk_rows)))
+
+    def remove_hash(self, meta_hash: str):
+        """
+        Drops every chunk of the paper from the index.
+        """
+        with self._lock, self._conn:
+            ids = [row[0] for row in self._conn.execute("SELECT id FROM chunks WHERE hash = ?", (meta_hash,))]
+            self._delete(ids)
+
+    def ids(self) -> set[str]:
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT id FROM chunks")}
+
+    def search(self, query: str, k: int = 4, hashes: list[str] | None = None) -> list[tuple[str, float]]:
+        """
+        Returns the IDs and BM25 scores of the k best chunks for the query, optionally only from the given papers.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        scores: dict[str, float] = {}
+        with self._lock:
+            count, total_length = self._stats()
+            if not count:
+                return []
+            avg_length = total_length / count
+            for term in terms:
+                sql = "SELECT p.id, p.tf, c.length FROM postings p JOIN chunks c ON c.id = p.id WHERE p.term = ?"
+                params = [term]
+                if hashes is not None:
+                    sql += f" AND c.hash IN ({','.join('?' * len(hashes))})"
+                    params.extend(hashes)
+                rows = self._conn.execute(sql, params).fetchall()
+                if not rows:
+                    continue
+                # document frequency over the whole corpus, so a filter does not change the term weights
+                df = len(rows) if hashes is None else self._conn.execute(
+                    "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0]
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                for chunk_id, tf, length in rows:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def _delete(self, ids: list[str]):
+        # sqlite limits the number of bound parameters, so delete in slices
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            removed = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE id IN ({placeholders})", part
+            ).fetchone()
+            self._conn.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", part)
+            self._conn.execute(f"DELETE FROM postings WHERE id IN ({placeholders})", part)
+            self._conn.execute("UPDATE stats SET chunks = chunks - ?, total_length = total_length - ? WHERE id = 0",
+                               removed)
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """
+    Fuses several rankings of IDs, every list adds 1 / (k + rank) to the score of its items.
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,199 @@
+import hashlib
+import os
+import tempfile
+import weakref
+from typing import BinaryIO, Iterator, Union
+
+from langchain_core.documents import Document
+
+
+class PdfBuffer:
+    """
+    PDF received as bytes or as a file object (e.g. a Streamlit upload), parsed straight from memory.
+
+    The content is read once and hashed on the way. Bytes and in-memory buffers up to max_memory bytes are kept
+    without copying, larger buffers and streams are copied in blocks and spilled to a temporary file once they
+    exceed max_memory, so only very large files touch the disk. Picklable, the ingest worker processes receive
+    the bytes of small files and the path of spilled ones.
+    """
+
+    def __init__(self, content: Union[bytes, bytearray, BinaryIO], name: str = "document.pdf",
+                 max_memory: int = 64 << 20, block_size: int = 1 << 20):
+        self.name = name
+        self.data: bytes | None = None
+        self.path: str | None = None
+        if isinstance(content, (bytes, bytearray)):
+            self.data = bytes(content)
+        elif hasattr(content, "getvalue") and _stream_size(content) <= max_memory:
+            # BytesIO (and the Streamlit uploads) share their internal bytes with getvalue, nothing is copied
+            self.data = content.getvalue()
+        else:
+            if hasattr(content, "getvalue"):
+                content.seek(0)
+            self._spool(content, max_memory, block_size)
+            return
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def _spool(self, stream: BinaryIO, max_memory: int, block_size: int):
+        hash_object = hashlib.sha256()
+        blocks, size, spill = [], 0, None
+        for block in iter(lambda: stream.read(block_size), b""):
+            hash_object.update(block)
+            size += len(block)
+            if spill is None and size > max_memory:
+                spill = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+                # the spilled file is removed with the buffer
+                weakref.finalize(self, os.remove, spill.name)
+                spill.writelines(blocks)
+                blocks = []
+            if spill is None:
+                blocks.append(block)
+            else:
+                spill.write(block)
+        if spill is None:
+            self.data = b"".join(blocks)
+        else:
+            spill.close()
+            self.path = spill.name
+        self.sha256 = hash_object.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def __reduce__(self):
+        # the copies sent to the worker processes do not own the spilled file
+        return _restore_buffer, (self.name, self.data, self.path, self.sha256)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+def _stream_size(stream: BinaryIO) -> int:
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+def _restore_buffer(name: str, data: bytes | None, path: str | None, sha256: str) -> PdfBuffer:
+    buffer = PdfBuffer.__new__(PdfBuffer)
+    buffer.name, buffer.data, buffer.path, buffer.sha256 = name, data, path, sha256
+    return buffer
+
+
+# A path to a PDF file or a PDF held in memory
+PdfSource = Union[str, PdfBuffer]
+# Everything RAG accepts as a PDF
+PdfInput = Union[str, os.PathLike, bytes, bytearray, BinaryIO, PdfBuffer]
+
+
+def as_pdf_source(pdf: PdfInput, **kwargs) -> PdfSource:
+    """
+    Returns paths and PdfBuffers as they are and wraps bytes and file objects into a PdfBuffer.
+    """
+    if isinstance(pdf, (str, PdfBuffer)):
+        return pdf
+    if isinstance(pdf, os.PathLike):
+        return os.fspath(pdf)
+    kwargs.setdefault("name", os.path.basename(getattr(pdf, "name", "") or "") or "document.pdf")
+    return PdfBuffer(pdf, **kwargs)
+
+
+class PdfBackend:
+    """
+    Base class of the PDF text-extraction backends used by RAG.
+
+    A backend turns a PDF file or a PdfBuffer into one Document per page with the metadata shape of PyPDFLoader
+    (document info keys, "source", "total_pages", "page" and "page_label"). Backends are stateless,
+    so they can be sent to the ingest process pool.
+    """
+    name: str = ""
+
+    def lazy_load(self, source: PdfSource) -> Iterator[Document]:
+        raise NotImplementedError
+
+    def load(self, source: PdfSource) -> list[Document]:
+        return list(self.lazy_load(source))
+
+
+class PyPDFBackend(PdfBackend):
+    """
+    Pure Python backend based on langchain PyPDFLoader.
+    """
+    name = "pypdf"
+
+    def lazy_load(self, source: PdfSource) -> Iterator[Document]:
+        from langchain_community.document_loaders import PyPDFLoader
+
+        if isinstance(source, PdfBuffer):
+            from langchain_community.document_loaders.blob_loaders import Blob
+            from langchain_community.document_loaders.parsers import PyPDFParser
+
+            # the same parser as PyPDFLoader, fed from memory or from the spilled file
+            if source.data is not None:
+                blob = Blob.from_data(source.data, path=source.name)
+            else:
+                blob = Blob.from_path(source.path, metadata={"source": source.name})
+            return PyPDFParser().lazy_parse(blob)
+        return PyPDFLoader(source).lazy_load()
+
+
+class PyMuPDFBackend(PdfBackend):
+    """
+    Fast backend based on PyMuPDF (fitz), emitting the same Document and metadata shape as PyPDFBackend.
+    """
+    name = "pymupdf"
+    # PyMuPDF metadata keys renamed to the PyPDFLoader ones, keys mapped to None are dropped
+    METADATA_KEYS = {
+        "creationDate": "creationdate",
+        "modDate": "moddate",
+        "format": None,
+        "encryption": None,
+    }
+
+    def lazy_load(self, source: PdfSource) -> Iterator[Document]:
+        with open_fitz(source) as pdf:
+            metadata = {"producer": "PyMuPDF", "creator": "PyMuPDF", "creationdate": ""}
+            for key, value in (pdf.metadata or {}).items():
+                key = self.METADATA_KEYS.get(key, key)
+                if key is None or not value:
+                    continue
+                metadata[key] = value
+            metadata["source"] = str(source)
+            metadata["total_pages"] = pdf.page_count
+
+            for num, page in enumerate(pdf):
+                yield Document(
+                    page_content=page.get_text(),
+                    metadata={**metadata, "page": num, "page_label": page.get_label() or str(num + 1)},
+                )
+
+
+def open_fitz(source: PdfSource):
+    """
+    Opens the PDF with PyMuPDF, from memory when it is held in a PdfBuffer.
+    """
+    import fitz  # PyMuPDF
+
+    if isinstance(source, PdfBuffer):
+        if source.data is not None:
+            return fitz.open(stream=source.data, filetype="pdf")
+        return fitz.open(source.path)
+    return fitz.open(source)
+
+
+LOADER_BACKENDS: dict[str, type[PdfBackend]] = {
+    PyPDFBackend.name: PyPDFBackend,
+    PyMuPDFBackend.name: PyMuPDFBackend,
+}
+
+
+def get_loader_backend(name: str | None = None) -> PdfBackend:
+    """
+    Returns the PDF backend by name. Without a name the SCIART_PDF_BACKEND environment variable is used,
+    so the backend can be chosen per deployment.
+    """
+    name = name or os.environ.get("SCIART_PDF_BACKEND", PyPDFBackend.name)
+    if name not in LOADER_BACKENDS:
+        raise ValueError(f"Unknown PDF backend '{name}', available: {', '.join(LOADER_BACKENDS)}")
+    return LOADER_BACKENDS[name]()
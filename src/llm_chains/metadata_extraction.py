@@ -0,0 +1,185 @@
+import re
+import threading
+
+from pydantic import BaseModel, Field, PrivateAttr, create_model
+
+from langchain_core.documents import Document
+
+from .objects import Bibcitation
+
+
+DOI_PATTERN = re.compile(r'\b(?:doi:\s*|https?://(?:dx\.)?doi\.org/)?(10\.\d{4,9}/[^\s"<>,;]+)', re.IGNORECASE)
+YEAR_PATTERN = re.compile(r'\b(19[5-9]\d|20\d{2})\b')
+# "Journal of Something 12 (2019) 123-145" as printed by Elsevier and others
+JOURNAL_VOLUME_YEAR_PAGES = re.compile(
+    r'(?P<journal>[A-Z][A-Za-z.&\- ]{2,80}?),?\s+(?P<volume>\d{1,4})\s*\((?P<year>(?:19|20)\d{2})\)\s*'
+    r'(?P<pages>[A-Za-z]?\d+\s*[-–]\s*[A-Za-z]?\d+)'
+)
+# "J. Chem. Phys. 152, 044101 (2020)" as printed by physics and chemistry journals
+JOURNAL_VOLUME_PAGES_YEAR = re.compile(
+    r'(?P<journal>[A-Z][A-Za-z.&\- ]{2,80}?)\s+(?P<volume>\d{1,4}),\s*(?P<pages>[A-Za-z]?\d+(?:\s*[-–]\s*[A-Za-z]?\d+)?)'
+    r'\s*\((?P<year>(?:19|20)\d{2})\)'
+)
+VOLUME_PATTERN = re.compile(r'\bVol(?:ume)?\.?\s*(\d{1,4})\b', re.IGNORECASE)
+NUMBER_PATTERN = re.compile(r'\b(?:No\.|Issue|Number)\s*(\d{1,4})\b', re.IGNORECASE)
+PAGES_PATTERN = re.compile(r'\bpp?\.\s*([A-Za-z]?\d+\s*[-–]\s*[A-Za-z]?\d+)', re.IGNORECASE)
+BAD_TITLES = re.compile(r'(untitled|microsoft word|\.docx?$|\.pdf$|\.tex$|^[\w\-]+$)', re.IGNORECASE)
+
+
+class FieldGuess(BaseModel):
+    """
+    Class to represent a locally extracted bibliographic field.
+    """
+    value: str
+    confidence: float
+    source: str
+
+
+class MetadataStats(BaseModel):
+    """
+    Counters of how often the metadata LLM call was avoided.
+    """
+    papers: int = 0
+    llm_calls: int = 0
+    fields_local: int = 0
+    fields_llm: int = 0
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def record(self, fields_local: int, fields_llm: int):
+        with self._lock:
+            self.papers += 1
+            self.llm_calls += int(fields_llm > 0)
+            self.fields_local += fields_local
+            self.fields_llm += fields_llm
+
+    @property
+    def llm_avoided(self) -> int:
+        return self.papers - self.llm_calls
+
+    @property
+    def avoided_rate(self) -> float:
+        return self.llm_avoided / self.papers if self.papers else 0.
+
+
+def given_name_first(name: str) -> str:
+    """
+    Turns "Family, Given" around, Bibcitation and the citation styles expect the family name last.
+    """
+    family, _, given = name.partition(",")
+    return f"{given.strip()} {family.strip()}" if given.strip() else family
+
+
+def split_authors(authors: str) -> list[str]:
+    """
+    Splits an author string into names, separated by ";", "and", "&" or commas.
+    "Family, Given" names keep their comma, "Smith, John and Doe, Jane" gives "Smith, John" and "Doe, Jane".
+    """
+    names = []
+    for part in re.split(r";|\s+(?:and|&)\s+", authors):
+        pieces = [piece.strip() for piece in part.split(",") if piece.strip()]
+        if len(pieces) <= 1 or all(len(piece.split()) >= 2 for piece in pieces):
+            # a single name or "John Smith, Jane Doe"
+            names.extend(pieces)
+        elif len(pieces) % 2 == 0:
+            # "Smith, John" or "Smith, John, Doe, Jane", a family name followed by its given names
+            names.extend(f"{family}, {given}" for family, given in zip(pieces[::2], pieces[1::2]))
+        else:
+            names.append(part.strip())
+    return names
+
+
+def normalize_authors(authors: str) -> tuple[str, float]:
+    """
+    Converts the author string of the PDF metadata into the ';' separated format of Bibcitation.
+
+    Returns:
+        tuple[str, float]: Normalized authors and the confidence that they are real names.
+    """
+    names = [" ".join(given_name_first(name).split()) for name in split_authors(authors)]
+    plausible = names and all(2 <= len(name.split()) <= 5 and not re.search(r"\d|@|,", name) for name in names)
+    return "; ".join(names), 0.8 if plausible else 0.3
+
+
+class LocalMetadataExtractor:
+    """
+    Extracts as many Bibcitation fields as possible without the LLM: embedded PDF metadata,
+    the DOI printed on the first page and the journal/volume/pages strings of the headers and footers.
+    Every field comes with a confidence, fields below min_confidence are left to the LLM.
+    """
+
+    def __init__(self, min_confidence: float = 0.7, header_lines: int = 8):
+        self.min_confidence = min_confidence
+        self.header_lines = header_lines
+
+    def extract(self, first_page: Document) -> dict[str, FieldGuess]:
+        guesses: dict[str, FieldGuess] = {}
+
+        def guess(field: str, value: str | None, confidence: float, source: str):
+            value = (value or "").strip()
+            if value and (field not in guesses or guesses[field].confidence < confidence):
+                guesses[field] = FieldGuess(value=value, confidence=confidence, source=source)
+
+        meta = first_page.metadata
+        title = meta.get("title", "")
+        if title and not BAD_TITLES.search(title.strip()):
+            guess("title", title, 0.8 if len(title.split()) >= 4 else 0.5, "pdf_metadata")
+        if meta.get("author"):
+            authors, confidence = normalize_authors(meta["author"])
+            # The field often holds the typesetter or the uploader, it is trusted only if every family name
+            # is also printed on the first page
+            page_words = set(re.findall(r"\w+", first_page.page_content.lower()))
+            families = [name.split()[-1].lower() for name in authors.split("; ") if name.split()]
+            if not all(family in page_words for family in families):
+                confidence = min(confidence, 0.5)
+            guess("author", authors, confidence, "pdf_metadata")
+
+        lines = [line.strip() for line in first_page.page_content.split("\n") if line.strip()]
+        header = lines[:self.header_lines] + lines[-self.header_lines:]
+        # Publishers often put the full reference in the subject, e.g. "Journal 12 (2019) 1-10. doi:10..."
+        candidates = [meta.get("subject", "")] + header
+
+        # A DOI in the body text may belong to a cited paper, only the metadata and the headers are trusted
+        for source, text, confidence in [("pdf_metadata", meta.get("doi", ""), 0.95),
+                                         ("pdf_subject", meta.get("subject", ""), 0.95),
+                                         ("header", "\n".join(header), 0.9),
+                                         ("body", first_page.page_content, 0.5)]:
+            doi = DOI_PATTERN.search(text)
+            if doi:
+                value = doi.group(1).rstrip(".")
+                # "(doi:10...)" in running text, DOIs themselves may hold balanced parentheses
+                if value.endswith(")") and value.count(")") > value.count("("):
+                    value = value[:-1]
+                guess("doi", value, confidence, source)
+
+        for source, text in zip(["pdf_subject"] + ["header"] * len(header), candidates):
+            if not text:
+                continue
+            for pattern in [JOURNAL_VOLUME_YEAR_PAGES, JOURNAL_VOLUME_PAGES_YEAR]:
+                match = pattern.search(text)
+                if match:
+                    guess("journal", match.group("journal").strip(" ,."), 0.75, source)
+                    guess("volume", match.group("volume"), 0.85, source)
+                    guess("year", match.group("year"), 0.85, source)
+                    guess("pages", match.group("pages").replace(" ", ""), 0.8, source)
+            for field, pattern in [("volume", VOLUME_PATTERN), ("number", NUMBER_PATTERN), ("pages", PAGES_PATTERN)]:
+                match = pattern.search(text)
+                if match:
+                    guess(field, match.group(1).replace(" ", ""), 0.75, source)
+
+        years = YEAR_PATTERN.findall(" ".join(header))
+        if years:
+            guess("year", max(years), 0.5, "header")
+        return guesses
+
+    def confident(self, guesses: dict[str, FieldGuess]) -> dict[str, str]:
+        return {field: g.value for field, g in guesses.items() if g.confidence >= self.min_confidence}
+
+
+def partial_bibcitation(fields: list[str]) -> type[BaseModel]:
+    """
+    Builds a structured output model with only the requested Bibcitation fields and their descriptions.
+    """
+    return create_model(
+        Bibcitation.__name__,
+        **{field: (str, Field(..., description=Bibcitation.model_fields[field].description)) for field in fields},
+    )
@@ -68,4 +68,6 @@ class QuotedAnswer(BaseModel):
 class State(TypedDict):
     question: str
     context: List[Document]
-    answer: QuotedAnswer
\ No newline at end of file
+    answer: QuotedAnswer
+    context_stats: dict[str, int]
+    partial_answers: List[QuotedAnswer]
\ No newline at end of file
@@ -0,0 +1,212 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+
+def scope_filter(hashes: list[str] | None) -> dict | None:
+    """
+    Returns the metadata filter restricting a search to the papers with the given hashes.
+    """
+    if not hashes:
+        return None
+    return {"hash": {"$in": list(hashes)}}
+
+
+def hashes_in_filter(where: dict | None) -> list[str] | None:
+    """
+    Returns the paper hashes a filter is restricted to, or None if it may match any paper.
+    """
+    value = (where or {}).get("hash")
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict) and "$in" in value:
+        return list(value["$in"])
+    return None
+
+
+def shard_by_hash(names: list[str]) -> Callable[[str], str]:
+    """
+    Returns a router spreading the papers evenly over the partitions by their hash.
+    """
+    def router(meta_hash: str) -> str:
+        return names[int(hashlib.sha256(meta_hash.encode()).hexdigest()[:8], 16) % len(names)]
+    return router
+
+
+def count_chunks(store: VectorStore) -> int | None:
+    """
+    Returns the number of chunks in the vectorstore without reading them, None if the store cannot count.
+    """
+    # Chroma counts through its collection, QuantizedVectorStore and PartitionedVectorStore directly
+    if hasattr(store, "_collection"):
+        return store._collection.count()
+    return store.count() if hasattr(store, "count") else None
+
+
+class PartitionedVectorStore(VectorStore):
+    """
+    Vectorstore made of several collections (one per shard or per project), every paper lives in exactly one of them.
+
+    Writes are routed by the paper hash, searches fan out to the partitions in parallel and the results are merged
+    by distance. A search scoped to some papers only visits the partitions holding them, so its latency depends
+    on the size of the scope rather than on the size of the whole database.
+    All partitions must use the same embedding function and distance.
+    """
+
+    def __init__(self, partitions: dict[str, VectorStore], router: Callable[[str], str] | None = None,
+                 max_workers: int | None = None):
+        self.partitions = partitions
+        self.router = router or shard_by_hash(list(partitions))
+        self._pool = ThreadPoolExecutor(max_workers or len(partitions))
+
+    @classmethod
+    def from_chroma(cls, embeddings: Embeddings, persist_directory: str | None, prefix: str = "langchain",
+                    shards: int = 4) -> "PartitionedVectorStore":
+        """
+        Creates the shards as collections named prefix_0 ... prefix_{shards - 1} of one persistent Chroma database,
+        or of an in-memory one without persist_directory.
+        """
+        from langchain_chroma import Chroma
+
+        partitions = {
+            f"{prefix}_{num}": Chroma(collection_name=f"{prefix}_{num}", embedding_function=embeddings,
+                                      persist_directory=persist_directory)
+            for num in range(shards)
+        }
+        return cls(partitions)
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: list[dict] | None = None,
+                   ids: list[str] | None = None, persist_directory: str | None = None, prefix: str = "langchain",
+                   shards: int = 4, **kwargs: Any) -> "PartitionedVectorStore":
+        """
+        Creates Chroma shards (see from_chroma) and adds the texts, every metadata needs the "hash" of its paper.
+        """
+        store = cls.from_chroma(embedding, persist_directory, prefix, shards)
+        store.add_texts(texts, metadatas, ids=ids, **kwargs)
+        return store
+
+    @property
+    def embeddings(self) -> Embeddings | None:
+        return next(iter(self.partitions.values())).embeddings
+
+    def _targets(self, where: dict | None) -> list[VectorStore]:
+        hashes = hashes_in_filter(where)
+        if hashes is None:
+            return list(self.partitions.values())
+        return [self.partitions[name] for name in dict.fromkeys(self.router(h) for h in hashes)]
+
+    def _fan_out(self, stores: list[VectorStore], func: Callable[[VectorStore], Any]) -> list:
+        if len(stores) == 1:
+            return [func(stores[0])]
+        return list(self._pool.map(func, stores))
+
+    def add_documents(self, documents: list[Document], ids: list[str] | None = None, **kwargs: Any) -> list[str]:
+        groups: dict[str, tuple[list, list]] = {}
+        for num, doc in enumerate(documents):
+            docs, doc_ids = groups.setdefault(self.router(doc.metadata["hash"]), ([], []))
+            docs.append(doc)
+            doc_ids.append(ids[num] if ids else doc.id)
+        added = []
+        for name, (docs, doc_ids) in groups.items():
+            added.extend(self.partitions[name].add_documents(docs, ids=doc_ids if all(doc_ids) else None, **kwargs))
+        return added
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, ids: list[str] | None = None,
+                  **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        docs = [Document(page_content=text, metadata=meta) for text, meta in zip(texts, metadatas)]
+        return self.add_documents(docs, ids=ids, **kwargs)
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> None:
+        self._fan_out(list(self.partitions.values()), lambda store: store.delete(ids, **kwargs))
+
+    def get(self, ids: list[str] | None = None, where: dict | None = None, limit: int | None = None,
+            offset: int | None = None, include: list[str] | None = None, **kwargs: Any) -> dict[str, Any]:
+        """
+        Chroma-like get over the partitions, limit and offset apply to the concatenation of the partitions.
+        """
+        result = {"ids": [], "documents": [], "metadatas": []}
+        skip = offset or 0
+        for store in self._targets(where):
+            if limit is not None and len(result["ids"]) >= limit:
+                break
+            # whole partitions before the offset are skipped without reading their documents,
+            # with a filter only the IDs of the matching rows are read to count them
+            if skip:
+                size = count_chunks(store) if where is None and ids is None else None
+                if size is None:
+                    size = len(store.get(ids=ids, where=where, include=[], **kwargs)["ids"])
+                if skip >= size:
+                    skip -= size
+                    continue
+            remaining = None if limit is None else limit - len(result["ids"])
+            page = store.get(ids=ids, where=where, limit=remaining, offset=skip or None, include=include, **kwargs)
+            skip = 0
+            for key in result:
+                result[key].extend(page.get(key) or [])
+        return result
+
+    def count(self) -> int | None:
+        counts = [count_chunks(store) for store in self.partitions.values()]
+        return None if None in counts else sum(counts)
+
+    def get_by_ids(self, ids: list[str], /) -> list[Document]:
+        if not ids:
+            return []
+        return [doc for docs in self._fan_out(list(self.partitions.values()), lambda store: store.get_by_ids(ids))
+                for doc in docs]
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding: list[float], k: int = 4,
+                                                          filter: dict | None = None,
+                                                          **kwargs: Any) -> list[tuple[Document, float]]:
+        results = self._fan_out(
+            self._targets(filter),
+            lambda store: store.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter, **kwargs),
+        )
+        # Chroma returns distances, the lower the closer
+        return sorted((pair for pairs in results for pair in pairs), key=lambda pair: pair[1])[:k]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict | None = None,
+                                     **kwargs: Any) -> list[tuple[Document, float]]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter=filter, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, filter: dict | None = None,
+                                    **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in
+                self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter, **kwargs)]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        embedding = self.embeddings.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(embedding, k, fetch_k, lambda_mult, filter=filter,
+                                                            **kwargs)
+
+    def max_marginal_relevance_search_by_vector(self, embedding: list[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, filter: dict | None = None,
+                                                **kwargs: Any) -> list[Document]:
+        """
+        Runs MMR in every partition, then once more over the union of their picks.
+        """
+        import numpy as np
+        from langchain_core.vectorstores.utils import maximal_marginal_relevance
+
+        stores = self._targets(filter)
+        results = self._fan_out(stores, lambda store: store.max_marginal_relevance_search_by_vector(
+            embedding, k, fetch_k, lambda_mult, filter=filter, **kwargs))
+        candidates = [doc for docs in results for doc in docs]
+        if len(stores) == 1 or len(candidates) <= 1:
+            return candidates[:k]
+        # The candidate vectors are not returned by the partitions, they come from the embedding cache
+        vectors = self.embeddings.embed_documents([doc.page_content for doc in candidates])
+        picked = maximal_marginal_relevance(np.array(embedding), vectors, lambda_mult=lambda_mult, k=k)
+        return [candidates[num] for num in picked]
@@ -1,33 +1,52 @@
-import fitz  # PyMuPDF
-import io
 import re
-import base64
 import hashlib
-from PIL import Image
+from itertools import chain, islice
+from typing import Iterable, Iterator
 from pydantic import BaseModel, Field
 
 from langchain_core.documents import Document
 
+from .loaders import PdfBackend, PdfBuffer, PdfSource, open_fitz
+from .tracing import tracer
 
-def pdf_page_to_base64(pdf_path: str) -> str:
+
+def pdf_page_to_png(pdf_path: PdfSource) -> bytes:
     """
-    Converts the first page of a PDF file to a base64-encoded PNG image.
+    Renders the first page of a PDF file as a PNG image.
 
     Args:
-        pdf_path (str): Path to the PDF file.
+        pdf_path (PdfSource): Path to the PDF file, or a PdfBuffer rendered from memory.
 
     Returns:
-        str: Base64-encoded string of the first page as a PNG image.
+        bytes: The first page as a PNG image.
     """
-    pdf_document = fitz.open(pdf_path)
-    page = pdf_document.load_page(0)  # Load the first page
-    pix = page.get_pixmap()
+    # PyMuPDF and Pillow are only needed here, they are imported on first use to keep the app start fast
+    import io
+    from PIL import Image
+
+    with open_fitz(pdf_path) as pdf_document:
+        page = pdf_document.load_page(0)  # Load the first page
+        pix = page.get_pixmap()
     img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
     buffer = io.BytesIO()
     img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
 
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+def pdf_page_to_base64(pdf_path: PdfSource) -> str:
+    """
+    Converts the first page of a PDF file to a base64-encoded PNG image.
+
+    Args:
+        pdf_path (PdfSource): Path to the PDF file, or a PdfBuffer rendered from memory.
+
+    Returns:
+        str: Base64-encoded string of the first page as a PNG image.
+    """
+    import base64
+
+    return base64.b64encode(pdf_page_to_png(pdf_path)).decode("utf-8")
 
 
 def make_hash_from_metadata(metadata: dict[str, str]):
@@ -39,47 +58,111 @@ def make_hash_from_metadata(metadata: dict[str, str]):
     hash_value = hash_object.hexdigest()
     return hash_value[:8]
 
-def extract_titles_and_sections(pages: list[Document], metadata_extra: dict[str, str], meta_hash: str) -> list[dict[str, str]]:
+
+def make_hash_from_file(pdf_path: PdfSource, block_size: int = 1 << 20) -> str:
     """
-    Extracts titles and sections from the PDF pages.
+    Computes the SHA-256 of the raw PDF bytes.
+
     Args:
-        pages (list[Document]): List of Document objects representing the PDF pages.
-        metadata_extra (dict[str, str]): Additional metadata to include in the output.
+        pdf_path (PdfSource): Path to the PDF file, or a PdfBuffer which was hashed while it was read.
+        block_size (int): Number of bytes read at once.
+
     Returns:
-        list[dict[str, str]]: List of dictionaries containing titles, metadata, and content.
+        str: Hex digest of the file content.
+    """
+    if isinstance(pdf_path, PdfBuffer):
+        return pdf_path.sha256
+    hash_object = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+
+# Precompiled once, classifying every line of a 1000 pages thesis is the hot loop of the ingest
+TITLE_PATTERN = re.compile(r'^(?:\d+\.?\s*|\bI\b\s*)?[A-Z][A-Za-z\-:]*\s*(?:[Aa][Nn][Dd]\s+[A-Z][A-Za-z\-:]*\s*)?$')  # tweak as needed
+CITATION_PATTERN = re.compile(r'\[\d+\]')
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
     """
-    title_pattern = r'^(?:\d+\.?\s*|\bI\b\s*)?[A-Z][A-Za-z\-:]*\s*(?:[Aa][Nn][Dd]\s+[A-Z][A-Za-z\-:]*\s*)?$'  # tweak as needed
-    metadata = {i: j for i, j in pages[0].metadata.items() if i not in ["page_label", "page"]} # remove source and page from metadata
+    Groups the items of the iterable into lists of at most size elements.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def iter_sections(pages: Iterable[Document], metadata_extra: dict[str, str], meta_hash: str) -> Iterator[dict[str, str]]:
+    """
+    Lazily extracts titles and sections from the PDF pages, a section is yielded as soon as the next title closes it.
+    Args:
+        pages (Iterable[Document]): Document objects representing the PDF pages, e.g. a loader lazy_load().
+        metadata_extra (dict[str, str]): Additional metadata to include in the output.
+        meta_hash (str): Hash of the paper metadata.
+    Yields:
+        dict[str, str]: Dictionary containing title, metadata, and content of a section.
+    """
+    pages = iter(pages)
+    first_page = next(pages, None)
+    if first_page is None:
+        return
+    metadata = {i: j for i, j in first_page.metadata.items() if i not in ["page_label", "page"]} # remove source and page from metadata
     metadata["hash"] = meta_hash
     metadata.update(metadata_extra)
-    sections = []
     current_title = None
     current_content = []
 
-    for page in pages:
-        lines = page.page_content.split('\n')
-        for line in lines:
-            if re.match(title_pattern, line.strip()):
+    for page in chain([first_page], pages):
+        for line in page.page_content.split('\n'):
+            line = line.strip()
+            if TITLE_PATTERN.match(line):
                 if current_title:
-                    sections.append({
+                    yield {
                         'title': current_title,
                         'metadata': metadata,
                         'content': "\n".join(current_content)
-                    })
-                current_title = line.strip()
+                    }
+                current_title = line
                 current_content = []
-            else:
-                current_content.append(line.strip())
+            elif current_title:
+                # lines before the first title are never part of a section
+                current_content.append(line)
 
     # Add the last section
     if current_title:
-        sections.append({
+        yield {
             'title': current_title,
             'metadata': metadata,
             'content': "\n".join(current_content)
-        })
+        }
+
+
+def extract_titles_and_sections(pages: list[Document], metadata_extra: dict[str, str], meta_hash: str) -> list[dict[str, str]]:
+    """
+    Extracts titles and sections from the PDF pages.
+    Args:
+        pages (list[Document]): List of Document objects representing the PDF pages.
+        metadata_extra (dict[str, str]): Additional metadata to include in the output.
+    Returns:
+        list[dict[str, str]]: List of dictionaries containing titles, metadata, and content.
+    """
+    return list(iter_sections(pages, metadata_extra, meta_hash))
 
-    return sections
+
+def iter_preprocessed(docs: Iterable[Document], paper_meta: dict[str, str], meta_hash: str) -> Iterator[dict[str, str]]:
+    """
+    Lazy version of preprocess_pdf, the sections are filtered and cleaned one by one.
+    """
+    for s in iter_sections(docs, paper_meta, meta_hash):
+        title = s["title"].lower()
+        if all(k not in title for k in ["references", "introduction"]):
+            yield s
+        elif title == "introduction":
+            intro = s["content"].split('.\n')
+            store = [i for i in intro if not CITATION_PATTERN.search(i)]
+            s["content"] = "\n".join(store)
+            yield s
 
 
 def preprocess_pdf(docs: list[Document], paper_meta: dict[str, str], meta_hash: str) -> list[dict[str, str]]:
@@ -92,17 +175,72 @@ def preprocess_pdf(docs: list[Document], paper_meta: dict[str, str], meta_hash:
     Returns:
         list[dict[str, str]]: List of dictionaries containing titles, metadata, and cleaned content.
     """
-    sections = extract_titles_and_sections(docs, paper_meta, meta_hash)
+    return list(iter_preprocessed(docs, paper_meta, meta_hash))
 
-    # Filter based on keywords
-    filtered = []
-    for s in sections:
-        if all(k not in s["title"].lower() for k in ["references", "introduction"]):
-            filtered.append(s)
-        elif s["title"].lower() == "introduction":
-            intro = s["content"].split('.\n')
-            store = [i for i in intro if not re.search(r'\[\d+\]', i)]
-            s["content"] = "\n".join(store)
-            filtered.append(s)
 
-    return filtered
+def iter_chunks(docs: Iterable[Document], paper_meta: dict[str, str], meta_hash: str,
+                chunk_size: int = 1000, chunk_overlap: int = 100) -> Iterator[Document]:
+    """
+    Lazily preprocesses the PDF pages and splits every kept section into chunks as soon as it is closed.
+    Args:
+        docs (Iterable[Document]): Document objects representing the PDF pages.
+        paper_meta (dict[str, str]): Metadata of the paper.
+        meta_hash (str): Hash of the paper metadata.
+    Yields:
+        Document: Chunk of the PDF ready for the vectorstore.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    # Section number and start index let the context packer merge neighbouring chunks back together
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    sections = tracer.iter("preprocess_pdf", iter_preprocessed(docs, paper_meta, meta_hash), count_as="sections")
+    for num, sec in enumerate(sections):
+        with tracer.span("split") as span:
+            chunks = splitter.create_documents([sec["content"]], metadatas=[{**sec["metadata"], "section": num}])
+            span.count("chunks", len(chunks))
+        yield from chunks
+
+
+def chunk_pdf(docs: Iterable[Document], paper_meta: dict[str, str], meta_hash: str,
+              chunk_size: int = 1000, chunk_overlap: int = 100) -> list[Document]:
+    """
+    Preprocesses the PDF pages and splits the kept sections into chunks ready for the vectorstore.
+    Args:
+        docs (Iterable[Document]): Document objects representing the PDF pages.
+        paper_meta (dict[str, str]): Metadata of the paper.
+        meta_hash (str): Hash of the paper metadata.
+    Returns:
+        list[Document]: List of Document objects representing the chunks of the PDF.
+    """
+    return list(iter_chunks(docs, paper_meta, meta_hash, chunk_size, chunk_overlap))
+
+
+def scan_pdf_file(pdf_path: PdfSource, backend: PdfBackend) -> tuple[Document, list[Document]]:
+    """
+    Parses the PDF file once for a new file: returns the first page, to extract the bibliographic metadata,
+    and the chunks, which get the paper metadata with attach_metadata once it is known.
+    Module level function, so it can run in a process pool.
+    """
+    pages = tracer.iter("load_pdf", backend.lazy_load(pdf_path), count_as="pages")
+    first_page = next(pages, None)
+    if first_page is None:
+        raise ValueError(f"{pdf_path} has no pages")
+    return first_page, chunk_pdf(chain([first_page], pages), {}, "")
+
+
+def attach_metadata(chunks: list[Document], paper_meta: dict[str, str], meta_hash: str) -> list[Document]:
+    """
+    Adds the paper metadata and its hash to chunks made by scan_pdf_file, as chunk_pdf_file would have.
+    """
+    for chunk in chunks:
+        chunk.metadata.update(paper_meta)
+        chunk.metadata["hash"] = meta_hash
+    return chunks
+
+
+def chunk_pdf_file(pdf_path: PdfSource, paper_meta: dict[str, str], meta_hash: str, backend: PdfBackend) -> list[Document]:
+    """
+    Loads the PDF file and splits it into chunks. Module level function, so it can run in a process pool.
+    """
+    pages = tracer.iter("load_pdf", backend.lazy_load(pdf_path), count_as="pages")
+    return chunk_pdf(pages, paper_meta, meta_hash)
@@ -23,6 +23,17 @@ Respond in JSON format.
 """
 
 
+system_prompt_meta_fields = """\
+Extract the following information from the scientific paper:
+
+{fields}
+
+Respond in JSON format.
+
+{text}
+"""
+
+
 system_prompt_rag = (
     """You're a helpful AI assistant. You help scientist to write 
     some scientific paper by summarizing the information provided 
@@ -39,4 +50,21 @@ system_prompt_rag = (
 
 
     {context}"""
-)
\ No newline at end of file
+)
+
+
+system_prompt_reduce = (
+    """You're a helpful AI assistant. You help scientist to write 
+    some scientific paper by combining summaries of several papers into one summary.
+    Every summary below was written from a single paper, identified by its Source ID and Hash.
+    The combined summary should:
+    - Use only the information in the summaries to answer the question. If no information is available, say you don't know.
+    - Connect and compare the findings of the papers instead of listing them one after another.
+    - Be formal, objective, and precise in tone.
+    The combined summary must:
+    - Include inline citations using the format: [value] - for one, [value1, value2, ...] - for many.
+    - Cite the Source ID and Hash of the summary every finding comes from.
+
+
+    {summaries}"""
+)
@@ -0,0 +1,428 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Any, Iterable
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from .partitioning import hashes_in_filter
+
+
+QUANTIZATIONS = {"int8": np.int8, "float16": np.float16}
+
+
+class _GrowingMemmap:
+    """
+    Memory-mapped 2D array file which doubles its capacity when it is full. Rows are only paged in
+    when they are read, so a large store costs little resident memory.
+    """
+
+    def __init__(self, path: str, dim: int, dtype: type, initial_rows: int = 1024):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        row_bytes = dim * self.dtype.itemsize
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(initial_rows * row_bytes)
+        self.capacity = os.path.getsize(path) // row_bytes
+        self.array = np.memmap(path, dtype=self.dtype, mode="r+", shape=(self.capacity, dim))
+
+    def reserve(self, rows: int):
+        if rows <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < rows:
+            capacity *= 2
+        self.array.flush()
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self.capacity = capacity
+        self.array = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+
+
+class QuantizedVectorStore(VectorStore):
+    """
+    Compact local vectorstore: embeddings are normalized and quantized to int8 (with one scale per vector)
+    or float16 in a memory-mapped NumPy file, texts and metadata live in a SQLite sidecar.
+
+    Search is an exact vectorized scan of the quantized vectors, or an IVF search over the nprobe lists
+    closest to the query once enough vectors are stored. With rerank the best candidates are re-ranked with
+    the float32 vectors, kept in a second memory-mapped file, so quantization costs almost no recall, but the
+    store then takes more disk space than plain float32 vectors. Scores are cosine distances, the lower
+    the closer, like Chroma. Filters and get(where=...) support equality and "$in" on metadata keys.
+    Searches filtered by paper hash scan all the rows of these papers and only them, also with the IVF index.
+
+    The rows are loaded when the store is opened, chunks added by another process are seen after reopening it.
+    """
+
+    def __init__(self, embedding_function: Embeddings, persist_directory: str, quantization: str = "int8",
+                 rerank: bool | None = None, rerank_factor: int = 4, index: str = "flat", n_lists: int | None = None,
+                 nprobe: int = 16, min_train_size: int = 4096, block_rows: int = 8192):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}', available: {', '.join(QUANTIZATIONS)}")
+        if index not in ["flat", "ivf"]:
+            raise ValueError(f"Unknown index '{index}', available: flat, ivf")
+        self.embedding_function = embedding_function
+        self.persist_directory = persist_directory
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.index = index
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.block_rows = block_rows
+        self._lock = threading.RLock()
+        os.makedirs(persist_directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(persist_directory, "metadata.sqlite"), check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (
+                    row INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    hash TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+        settings = dict(self._conn.execute("SELECT key, value FROM settings"))
+        if settings.get("quantization", quantization) != quantization:
+            raise ValueError(f"{persist_directory} holds {settings['quantization']} vectors, not {quantization}")
+        # The float32 vectors are written from the first chunk on or never, rerank is fixed when the store is created
+        # (stores written before the setting existed have the file or not)
+        stored_rerank = settings.get("rerank")
+        if stored_rerank is None and "dim" in settings:
+            stored_rerank = str(int(os.path.exists(os.path.join(persist_directory, "vectors.float32"))))
+        if rerank is not None and stored_rerank is not None and rerank != (stored_rerank == "1"):
+            raise ValueError(f"{persist_directory} was created with rerank={stored_rerank == '1'}")
+        self.rerank = stored_rerank == "1" if rerank is None else rerank
+
+        # Per row state kept in memory: alive flag (rows of deleted chunks stay in the files), paper code
+        # for the hash filters and IVF list
+        rows = self._conn.execute("SELECT row, hash FROM chunks ORDER BY row").fetchall()
+        self._size = rows[-1][0] + 1 if rows else 0
+        self._hash_codes: dict[str, int] = {}
+        self._alive = np.zeros(self._size, dtype=bool)
+        self._paper = np.full(self._size, -1, dtype=np.int32)
+        for row, meta_hash in rows:
+            self._alive[row] = True
+            self._paper[row] = self._hash_codes.setdefault(meta_hash, len(self._hash_codes))
+
+        self._vectors = self._float32 = self._scales = None
+        self._centroids, self._lists = None, np.zeros(0, dtype=np.int32)
+        self._trained_size = 0
+        if "dim" in settings:
+            self._open_arrays(int(settings["dim"]))
+            ivf_path = os.path.join(persist_directory, "ivf.npz")
+            if os.path.exists(ivf_path):
+                with np.load(ivf_path) as ivf:
+                    self._centroids, self._trained_size = ivf["centroids"], int(ivf["trained_size"])
+                self._lists = self._assign(np.arange(self._size))
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: list[dict] | None = None,
+                   ids: list[str] | None = None, persist_directory: str | None = None,
+                   **kwargs: Any) -> "QuantizedVectorStore":
+        import tempfile
+
+        store = cls(embedding, persist_directory or tempfile.mkdtemp(prefix="sciart-vectors-"), **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def _select_relevance_score_fn(self):
+        return lambda distance: 1. - distance
+
+    def _open_arrays(self, dim: int):
+        self.dim = dim
+        path = os.path.join(self.persist_directory, "vectors.{}")
+        self._vectors = _GrowingMemmap(path.format(self.quantization), dim, QUANTIZATIONS[self.quantization])
+        if self.quantization == "int8":
+            self._scales = _GrowingMemmap(path.format("scales"), 1, np.float32)
+        if self.rerank:
+            self._float32 = _GrowingMemmap(path.format("float32"), dim, np.float32)
+
+    def __len__(self) -> int:
+        return int(self._alive.sum())
+
+    def count(self) -> int:
+        return len(self)
+
+    # Writes
+
+    def add_texts(self, texts: Iterable[str], metadatas: list[dict] | None = None, ids: list[str] | None = None,
+                  **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        docs = [Document(page_content=text, metadata=meta) for text, meta in zip(texts, metadatas)]
+        return self.add_documents(docs, ids=ids, **kwargs)
+
+    def add_documents(self, documents: list[Document], ids: list[str] | None = None, **kwargs: Any) -> list[str]:
+        if not documents:
+            return []
+        ids = [i or doc.id or str(uuid.uuid4()) for i, doc in zip(ids or [None] * len(documents), documents)]
+        vectors = np.asarray(self.embedding_function.embed_documents([doc.page_content for doc in documents]),
+                             dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            if self._vectors is None:
+                with self._conn:
+                    self._conn.executemany("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                                           [("dim", str(vectors.shape[1])), ("quantization", self.quantization),
+                                            ("rerank", str(int(self.rerank)))])
+                self._open_arrays(vectors.shape[1])
+            # Chunks added again under the same ID replace the old ones
+            self._delete(ids)
+            start, end = self._size, self._size + len(documents)
+            for array in [self._vectors, self._scales, self._float32]:
+                if array is not None:
+                    array.reserve(end)
+            if self.quantization == "int8":
+                scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+                self._vectors.array[start:end] = np.round(vectors / scales[:, None]).astype(np.int8)
+                self._scales.array[start:end, 0] = scales
+            else:
+                self._vectors.array[start:end] = vectors.astype(np.float16)
+            if self._float32 is not None:
+                self._float32.array[start:end] = vectors
+            for array in [self._vectors, self._scales, self._float32]:
+                if array is not None:
+                    array.array.flush()
+
+            rows = [(start + num, chunk_id, doc.metadata.get("hash", ""), doc.page_content, json.dumps(doc.metadata))
+                    for num, (chunk_id, doc) in enumerate(zip(ids, documents))]
+            with self._conn:
+                self._conn.executemany("INSERT INTO chunks (row, id, hash, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                                       rows)
+            codes = [self._hash_codes.setdefault(row[2], len(self._hash_codes)) for row in rows]
+            self._alive = np.concatenate([self._alive, np.ones(len(rows), dtype=bool)])
+            self._paper = np.concatenate([self._paper, np.array(codes, dtype=np.int32)])
+            self._size = end
+            if self._centroids is not None:
+                self._lists = np.concatenate([self._lists, self._assign(np.arange(start, end))])
+            if self.index == "ivf" and len(self) >= max(self.min_train_size, 2 * self._trained_size):
+                self.train()
+        return ids
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> None:
+        """
+        Deletes the chunks, their vector rows stay in the files and are skipped by the searches.
+        """
+        if ids:
+            with self._lock:
+                self._delete(ids)
+
+    def _delete(self, ids: list[str]):
+        rows = []
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            rows.extend(row for (row,) in self._conn.execute(
+                f"SELECT row FROM chunks WHERE id IN ({','.join('?' * len(part))})", part))
+        if rows:
+            with self._conn:
+                self._conn.executemany("DELETE FROM chunks WHERE row = ?", [(row,) for row in rows])
+            self._alive[rows] = False
+
+    # IVF
+
+    def train(self, n_lists: int | None = None, iterations: int = 10, sample_size: int = 100_000, seed: int = 0):
+        """
+        Clusters the stored vectors with k-means into n_lists inverted lists (sqrt of the size by default).
+        Vectors added later are assigned to the closest list, the lists are retrained once the size doubled.
+        """
+        with self._lock:
+            rows = np.flatnonzero(self._alive)
+            n_lists = n_lists or self.n_lists or max(int(np.sqrt(len(rows))), 1)
+            if len(rows) < n_lists:
+                return
+            rng = np.random.default_rng(seed)
+            sample = self._dequantize(np.sort(rng.choice(rows, min(sample_size, len(rows)), replace=False)))
+            centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for num in range(n_lists):
+                    members = sample[labels == num]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[num] = centroid / max(np.linalg.norm(centroid), 1e-12)
+            self._centroids, self._trained_size = centroids, len(rows)
+            self._lists = self._assign(np.arange(self._size))
+            np.savez(os.path.join(self.persist_directory, "ivf.npz"), centroids=centroids,
+                     trained_size=self._trained_size)
+
+    def _assign(self, rows: np.ndarray) -> np.ndarray:
+        lists = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), self.block_rows):
+            part = rows[start:start + self.block_rows]
+            lists[start:start + len(part)] = np.argmax(self._dequantize(part) @ self._centroids.T, axis=1)
+        return lists
+
+    # Search
+
+    def _dequantize(self, rows: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(self._vectors.array[rows], dtype=np.float32)
+        if self._scales is not None:
+            vectors *= self._scales.array[rows]
+        return vectors
+
+    def _candidate_rows(self, query: np.ndarray, where: dict | None, needed: int) -> np.ndarray:
+        mask = self._alive.copy()
+        hashes = hashes_in_filter(where)
+        if hashes is not None:
+            mask &= np.isin(self._paper, [self._hash_codes[h] for h in hashes if h in self._hash_codes])
+        other = {key: value for key, value in (where or {}).items() if key != "hash"}
+        if other:
+            mask &= np.isin(np.arange(self._size), self._rows_where(other))
+        # the rows of a few papers are scanned exactly, the lists would only drop some of them
+        if hashes is None and self._centroids is not None and len(self._centroids) > self.nprobe:
+            lists = np.argsort(-(self._centroids @ query))
+            nprobe = self.nprobe
+            probed = np.isin(self._lists, lists[:nprobe])
+            # a selective filter can leave too few rows in the closest lists, more lists are probed then
+            while np.count_nonzero(mask & probed) < needed and nprobe < len(lists):
+                nprobe *= 2
+                probed = np.isin(self._lists, lists[:nprobe])
+            mask &= probed
+        return np.flatnonzero(mask)
+
+    def _search(self, embedding: list[float], k: int, where: dict | None) -> list[tuple[int, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        with self._lock:
+            if self._vectors is None or not k:
+                return []
+            shortlist = k * self.rerank_factor if self._float32 is not None else k
+            rows = self._candidate_rows(query, where, shortlist)
+        best_rows, best_scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # The scan runs block by block, so a large store is never dequantized all at once
+        for start in range(0, len(rows), self.block_rows):
+            part = rows[start:start + self.block_rows]
+            # an unfiltered scan reads contiguous rows, a slice of the memmap avoids the fancy indexing copy
+            rows_slice = slice(part[0], part[-1] + 1) if part[-1] - part[0] + 1 == len(part) else part
+            scores = np.asarray(self._vectors.array[rows_slice], dtype=np.float32) @ query
+            if self._scales is not None:
+                scores *= self._scales.array[rows_slice, 0]
+            best_rows = np.concatenate([best_rows, part])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_rows) > shortlist:
+                top = np.argpartition(-best_scores, shortlist)[:shortlist]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        if self._float32 is not None and len(best_rows):
+            best_scores = np.asarray(self._float32.array[np.sort(best_rows)], dtype=np.float32) @ query
+            best_rows = np.sort(best_rows)
+        order = np.argsort(-best_scores)[:k]
+        return [(int(best_rows[num]), float(1. - best_scores[num])) for num in order]
+
+    def _documents(self, rows: list[int]) -> dict[int, Document]:
+        docs = {}
+        for start in range(0, len(rows), 500):
+            part = rows[start:start + 500]
+            for row, chunk_id, text, metadata in self._conn.execute(
+                    f"SELECT row, id, text, metadata FROM chunks WHERE row IN ({','.join('?' * len(part))})", part):
+                docs[row] = Document(id=chunk_id, page_content=text, metadata=json.loads(metadata))
+        return docs
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding: list[float], k: int = 4,
+                                                          filter: dict | None = None,
+                                                          **kwargs: Any) -> list[tuple[Document, float]]:
+        hits = self._search(embedding, k, filter)
+        with self._lock:
+            docs = self._documents([row for row, _ in hits])
+        return [(docs[row], distance) for row, distance in hits if row in docs]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict | None = None,
+                                     **kwargs: Any) -> list[tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter=filter)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, filter: dict | None = None,
+                                    **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter)]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5,
+                                      filter: dict | None = None, **kwargs: Any) -> list[Document]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(embedding, k, fetch_k, lambda_mult, filter=filter)
+
+    def max_marginal_relevance_search_by_vector(self, embedding: list[float], k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, filter: dict | None = None,
+                                                **kwargs: Any) -> list[Document]:
+        from langchain_core.vectorstores.utils import maximal_marginal_relevance
+
+        hits = self._search(embedding, fetch_k, filter)
+        if not hits:
+            return []
+        rows = [row for row, _ in hits]
+        with self._lock:
+            docs = self._documents(rows)
+            sorted_rows = np.sort(rows)
+            vectors = (self._float32.array[sorted_rows] if self._float32 is not None
+                       else self._dequantize(sorted_rows))
+        vectors = dict(zip(sorted_rows.tolist(), np.asarray(vectors, dtype=np.float32)))
+        picked = maximal_marginal_relevance(np.array(embedding, dtype=np.float32), [vectors[row] for row in rows],
+                                            lambda_mult=lambda_mult, k=k)
+        return [docs[rows[num]] for num in picked if rows[num] in docs]
+
+    # Reads
+
+    def _where_sql(self, where: dict | None) -> tuple[str, list]:
+        clauses, params = [], []
+        for key, value in (where or {}).items():
+            column = "hash" if key == "hash" else f"json_extract(metadata, '$.{key}')"
+            if isinstance(value, dict):
+                if set(value) != {"$in"}:
+                    raise ValueError(f"Unsupported filter {value}, use a value or {{'$in': [...]}}")
+                values = list(value["$in"])
+                clauses.append(f"{column} IN ({','.join('?' * len(values))})" if values else "0")
+                params.extend(values)
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return " AND ".join(clauses), params
+
+    def _rows_where(self, where: dict) -> list[int]:
+        clause, params = self._where_sql(where)
+        return [row for (row,) in self._conn.execute(f"SELECT row FROM chunks WHERE {clause}", params)]
+
+    def get(self, ids: list[str] | None = None, where: dict | None = None, limit: int | None = None,
+            offset: int | None = None, include: list[str] | None = None, **kwargs: Any) -> dict[str, Any]:
+        """
+        Chroma-like get, the chunks are returned in insertion order.
+        """
+        clause, params = self._where_sql(where)
+        if ids is not None:
+            clause = " AND ".join(filter(None, [clause, f"id IN ({','.join('?' * len(ids))})"]))
+            params.extend(ids)
+        sql = "SELECT id, text, metadata FROM chunks" + (f" WHERE {clause}" if clause else "") + " ORDER BY row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset or 0])
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        include = ["documents", "metadatas"] if include is None else include
+        return {
+            "ids": [row[0] for row in rows],
+            "documents": [row[1] for row in rows] if "documents" in include else None,
+            "metadatas": [json.loads(row[2]) for row in rows] if "metadatas" in include else None,
+        }
+
+    def get_by_ids(self, ids: list[str], /) -> list[Document]:
+        if not ids:
+            return []
+        page = self.get(ids=list(ids))
+        return [Document(id=chunk_id, page_content=text, metadata=meta)
+                for chunk_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"])]
@@ -1,50 +1,97 @@
-from langchain.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import VectorStore
 from langchain_openai import ChatOpenAI
 from langchain_core.documents import Document
 from langchain_community.callbacks import get_openai_callback
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers.openai_tools import JsonOutputKeyToolsParser
 from langgraph.graph import START, StateGraph
 from langgraph.graph.state import CompiledStateGraph
+from langgraph.types import StreamWriter
 from langchain_core.vectorstores import VectorStore
+from langchain_core.runnables import Runnable
 from langchain_core.runnables.config import RunnableConfig
+from langgraph.utils.runnable import RunnableCallable
+from pydantic import BaseModel, ValidationError
 
+import asyncio
 import os
+import re
+import uuid
+from contextlib import contextmanager
+from itertools import chain
 from pathlib import Path
+from typing import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from .objects import Bibcitation, QuotedAnswer, State
-from .prompt_templates import system_prompt_meta, system_prompt_rag
-from .pdf_processing import preprocess_pdf, make_hash_from_metadata
+from .objects import Bibcitation, LlmCitation, QuotedAnswer, State
+from .prompt_templates import system_prompt_meta, system_prompt_meta_fields, system_prompt_rag, system_prompt_reduce
+from .pdf_processing import iter_chunks, batched, attach_metadata, chunk_pdf_file, scan_pdf_file, make_hash_from_metadata, make_hash_from_file
 from .spendings import Spendings, SpendingsMeta, SpendingClient
-from .context_postprocessing import format_docs_with_id
+from .context_postprocessing import pack_context, count_tokens, limit_per_paper
+from .ingest_cache import IngestCache, IngestRecord
+from .answer_cache import AnswerCache
+from .loaders import PdfBackend, PdfInput, PdfSource, as_pdf_source, get_loader_backend
+from .tracing import tracer, run_traced
+from .metadata_extraction import LocalMetadataExtractor, MetadataStats, partial_bibcitation
+from .citation_styles import SummaryCitation
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .partitioning import count_chunks, scope_filter
+from .dedup import NearDuplicateIndex, resolve_links
+from .concurrency import llm_limiter, limited
+
+
+# Inline citation markers such as [1] or [1, 2]
+INLINE_CITATION = re.compile(r"\s*\[\d+(?:\s*,\s*\d+)*\]")
 
 
 class RAG:
-    def __init__(self, model: ChatOpenAI, vectorstore: VectorStore, spendings_client: SpendingClient):
+    def __init__(self, model: ChatOpenAI, vectorstore: VectorStore, spendings_client: SpendingClient,
+                 ingest_cache: IngestCache | None = None, answer_cache: AnswerCache | None = None,
+                 loader: PdfBackend | str | None = None, metadata_extractor: LocalMetadataExtractor | None = None,
+                 metadata_window: int = 3000, lexical_index: LexicalIndex | None = None,
+                 dedup_index: NearDuplicateIndex | None = None):
         """
         Initializes the RAG class with a PDF file and a question.
+        loader selects the PDF text-extraction backend, by default from the SCIART_PDF_BACKEND environment variable.
+        metadata_window limits the first page text sent to the LLM for the fields not found locally.
+        lexical_index is kept in sync with the vectorstore and enables the "lexical" and "hybrid" retrieval.
+        dedup_index skips embedding chunks nearly identical to stored ones, they are linked to the stored vectors.
 
         """
         self.llm = model
         self.vectorstore = vectorstore
         self.spendings = spendings_client
+        self.ingest_cache = ingest_cache
+        self.answer_cache = answer_cache
+        self.loader = loader if isinstance(loader, PdfBackend) else get_loader_backend(loader)
+        self.metadata_extractor = metadata_extractor or LocalMetadataExtractor()
+        self.metadata_window = metadata_window
+        self.metadata_stats = MetadataStats()
+        self.lexical_index = lexical_index
+        self.dedup_index = dedup_index
 
-    def load_pdf(self, path: str) -> list[Document]:
+    def load_pdf(self, path: PdfInput) -> list[Document]:
         """
-        Loads the PDF file and splits it into chunks.
+        Loads the PDF file and splits it into chunks. Bytes and file objects are parsed from memory.
 
         Returns:
             list[Document]: List of Document objects representing the chunks of the PDF.
         """
         # pdf_path = Path.cwd() / "tmp" / path # 248_ftp.pdf tmp/nl501863u.pdf tmp/Vol_241_Sample_pages.pdf
-        loader = PyPDFLoader(path) 
-        docs = loader.load()
+        with tracer.span("load_pdf") as span:
+            docs = self.loader.load(as_pdf_source(path))
+            span.count("pages", len(docs))
         return docs
+
+    def lazy_load_pdf(self, path: PdfInput) -> Iterator[Document]:
+        """
+        Loads the PDF file page by page, so the pages never have to be in memory all at once.
+        """
+        return tracer.iter("load_pdf", self.loader.lazy_load(as_pdf_source(path)), count_as="pages")
     
     def metadata_from_pdf(self, docs: list[Document]) -> list[Document]:
         """
-        Extracts metadata from the PDF file.
+        Extracts metadata from the PDF file. The fields are first extracted locally (PDF metadata, DOI,
+        journal headers), the LLM is asked only for the missing or low-confidence ones.
 
         Args:
             docs (list[Document]): List of Document objects representing the chunks of the PDF.
@@ -52,51 +99,486 @@ class RAG:
         Returns:
             list[Document]: List of Document objects with metadata.
         """
+        meta, chain, inputs = self._metadata_request(docs)
+        if chain is None:
+            return meta
+        with llm_limiter.limit(), get_openai_callback() as cb, tracer.span("metadata_from_pdf") as span:
+            response = chain.invoke(inputs)
+            span.count("tokens", cb.total_tokens)
+        return self._metadata_response(meta, response, cb)
+
+    async def ametadata_from_pdf(self, docs: list[Document]) -> dict[str, str]:
+        """
+        Async variant of metadata_from_pdf, the local extraction and the spendings write run in threads.
+        """
+        meta, chain, inputs = await asyncio.to_thread(self._metadata_request, docs)
+        if chain is None:
+            return meta
+        async with llm_limiter.alimit():
+            with get_openai_callback() as cb, tracer.span("metadata_from_pdf") as span:
+                response = await chain.ainvoke(inputs)
+                span.count("tokens", cb.total_tokens)
+        return await asyncio.to_thread(self._metadata_response, meta, response, cb)
+
+    def _metadata_request(self, docs: list[Document]) -> tuple[dict[str, str], Runnable | None, dict]:
+        with tracer.span("metadata_local"):
+            meta = self.metadata_extractor.confident(self.metadata_extractor.extract(docs[0]))
+        missing = [field for field in Bibcitation.model_fields if field not in meta]
+        self.metadata_stats.record(len(meta), len(missing))
+        if not missing:
+            return {field: meta[field] for field in Bibcitation.model_fields}, None, {}
+
+        fields = "\n\n".join(f"{field}: {Bibcitation.model_fields[field].description}" for field in missing)
         prompt = ChatPromptTemplate.from_messages(
             [
-                ("system", system_prompt_meta),
+                ("system", system_prompt_meta_fields if meta else system_prompt_meta),
                 ("human", "{question}"),
             ]
         )
-        meta_cite_llm = self.llm.with_structured_output(Bibcitation)
-        chain = prompt | meta_cite_llm
-        with get_openai_callback() as cb:
-            response = chain.invoke({"question": "Extract the bibliographic information from the scientific paper.", "text": docs[0].page_content})
-            self.spendings.add_spending(Spendings(cost=SpendingsMeta.from_api_response(cb)))
+        meta_cite_llm = self.llm.with_structured_output(partial_bibcitation(missing) if meta else Bibcitation)
+        inputs = {"question": "Extract the bibliographic information from the scientific paper.",
+                  "text": docs[0].page_content[:self.metadata_window], "fields": fields}
+        return meta, prompt | meta_cite_llm, inputs
 
-        return response.__dict__
+    def _metadata_response(self, meta: dict[str, str], response: BaseModel, cb) -> dict[str, str]:
+        meta.update(response.__dict__)
+        meta = {field: meta[field] for field in Bibcitation.model_fields}
+        self.spendings.add_spending(Spendings(cost=SpendingsMeta.from_api_response(cb), operation="metadata",
+                                              model=self.model_settings()["model"],
+                                              doc_hash=make_hash_from_metadata(meta)))
+        return meta
     
-    def store_pdf(self, docs: list[Document], paper_meta: dict[str, str]) -> list[Document]:
+    def store_pdf(self, docs: Iterable[Document], paper_meta: dict[str, str], batch_size: int = 256) -> list[Document]:
         """
         Splits the PDF file into smaller chunks and stores them in the vectorstore.
+        Pages are consumed lazily and the chunks are written in batches of batch_size.
 
         Args:
-            docs (list[Document]): List of Document objects representing the chunks of the PDF.
+            docs (Iterable[Document]): Document objects representing the pages of the PDF.
 
         Returns:
             list[Document]: List of Document objects representing the chunks of the PDF.
         """
         hash_check = make_hash_from_metadata(paper_meta)
-        check_uniqueness = self.vectorstore.get(where={"hash": hash_check})
-        if check_uniqueness.get("ids", 0):
+        if self.is_stored(hash_check):
             print("The document is already in the vectorstore.")
             return
 
-        sections = preprocess_pdf(docs, paper_meta, hash_check)
-
-        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        texts, metadatas = [], []
-        for sec in sections:
-            texts.append(sec["content"])
-            metadatas.append(sec["metadata"])
-        chunks = splitter.create_documents(texts, metadatas=metadatas)
-        self.vectorstore.add_documents(chunks)
+        for chunks in batched(iter_chunks(docs, paper_meta, hash_check), batch_size):
+            self.add_chunks(chunks)
+        if self.answer_cache is not None:
+            self.answer_cache.bump_corpus_version()
         return 
+
+    def add_chunks(self, chunks: list[Document]):
+        """
+        Embeds and writes the chunks to the vectorstore, and indexes them under the same IDs in the lexical index.
+        Near duplicates of stored chunks are only linked to them.
+        """
+        registered, ids, chunks = self._deduplicate(chunks)
+        with self._rollback_dedup(registered):
+            if chunks:
+                self.record_embedding(chunks)
+                self._write_chunks(ids, chunks)
+
+    async def aadd_chunks(self, chunks: list[Document]):
+        """
+        Async variant of add_chunks. With a cached embedding function the vectors are fetched asynchronously
+        first, the vectorstore then finds them in the cache (without counting them twice) and only the local
+        write runs in a thread.
+        """
+        registered, ids, chunks = await asyncio.to_thread(self._deduplicate, chunks)
+        with self._rollback_dedup(registered):
+            if not chunks:
+                return
+            await asyncio.to_thread(self.record_embedding, chunks)
+            embeddings = self.vectorstore.embeddings
+            if hasattr(embeddings, "uncached"):
+                with tracer.span("embed_documents") as span:
+                    await embeddings.aembed_documents([chunk.page_content for chunk in chunks])
+                    span.count("chunks", len(chunks))
+                # the vectors were counted above, the vectorstore only reads them back
+                with embeddings.uncounted():
+                    await asyncio.to_thread(self._write_chunks, ids, chunks)
+            else:
+                await asyncio.to_thread(self._write_chunks, ids, chunks)
+
+    def _deduplicate(self, chunks: list[Document]) -> tuple[list[str], list[str], list[Document]]:
+        """
+        Returns the IDs registered in the dedup index, then the IDs and the chunks to write.
+        """
+        ids = [str(uuid.uuid4()) for _ in chunks]
+        if self.dedup_index is None:
+            return [], ids, chunks
+        with tracer.span("deduplicate") as span:
+            keep = self.dedup_index.deduplicate(ids, chunks)
+            span.count("duplicates", keep.count(False))
+        return ids, [i for i, k in zip(ids, keep) if k], [chunk for chunk, k in zip(chunks, keep) if k]
+
+    @contextmanager
+    def _rollback_dedup(self, registered: list[str]):
+        try:
+            yield
+        except BaseException:
+            # The chunks of the batch were registered as stored or linked. Left behind, they would mark the paper
+            # as stored and later duplicates would be linked to missing vectors
+            if registered:
+                self.dedup_index.forget(registered)
+            raise
+
+    def _write_chunks(self, ids: list[str], chunks: list[Document]):
+        with tracer.span("add_documents") as span:
+            self.vectorstore.add_documents(chunks, ids=ids)
+            span.count("chunks", len(chunks))
+        if self.lexical_index is not None:
+            with tracer.span("lexical_index") as span:
+                self.lexical_index.add(ids, chunks)
+                span.count("chunks", len(chunks))
+
+    def sync_lexical_index(self, batch_size: int = 1000) -> int:
+        """
+        Indexes the vectorstore chunks missing from the lexical index, e.g. stored before the index existed.
+        When both hold as many chunks the indexes are in sync and nothing is read, otherwise only the IDs
+        are compared and the missing chunks are fetched by ID.
+
+        Returns:
+            int: Number of indexed chunks.
+        """
+        if self.lexical_index is None:
+            return 0
+        stored = count_chunks(self.vectorstore)
+        if stored is not None and stored == len(self.lexical_index):
+            return 0
+        indexed = self.lexical_index.ids()
+        added, offset = 0, 0
+        while True:
+            page = self.vectorstore.get(include=[], limit=batch_size, offset=offset)
+            if not page["ids"]:
+                return added
+            offset += len(page["ids"])
+            missing = [chunk_id for chunk_id in page["ids"] if chunk_id not in indexed]
+            if missing:
+                docs = self.vectorstore.get_by_ids(missing)
+                self.lexical_index.add([doc.id for doc in docs], docs)
+                added += len(docs)
+
+    def sync_dedup_index(self, batch_size: int = 1000) -> int:
+        """
+        Drops the chunks of the near-duplicate index missing from the vectorstore, e.g. after it was reset,
+        so new chunks are not linked to missing vectors. When both hold as many chunks nothing is read.
+
+        Returns:
+            int: Number of dropped chunks.
+        """
+        if self.dedup_index is None:
+            return 0
+        stored = count_chunks(self.vectorstore)
+        if stored is not None and stored == len(self.dedup_index):
+            return 0
+        if stored == 0:
+            dropped = len(self.dedup_index)
+            self.dedup_index.clear()
+            return dropped
+        ids, offset = set(), 0
+        while True:
+            page = self.vectorstore.get(include=[], limit=batch_size, offset=offset)
+            if not page["ids"]:
+                return self.dedup_index.retain(ids)
+            ids.update(page["ids"])
+            offset += len(page["ids"])
+
+    def record_embedding(self, chunks: list[Document]):
+        """
+        Records the estimated embedding cost of the chunks, per paper. Texts already in the embedding cache are free.
+        """
+        embeddings = self.vectorstore.embeddings
+        model = getattr(embeddings, "model_name", None) or getattr(embeddings, "model", "") or ""
+        papers = {}
+        for chunk in chunks:
+            papers.setdefault(chunk.metadata["hash"], []).append(chunk.page_content)
+        for meta_hash, texts in papers.items():
+            if hasattr(embeddings, "uncached"):
+                texts = embeddings.uncached(texts)
+            tokens = sum(count_tokens(text) for text in texts)
+            self.spendings.add_spending(Spendings(cost=SpendingsMeta.from_embedding_tokens(tokens, model),
+                                                  operation="embedding", model=model, doc_hash=meta_hash))
+
+    def is_stored(self, meta_hash: str) -> bool:
+        """
+        Checks if the chunks of the paper with the given metadata hash are in the vectorstore.
+        """
+        check_uniqueness = self.vectorstore.get(where={"hash": meta_hash}, limit=1)
+        if check_uniqueness.get("ids"):
+            return True
+        if self.dedup_index is None:
+            return False
+        # every chunk of the paper may be a duplicate, linked to the chunks of another version,
+        # the links count only while the linked vectors are still in the vectorstore
+        targets = list(self.dedup_index.linked([meta_hash]))
+        if targets and len(self.vectorstore.get_by_ids(targets)) == len(targets):
+            return True
+        # the paper must be stored again, its stale chunks would turn the new ones into links to missing vectors
+        self.dedup_index.forget_hash(meta_hash)
+        if targets:
+            self.dedup_index.forget(targets)
+        return False
+
+    def ingest_pdf(self, path: PdfInput) -> IngestRecord:
+        """
+        Loads, describes and stores the PDF file, skipping every step already done for the same file content.
+
+        Args:
+            path (PdfInput): Path to the PDF file, or its content as bytes or a file object (parsed from memory).
+
+        Returns:
+            IngestRecord: Ingest state of the file, including the extracted metadata and its hash.
+        """
+        path = as_pdf_source(path)
+        file_hash = make_hash_from_file(path)
+        record = self.ingest_cache.get(file_hash) if self.ingest_cache is not None else None
+        if record is not None and record.status == IngestCache.STORED and self.is_stored(record.meta_hash):
+            return record
+
+        pages = self.lazy_load_pdf(path)
+        first_page = next(pages, None)
+        if first_page is None:
+            raise ValueError(f"{path} has no pages")
+        docs = chain([first_page], pages)
+        if record is None:
+            meta = self.metadata_from_pdf([first_page])
+            record = IngestRecord(file_hash=file_hash, meta_hash=make_hash_from_metadata(meta), metadata=meta)
+            if self.ingest_cache is not None:
+                self.ingest_cache.put(record)
+
+        self.store_pdf(docs, record.metadata)
+        if self.ingest_cache is not None:
+            self.ingest_cache.mark_stored(record)
+        return record
+
+    def ingest_many(self, paths: list[PdfInput], max_workers: int | None = None, max_concurrency: int = 4,
+                    batch_size: int = 512) -> list[IngestRecord]:
+        """
+        Ingests several PDF files at once. Parsing and preprocessing run in a process pool,
+        the metadata LLM calls run concurrently and the chunks of all papers are written in large batches.
+
+        Args:
+            paths (list[PdfInput]): Paths to the PDF files, or their contents as bytes or file objects.
+            max_workers (int | None): Number of processes used for parsing, defaults to the number of CPUs.
+            max_concurrency (int): Maximum number of simultaneous metadata LLM calls.
+            batch_size (int): Minimum number of chunks embedded and written to the vectorstore at once.
+
+        Returns:
+            list[IngestRecord]: Ingest state of every file, in the order of the paths.
+        """
+        results: dict[str, IngestRecord] = {}
+        paths = [as_pdf_source(path) for path in paths]
+        file_hashes = [make_hash_from_file(path) for path in paths]
+        seen_papers: set[str] = set()
+        batch: list[Document] = []
+        batch_records: list[IngestRecord] = []
+
+        def flush():
+            if batch:
+                self.add_chunks(batch)
+                if self.answer_cache is not None:
+                    self.answer_cache.bump_corpus_version()
+            for rec in batch_records:
+                if self.ingest_cache is not None:
+                    self.ingest_cache.mark_stored(rec)
+                else:
+                    rec.status = IngestCache.STORED
+            batch.clear()
+            batch_records.clear()
+
+        with ProcessPoolExecutor(max_workers) as pool, ThreadPoolExecutor(max_concurrency) as llm_pool:
+            pending = {}
+
+            def collect(record: IngestRecord, chunks: list[Document]):
+                batch.extend(chunks)
+                batch_records.append(record)
+                results[record.file_hash] = record
+                if len(batch) >= batch_size:
+                    flush()
+
+            def submit_chunking(path: PdfSource, record: IngestRecord, chunks: list[Document] | None = None):
+                # The same paper may come from several files or already be in the vectorstore
+                if record.meta_hash in seen_papers or self.is_stored(record.meta_hash):
+                    print("The document is already in the vectorstore.")
+                    results[record.file_hash] = (self.ingest_cache.mark_stored(record)
+                                                 if self.ingest_cache is not None else record)
+                    return
+                seen_papers.add(record.meta_hash)
+                # a new file was chunked when it was scanned, a known one is parsed now
+                if chunks is not None:
+                    collect(record, attach_metadata(chunks, record.metadata, record.meta_hash))
+                    return
+                future = pool.submit(run_traced, chunk_pdf_file, path, record.metadata, record.meta_hash, self.loader)
+                pending[future] = ("chunk", path, record)
+
+            # identical files uploaded twice are ingested once
+            for file_hash, path in dict(zip(file_hashes, paths)).items():
+                record = self.ingest_cache.get(file_hash) if self.ingest_cache is not None else None
+                if record is None:
+                    # new files are parsed once, the metadata is extracted from the first page of the result
+                    pending[pool.submit(run_traced, scan_pdf_file, path, self.loader)] = ("scan", path, file_hash)
+                elif record.status == IngestCache.STORED and self.is_stored(record.meta_hash):
+                    results[file_hash] = record
+                else:
+                    submit_chunking(path, record)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, path, payload = pending.pop(future)
+                    if stage in ["scan", "chunk"]:
+                        # Worker processes send their stage timings back with the result
+                        result, samples = future.result()
+                        tracer.merge(samples)
+                    if stage == "scan":
+                        first_page, chunks = result
+                        meta_future = llm_pool.submit(self.metadata_from_pdf, [first_page])
+                        pending[meta_future] = ("meta", path, (payload, chunks))
+                    elif stage == "meta":
+                        meta = future.result()
+                        file_hash, chunks = payload
+                        record = IngestRecord(file_hash=file_hash, meta_hash=make_hash_from_metadata(meta), metadata=meta)
+                        if self.ingest_cache is not None:
+                            self.ingest_cache.put(record)
+                        submit_chunking(path, record, chunks)
+                    else:
+                        collect(payload, result)
+            flush()
+
+        return [results[file_hash] for file_hash in file_hashes]
     
+    async def aingest_pdf(self, path: PdfInput) -> IngestRecord:
+        """
+        Async variant of ingest_pdf, the PDF is parsed in a worker thread.
+        """
+        return (await self._aingest([path], None, 1))[0]
+
+    async def aingest_many(self, paths: list[PdfInput], max_workers: int | None = None,
+                           max_concurrency: int = 4) -> list[IngestRecord]:
+        """
+        Async variant of ingest_many. Parsing runs in a process pool, the metadata calls and the embeddings
+        are awaited, so the event loop keeps serving the other sessions. Chunks are written paper by paper.
+        """
+        pool = ProcessPoolExecutor(max_workers)
+        try:
+            return await self._aingest(paths, pool, max_concurrency)
+        finally:
+            # waiting for the workers to exit must not block the event loop
+            await asyncio.to_thread(pool.shutdown)
+
+    async def _aingest(self, paths: list[PdfInput], pool: ProcessPoolExecutor | None,
+                       max_concurrency: int) -> list[IngestRecord]:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_concurrency)
+        seen_papers: set[str] = set()
+        # Streams are read (and hashed on the way) off the event loop
+        paths = await asyncio.gather(*(asyncio.to_thread(as_pdf_source, path) for path in paths))
+        file_hashes = await asyncio.gather(*(asyncio.to_thread(make_hash_from_file, path) for path in paths))
+
+        async def in_worker(func, *args):
+            # Worker processes send their stage timings back with the result
+            result, samples = await loop.run_in_executor(pool, run_traced, func, *args)
+            if pool is not None:
+                tracer.merge(samples)
+            return result
+
+        async def ingest(file_hash: str, path: PdfSource) -> IngestRecord:
+            # The SQLite caches and the vectorstore lookups are blocking, they run in threads
+            record = await asyncio.to_thread(self.ingest_cache.get, file_hash) if self.ingest_cache is not None else None
+            if (record is not None and record.status == IngestCache.STORED
+                    and await asyncio.to_thread(self.is_stored, record.meta_hash)):
+                return record
+            chunks = None
+            if record is None:
+                # new files are parsed once, the metadata is extracted from the first page of the result
+                first_page, chunks = await in_worker(scan_pdf_file, path, self.loader)
+                async with semaphore:
+                    meta = await self.ametadata_from_pdf([first_page])
+                record = IngestRecord(file_hash=file_hash, meta_hash=make_hash_from_metadata(meta), metadata=meta)
+                if self.ingest_cache is not None:
+                    await asyncio.to_thread(self.ingest_cache.put, record)
+
+            # The same paper may come from several files or already be in the vectorstore.
+            # It is claimed before the lookup is awaited, so two files of the same paper are not both chunked
+            duplicate = record.meta_hash in seen_papers
+            seen_papers.add(record.meta_hash)
+            if duplicate or await asyncio.to_thread(self.is_stored, record.meta_hash):
+                print("The document is already in the vectorstore.")
+            else:
+                if chunks is None:
+                    chunks = await in_worker(chunk_pdf_file, path, record.metadata, record.meta_hash, self.loader)
+                else:
+                    chunks = attach_metadata(chunks, record.metadata, record.meta_hash)
+                await self.aadd_chunks(chunks)
+                if self.answer_cache is not None:
+                    await asyncio.to_thread(self.answer_cache.bump_corpus_version)
+            if self.ingest_cache is not None:
+                return await asyncio.to_thread(self.ingest_cache.mark_stored, record)
+            record.status = IngestCache.STORED
+            return record
+
+        # identical files uploaded twice are ingested once
+        unique = dict(zip(file_hashes, paths))
+        records = dict(zip(unique, await asyncio.gather(*(ingest(h, path) for h, path in unique.items()))))
+        return [records[file_hash] for file_hash in file_hashes]
+
+    def model_settings(self) -> dict:
+        """
+        Returns the model parameters that change the generated answer.
+        """
+        return {
+            "model": getattr(self.llm, "model_name", type(self.llm).__name__),
+            "temperature": getattr(self.llm, "temperature", None),
+        }
+
+    def corpus_version(self) -> int | None:
+        """
+        Returns the version of the stored corpus, read before answering and passed to cached_answer and
+        cache_answer. None without an answer cache.
+        """
+        if self.answer_cache is None:
+            return None
+        return self.answer_cache.corpus_version
+
+    def cached_answer(self, question: str, config: RunnableConfig,
+                      version: int | None = None) -> SummaryCitation | None:
+        """
+        Looks the question up in the answer cache. A hit is recorded as a zero-cost spending.
+        """
+        if self.answer_cache is None:
+            return None
+        summary = self.answer_cache.get(question, config, self.model_settings(), version)
+        if summary is not None:
+            self.spendings.add_spending(Spendings(cost=SpendingsMeta.empty(), operation="summary",
+                                                  model=self.model_settings()["model"], cache_hit=True))
+        return summary
+
+    def cache_answer(self, question: str, config: RunnableConfig, summary: SummaryCitation, version: int | None):
+        if self.answer_cache is not None and version is not None:
+            self.answer_cache.put(question, config, self.model_settings(), summary, version)
+
     def create_graph(self) -> CompiledStateGraph:
         """
         Creates a graph of execution, including retrieving, llm and structured output.
 
+        The configurable part of the config accepts "chunk_nums" (number of retrieved chunks), "token_budget"
+        (maximum context tokens, chunks are packed in retrieval order) and "mmr" (drop redundant chunks with
+        maximal marginal relevance).
+        "retrieval" selects "vector" (default), "lexical" (BM25 over the lexical index) or "hybrid" (both rankings
+        fused with reciprocal rank fusion, "rrf_k" sets the fusion constant, 60 by default).
+        "hashes" restricts the search to the papers with these metadata hashes and "per_paper_k" keeps at most
+        that many chunks of every paper.
+        "mode": "map_reduce" summarizes the chunks of every paper separately, at most "map_concurrency" (8)
+        calls at once, and merges the summaries in a last call. The default "stuff" mode makes a single call.
+        Set "stream_answer" in the configurable part of the config and run the graph with
+        stream_mode=["updates", "custom"] to receive the partial answer text as the tokens arrive.
+        The graph also runs with ainvoke and astream, the nodes then await the model and the embeddings,
+        so many sessions can share one event loop.
+
         Returns: CompiledStateGraph - runnable graph
         TODO: if we want to reuse some parts of the graph, we can create a class instead of a function
         """
@@ -107,25 +589,255 @@ class RAG:
                 ("human", "{question}"),
             ]
         )
+        reduce_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", system_prompt_reduce),
+                ("human", "{question}"),
+            ]
+        )
 
-        def retrieve(state: State, config: RunnableConfig):
+        # Every model call takes a slot of the process-wide limiter, also the parallel calls of the map step
+        structured_llm = limited(self.llm.with_structured_output(QuotedAnswer))
+        # Tool call arguments are parsed as partial JSON, so the answer text is available token by token
+        streaming_llm = (
+            self.llm.bind_tools([QuotedAnswer], tool_choice=QuotedAnswer.__name__)
+            | JsonOutputKeyToolsParser(key_name=QuotedAnswer.__name__, first_tool_only=True)
+        )
+
+        def vector_search(question: str, k: int, config: RunnableConfig, hashes: list[str] | None,
+                          embedding: list[float] | None = None) -> list[Document]:
+            mmr = config["configurable"].get("mmr", False)
+            if embedding is not None:
+                # the query was embedded asynchronously beforehand
+                if mmr:
+                    return self.vectorstore.max_marginal_relevance_search_by_vector(
+                        embedding, k, fetch_k=max(4 * k, 20), filter=scope_filter(hashes))
+                return self.vectorstore.similarity_search_by_vector(embedding, k, filter=scope_filter(hashes))
+            if mmr:
+                return self.vectorstore.max_marginal_relevance_search(question, k, fetch_k=max(4 * k, 20),
+                                                                      filter=scope_filter(hashes))
+            return self.vectorstore.similarity_search(question, k, filter=scope_filter(hashes))
+
+        def lexical_search(question: str, k: int, hashes: list[str] | None) -> list[str]:
+            with tracer.span("lexical_search") as span:
+                hits = [chunk_id for chunk_id, _ in self.lexical_index.search(question, k, hashes)]
+                span.count("chunks", len(hits))
+            return hits
+
+        def fetch(ids: list[str], known: dict[str, Document]) -> list[Document]:
+            # get_by_ids does not keep the order of the IDs and Chroma rejects an empty list
+            missing = [i for i in ids if i not in known]
+            if missing:
+                known = {**known, **{doc.id: doc for doc in self.vectorstore.get_by_ids(missing)}}
+            return [known[i] for i in ids if i in known]
+
+        def retrieval_mode(config: RunnableConfig) -> str:
+            if self.lexical_index is None or not config["configurable"].get("chunk_nums", 4):
+                return "vector"
+            return config["configurable"].get("retrieval", "vector")
+
+        def search(question: str, config: RunnableConfig, embedding: list[float] | None = None) -> list[Document]:
             number_of_docs = config["configurable"].get("chunk_nums", 4)
-            retrieved_docs = self.vectorstore.similarity_search(state["question"], number_of_docs)
+            retrieval = retrieval_mode(config)
+            hashes = config["configurable"].get("hashes") or None
+            per_paper_k = config["configurable"].get("per_paper_k")
+            # With a quota more chunks are ranked, so the other papers can take the places of the capped one
+            fetch_k = max(4 * number_of_docs, 20) if per_paper_k else number_of_docs
+            # Chunks of the scoped papers may be linked to the vectors of another version of the paper, its hash
+            # is added to the filter and its chunks which are not linked are dropped afterwards
+            linked = self.dedup_index.linked(hashes) if self.dedup_index is not None and hashes else {}
+            search_hashes = hashes
+            if linked:
+                search_hashes = sorted(set(hashes) | {meta_hash for meta_hash, _ in linked.values()})
+                fetch_k = max(2 * fetch_k, 20)
+            if retrieval == "lexical":
+                retrieved_docs = fetch(lexical_search(question, fetch_k, search_hashes), {})
+            elif retrieval == "hybrid":
+                # Both rankings are deeper than k, so a chunk ranked well by one of them can still make it
+                depth = max(2 * fetch_k, 20)
+                vector_docs = {doc.id: doc
+                               for doc in vector_search(question, depth, config, search_hashes, embedding)}
+                lexical_ids = lexical_search(question, depth, search_hashes)
+                fused = reciprocal_rank_fusion([list(vector_docs), lexical_ids],
+                                               config["configurable"].get("rrf_k", 60))[:fetch_k]
+                retrieved_docs = fetch(fused, vector_docs)
+            else:
+                retrieved_docs = vector_search(question, fetch_k, config, search_hashes, embedding)
+            if linked:
+                retrieved_docs = resolve_links(retrieved_docs, hashes, linked)
+            if per_paper_k:
+                retrieved_docs = limit_per_paper(retrieved_docs, per_paper_k)
+            return retrieved_docs[:number_of_docs]
+
+        def retrieve(state: State, config: RunnableConfig):
+            with tracer.span("retrieve") as span:
+                retrieved_docs = search(state["question"], config)
+                span.count("chunks", len(retrieved_docs))
             return {"context": retrieved_docs}
 
+        async def aretrieve(state: State, config: RunnableConfig):
+            with tracer.span("retrieve") as span:
+                embedding = None
+                if retrieval_mode(config) != "lexical":
+                    with tracer.span("embed_query"):
+                        embedding = await self.vectorstore.embeddings.aembed_query(state["question"])
+                # The local index lookups are short, they run in a thread so the loop stays free meanwhile
+                retrieved_docs = await asyncio.to_thread(search, state["question"], config, embedding)
+                span.count("chunks", len(retrieved_docs))
+            return {"context": retrieved_docs}
+
+
+        def answer(messages, config: RunnableConfig, writer: StreamWriter) -> QuotedAnswer:
+            if not config["configurable"].get("stream_answer", False):
+                return structured_llm.invoke(messages)
+
+            partial = {}
+            with llm_limiter.limit():
+                for partial in streaming_llm.stream(messages):
+                    if partial and partial.get("answer"):
+                        writer({"answer": partial["answer"]})
+            try:
+                return QuotedAnswer.model_validate(partial or {})
+            except ValidationError:
+                # The model streamed no complete tool call, e.g. it answered in plain text
+                return structured_llm.invoke(messages)
+
+        async def aanswer(messages, config: RunnableConfig, writer: StreamWriter) -> QuotedAnswer:
+            if not config["configurable"].get("stream_answer", False):
+                return await structured_llm.ainvoke(messages)
+
+            partial = {}
+            async with llm_limiter.alimit():
+                async for partial in streaming_llm.astream(messages):
+                    if partial and partial.get("answer"):
+                        writer({"answer": partial["answer"]})
+            try:
+                return QuotedAnswer.model_validate(partial or {})
+            except ValidationError:
+                # The model streamed no complete tool call, e.g. it answered in plain text
+                return await structured_llm.ainvoke(messages)
+
+        def pack(state: State, config: RunnableConfig):
+            with tracer.span("pack_context") as span:
+                packed = pack_context(state["context"], config["configurable"].get("token_budget"))
+                span.count("tokens_saved", packed.tokens_saved)
+            context_stats = {"tokens": packed.tokens, "tokens_saved": packed.tokens_saved,
+                             "chunks_used": packed.chunks_used, "chunks_dropped": packed.chunks_dropped}
+            messages = prompt.invoke({"question": state["question"], "context": packed.text})
+            return messages, context_stats
+
+        def generate(state: State, config: RunnableConfig, writer: StreamWriter):
+            messages, context_stats = pack(state, config)
+            with tracer.span("generate") as span:
+                span.count("context_tokens", context_stats["tokens"])
+                response = answer(messages, config, writer)
+            return {"answer": response, "context_stats": context_stats}
+
+        async def agenerate(state: State, config: RunnableConfig, writer: StreamWriter):
+            messages, context_stats = pack(state, config)
+            with tracer.span("generate") as span:
+                span.count("context_tokens", context_stats["tokens"])
+                response = await aanswer(messages, config, writer)
+            return {"answer": response, "context_stats": context_stats}
+
+        def pack_papers(state: State, config: RunnableConfig):
+            groups: dict[str, list[Document]] = {}
+            for doc in state["context"]:
+                groups.setdefault(doc.metadata["hash"], []).append(doc)
+            token_budget = config["configurable"].get("token_budget")
+            with tracer.span("pack_context") as span:
+                packed = [pack_context(docs, token_budget // len(groups) if token_budget else None)
+                          for docs in groups.values()]
+                span.count("tokens_saved", sum(p.tokens_saved for p in packed))
+            context_stats = {"tokens": sum(p.tokens for p in packed),
+                             "tokens_saved": sum(p.tokens_saved for p in packed),
+                             "chunks_used": sum(p.chunks_used for p in packed),
+                             "chunks_dropped": sum(p.chunks_dropped for p in packed)}
+            inputs = [prompt.invoke({"question": state["question"], "context": p.text}) for p in packed]
+            return list(groups), inputs, context_stats
+
+        def paper_summaries(meta_hashes: list[str], responses: list[QuotedAnswer]) -> list[QuotedAnswer]:
+            # Every summary covers a single paper, so it cites that paper whatever the model wrote.
+            # Its inline markers refer to the per-paper source IDs and are dropped.
+            return [
+                QuotedAnswer(answer=INLINE_CITATION.sub("", response.answer),
+                             citations=[LlmCitation(source_id=num, hash=meta_hash)])
+                for num, (meta_hash, response) in enumerate(zip(meta_hashes, responses), start=1)
+            ]
+
+        def summarize_papers(state: State, config: RunnableConfig):
+            # Map: one summary per paper, the calls run in parallel
+            meta_hashes, inputs, context_stats = pack_papers(state, config)
+            with tracer.span("map_summaries") as span:
+                span.count("papers", len(inputs))
+                span.count("context_tokens", context_stats["tokens"])
+                responses = structured_llm.batch(
+                    inputs, config={**config, "max_concurrency": config["configurable"].get("map_concurrency", 8)})
+            return {"partial_answers": paper_summaries(meta_hashes, responses), "context_stats": context_stats}
+
+        async def asummarize_papers(state: State, config: RunnableConfig):
+            meta_hashes, inputs, context_stats = pack_papers(state, config)
+            with tracer.span("map_summaries") as span:
+                span.count("papers", len(inputs))
+                span.count("context_tokens", context_stats["tokens"])
+                responses = await structured_llm.abatch(
+                    inputs, config={**config, "max_concurrency": config["configurable"].get("map_concurrency", 8)})
+            return {"partial_answers": paper_summaries(meta_hashes, responses), "context_stats": context_stats}
+
+        def reduce_messages(state: State):
+            summaries = "\n\n".join(
+                f"Source ID: {p.citations[0].source_id}\nHash: {p.citations[0].hash}\nSummary: {p.answer}"
+                for p in state["partial_answers"]
+            )
+            return reduce_prompt.invoke({"question": state["question"], "summaries": summaries})
+
+        def combined_answer(partial_answers: list[QuotedAnswer], response: QuotedAnswer) -> dict:
+            # Only hashes of the given papers are kept, a wrong hash is recovered from the source ID
+            source_ids = {p.citations[0].hash: p.citations[0].source_id for p in partial_answers}
+            hashes = {num: meta_hash for meta_hash, num in source_ids.items()}
+            citations = {}
+            for citation in response.citations:
+                meta_hash = citation.hash if citation.hash in source_ids else hashes.get(citation.source_id)
+                if meta_hash is not None:
+                    citations.setdefault(meta_hash, LlmCitation(source_id=source_ids[meta_hash], hash=meta_hash))
+            return {"answer": QuotedAnswer(answer=response.answer, citations=list(citations.values()))}
+
+        def combine_summaries(state: State, config: RunnableConfig, writer: StreamWriter):
+            # Reduce: merge the summaries of the papers into one answer
+            partial_answers = state["partial_answers"]
+            if len(partial_answers) == 1:
+                writer({"answer": partial_answers[0].answer})
+                return {"answer": partial_answers[0]}
+            with tracer.span("reduce_summaries") as span:
+                span.count("papers", len(partial_answers))
+                response = answer(reduce_messages(state), config, writer)
+            return combined_answer(partial_answers, response)
+
+        async def acombine_summaries(state: State, config: RunnableConfig, writer: StreamWriter):
+            partial_answers = state["partial_answers"]
+            if len(partial_answers) == 1:
+                writer({"answer": partial_answers[0].answer})
+                return {"answer": partial_answers[0]}
+            with tracer.span("reduce_summaries") as span:
+                span.count("papers", len(partial_answers))
+                response = await aanswer(reduce_messages(state), config, writer)
+            return combined_answer(partial_answers, response)
 
-        def generate(state: State):
-            formatted_docs = format_docs_with_id(state["context"])
-            # docs_content = "\n\n".join(doc.page_content for doc in state["context"])
-            messages = prompt.invoke({"question": state["question"], "context": formatted_docs})
-            structured_llm = self.llm.with_structured_output(QuotedAnswer)
-            response = structured_llm.invoke(messages)
-            return {"answer": response}
+        def route(state: State, config: RunnableConfig) -> str:
+            if config["configurable"].get("mode") == "map_reduce" and state["context"]:
+                return "summarize_papers"
+            return "generate"
 
 
         # Compile application and test
-        graph_builder = StateGraph(State).add_sequence([retrieve, generate])
+        graph_builder = StateGraph(State)
+        # Every node has a sync and an async variant, invoke and stream use the first, ainvoke and astream the second
+        for func, afunc in [(retrieve, aretrieve), (generate, agenerate), (summarize_papers, asummarize_papers),
+                            (combine_summaries, acombine_summaries)]:
+            graph_builder.add_node(func.__name__, RunnableCallable(func, afunc, name=func.__name__))
         graph_builder.add_edge(START, "retrieve")
+        graph_builder.add_conditional_edges("retrieve", route, ["generate", "summarize_papers"])
+        graph_builder.add_edge("summarize_papers", "combine_summaries")
         graph = graph_builder.compile()
         
         return graph
\ No newline at end of file
@@ -0,0 +1,257 @@
+"""
+Process-wide services shared by every Streamlit session and by the command line tools.
+
+Streamlit re-executes app.py on every widget interaction, while imported modules stay loaded. Every service
+is built on first use, once per process, and the heavy libraries it needs are imported at that moment,
+so a rerun or a page which does not need the model pays nothing.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import queue
+import threading
+from typing import AsyncIterable, Awaitable, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# Reentrant, because building a service builds the services it depends on
+_lock = threading.RLock()
+_services: dict[str, object] = {}
+
+
+def data_path(name: str) -> str:
+    """
+    Returns the path of a persistent file, the directory is set by the SCIART_DATA_DIR environment variable.
+    """
+    return os.path.join(os.environ.get("SCIART_DATA_DIR", "."), name)
+
+
+def service(func: Callable[[], T]) -> Callable[[], T]:
+    """
+    Turns a factory into a thread-safe lazy singleton, registered under the function name.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def get() -> T:
+        instance = _services.get(name)
+        if instance is None:
+            with _lock:
+                instance = _services.get(name)
+                if instance is None:
+                    instance = _services[name] = func()
+        return instance
+    return get
+
+
+def loaded(name: str) -> object | None:
+    """
+    Returns the service if it was already built, without building it.
+    """
+    return _services.get(name)
+
+
+def _http_limits():
+    import httpx
+
+    # Connections are kept alive between requests, so concurrent sessions do not pay a TLS handshake each
+    return httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.)
+
+
+@service
+def http_client():
+    """
+    Pooled keep-alive HTTP client shared by the chat model and the embeddings.
+    """
+    import httpx
+
+    return httpx.Client(limits=_http_limits(), timeout=httpx.Timeout(60., connect=10.))
+
+
+@service
+def http_async_client():
+    """
+    Async counterpart of http_client, bound to no event loop until its first request.
+    """
+    import httpx
+
+    return httpx.AsyncClient(limits=_http_limits(), timeout=httpx.Timeout(60., connect=10.))
+
+
+@service
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop running in a daemon thread, every session submits its coroutines to it,
+    so the async HTTP client and its connections live in a single loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="sciart-event-loop", daemon=True).start()
+    return loop
+
+
+def _submit(coro: Awaitable[T]) -> concurrent.futures.Future:
+    # The task runs in a copy of the caller context, so callbacks like get_openai_callback keep counting
+    context = contextvars.copy_context()
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    loop = event_loop()
+
+    def start():
+        task = loop.create_task(coro, context=context)
+        future.add_done_callback(lambda f: f.cancelled() and loop.call_soon_threadsafe(task.cancel))
+
+        def done(t: asyncio.Task):
+            if t.cancelled():
+                future.cancel()
+            elif t.exception() is not None:
+                future.set_exception(t.exception())
+            else:
+                future.set_result(t.result())
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """
+    Runs the coroutine in the shared event loop and waits for its result.
+    """
+    future = _submit(coro)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def iterate_async(aiterable: AsyncIterable[T]) -> Iterator[T]:
+    """
+    Iterates an async iterable from synchronous code, the items are produced in the shared event loop.
+    Closing the iterator early cancels the producer.
+    """
+    items: queue.Queue = queue.Queue()
+    end = object()
+
+    async def produce():
+        try:
+            async for item in aiterable:
+                items.put(item)
+        finally:
+            items.put(end)
+
+    future = _submit(produce())
+    try:
+        while (item := items.get()) is not end:
+            yield item
+        future.result()
+    finally:
+        future.cancel()
+
+
+@service
+def embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    from .embedding_cache import CachedEmbeddings
+
+    return CachedEmbeddings(OpenAIEmbeddings(http_client=http_client(), http_async_client=http_async_client()),
+                            path=data_path("embedding_cache.sqlite"))
+
+
+@service
+def vectorstore():
+    """
+    One collection per project (SCIART_PROJECT), split into SCIART_SHARDS collections for large databases.
+    SCIART_VECTORSTORE selects the backend: "chroma" (default) or "quantized", the compact memory-mapped store
+    with SCIART_QUANTIZATION "int8" (default) or "float16" vectors. SCIART_RERANK=1 creates it with float32 copies
+    of the vectors to re-rank the results, at a disk cost above plain float32 storage.
+    """
+    project = os.environ.get("SCIART_PROJECT", "langchain")
+    shards = int(os.environ.get("SCIART_SHARDS", "1"))
+    backend = os.environ.get("SCIART_VECTORSTORE", "chroma")
+    if backend == "quantized":
+        from .quantized_store import QuantizedVectorStore
+
+        def collection(name: str) -> QuantizedVectorStore:
+            return QuantizedVectorStore(embeddings(), os.path.join(data_path("vectors"), name),
+                                        quantization=os.environ.get("SCIART_QUANTIZATION", "int8"),
+                                        rerank=True if os.environ.get("SCIART_RERANK") == "1" else None)
+    elif backend == "chroma":
+        from langchain_chroma import Chroma
+
+        def collection(name: str) -> Chroma:
+            return Chroma(collection_name=name, embedding_function=embeddings(),
+                          persist_directory=data_path("chroma_db"))
+    else:
+        raise ValueError(f"Unknown vectorstore '{backend}', available: chroma, quantized")
+
+    if shards > 1:
+        from .partitioning import PartitionedVectorStore
+
+        return PartitionedVectorStore({f"{project}_{num}": collection(f"{project}_{num}") for num in range(shards)})
+    return collection(project)
+
+
+@service
+def chat_model():
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(temperature=0.0, model="gpt-4o-mini", stream_usage=True, http_client=http_client(),
+                      http_async_client=http_async_client())
+
+
+@service
+def spending_client():
+    from .spendings import SpendingClient
+
+    return SpendingClient(client_name="spendings", db_path=data_path("spendings.sqlite"))
+
+
+@service
+def ingest_cache():
+    from .ingest_cache import IngestCache
+
+    return IngestCache(data_path("ingest_cache.sqlite"))
+
+
+@service
+def answer_cache():
+    from .answer_cache import AnswerCache
+
+    return AnswerCache(data_path("answer_cache.sqlite"))
+
+
+@service
+def lexical_index():
+    from .lexical_index import LexicalIndex
+
+    return LexicalIndex(data_path("lexical_index.sqlite"))
+
+
+@service
+def dedup_index():
+    """
+    Near-duplicate chunk index, SCIART_DEDUP_THRESHOLD sets the estimated Jaccard similarity of a duplicate.
+    """
+    from .dedup import NearDuplicateIndex
+
+    return NearDuplicateIndex(data_path("dedup_index.sqlite"),
+                              threshold=float(os.environ.get("SCIART_DEDUP_THRESHOLD", "0.85")))
+
+
+@service
+def rag():
+    from .rag import RAG
+
+    sum_assistant = RAG(chat_model(), vectorstore(), spending_client(), ingest_cache(), answer_cache(),
+                        lexical_index=lexical_index(), dedup_index=dedup_index())
+    # Papers stored before the lexical index existed are indexed once, a reset vectorstore empties the dedup index
+    sum_assistant.sync_lexical_index()
+    sum_assistant.sync_dedup_index()
+    return sum_assistant
+
+
+@service
+def graph():
+    return rag().create_graph()
@@ -1,6 +1,19 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from datetime import datetime
-import pandas as pd
+import sqlite3
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+# USD per 1M tokens, embeddings are not reported by the OpenAI callback
+EMBEDDING_PRICES = {
+    "text-embedding-ada-002": 0.10,
+    "text-embedding-3-small": 0.02,
+    "text-embedding-3-large": 0.13,
+}
 
 
 class SpendingsMeta(BaseModel):
@@ -18,30 +31,146 @@ class SpendingsMeta(BaseModel):
             total_cost=sm.total_cost if hasattr(sm, "total_cost") else 0.,
         )
 
+    @classmethod
+    def empty(cls):
+        return cls(total_tokens=0, prompt_tokens=0, completion_tokens=0, total_cost=0.)
+
+    @classmethod
+    def from_embedding_tokens(cls, tokens: int, model: str):
+        return cls(total_tokens=tokens, prompt_tokens=tokens, completion_tokens=0,
+                   total_cost=tokens * EMBEDDING_PRICES.get(model, 0.) / 1e6)
+
 
 class Spendings(BaseModel):
     cost: SpendingsMeta
+    operation: str = "summary"
+    model: str = ""
+    doc_hash: str = ""
+    cache_hit: bool = False
     timestamp: datetime = Field(default_factory=datetime.now)
 
 
+SPENDING_COLUMNS = ["total_tokens", "prompt_tokens", "completion_tokens", "total_cost"]
+
+
 class SpendingClient(BaseModel):
+    """
+    Append-only spending ledger stored in SQLite, shared by every worker using the same database file.
+    Every insert also updates the rollups by day, operation and model, so the totals never need a full scan.
+    """
     client_name: str
-    spendings: list[Spendings] = Field(default_factory=list)
+    db_path: str = ":memory:"
+    _conn: sqlite3.Connection = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def model_post_init(self, __context):
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        with self._conn:
+            if self.db_path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS spendings (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    client_name TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    operation TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    doc_hash TEXT NOT NULL,
+                    cache_hit INTEGER NOT NULL,
+                    total_tokens INTEGER NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    total_cost REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS rollups (
+                    client_name TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    operation TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    calls INTEGER NOT NULL,
+                    cache_hits INTEGER NOT NULL,
+                    total_tokens INTEGER NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    total_cost REAL NOT NULL,
+                    PRIMARY KEY (client_name, day, operation, model)
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS spendings_client ON spendings (client_name, id)")
 
     def add_spending(self, spending: Spendings):
-        self.spendings.append(spending)
+        cost = spending.cost
+        values = (int(cost.total_tokens), int(cost.prompt_tokens), int(cost.completion_tokens), cost.total_cost)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO spendings (client_name, timestamp, operation, model, doc_hash, cache_hit, "
+                "total_tokens, prompt_tokens, completion_tokens, total_cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.client_name, spending.timestamp.isoformat(), spending.operation, spending.model,
+                 spending.doc_hash, int(spending.cache_hit), *values),
+            )
+            self._conn.execute(
+                "INSERT INTO rollups (client_name, day, operation, model, calls, cache_hits, "
+                "total_tokens, prompt_tokens, completion_tokens, total_cost) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (client_name, day, operation, model) DO UPDATE SET "
+                "calls = calls + 1, cache_hits = cache_hits + excluded.cache_hits, "
+                "total_tokens = total_tokens + excluded.total_tokens, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "total_cost = total_cost + excluded.total_cost",
+                (self.client_name, spending.timestamp.date().isoformat(), spending.operation, spending.model,
+                 int(spending.cache_hit), *values),
+            )
 
+    def rows_since(self, rowid: int = 0, limit: int | None = None) -> list[tuple]:
+        """
+        Returns the ledger rows inserted after the given row id, in insertion order.
+        With a limit only the latest rows are returned, the older ones are not read.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, timestamp, operation, model, doc_hash, cache_hit, "
+                "total_tokens, prompt_tokens, completion_tokens, total_cost "
+                "FROM spendings WHERE client_name = ? AND id > ? ORDER BY id DESC LIMIT ?",
+                (self.client_name, rowid, -1 if limit is None else limit),
+            ).fetchall()
+        return rows[::-1]
 
-def spend_helper(spending_client: SpendingClient):
+    def rollups(self) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT day, operation, model, calls, cache_hits, "
+                "total_tokens, prompt_tokens, completion_tokens, total_cost "
+                "FROM rollups WHERE client_name = ? ORDER BY day DESC, operation, model",
+                (self.client_name,),
+            ).fetchall()
+
+
+def _format_columns(df: "pd.DataFrame") -> "pd.DataFrame":
+    df.columns = df.columns.str.replace("_", " ").str.capitalize()
+    return df
+
+
+def spend_helper(spending_client: SpendingClient, tail: int = 200):
     """
-    Helper function to format the spending information.
+    Helper function to format the latest spendings, at most tail rows are read whatever the size of the ledger.
+    The totals come from the rollups, see rollup_helper.
     """
-    result = []
-    for data in spending_client.spendings:
-        date = data.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        result_loc = data.cost.__dict__
-        result_loc['timestamp'] = date
-        result.append(result_loc)
-    df = pd.DataFrame(result)
-    df.columns = df.columns.str.replace("_", " ").str.capitalize()
-    return df
\ No newline at end of file
+    import pandas as pd
+
+    columns = ["id", "timestamp", "operation", "model", "doc_hash", "cache_hit"] + SPENDING_COLUMNS
+    df = pd.DataFrame(spending_client.rows_since(0, limit=tail), columns=columns)
+    df["timestamp"] = pd.to_datetime(df["timestamp"]).dt.strftime("%Y-%m-%d %H:%M:%S")
+    df["cache_hit"] = df["cache_hit"].astype(bool)
+    return _format_columns(df.drop(columns="id"))
+
+
+def rollup_helper(spending_client: SpendingClient):
+    """
+    Helper function to format the precomputed totals by day, operation and model.
+    """
+    import pandas as pd
+
+    columns = ["day", "operation", "model", "calls", "cache_hits"] + SPENDING_COLUMNS
+    return _format_columns(pd.DataFrame(spending_client.rollups(), columns=columns))
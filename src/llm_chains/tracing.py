@@ -0,0 +1,185 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Iterator
+
+
+QUANTILES = {"p50": "0.5", "p95": "0.95", "p99": "0.99"}
+_EXHAUSTED = object()
+
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    Nearest-rank percentile of the sorted values: the smallest value with at least q of the values at or below it.
+    """
+    return values[max(math.ceil(q * len(values)) - 1, 0)] if values else 0.
+
+
+class Span:
+    """
+    Class to represent one timed stage. Time spent in nested spans is not part of the stage time.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.child_time = 0.
+        self.seconds = 0.
+        self.counts: dict[str, int] = {}
+
+    def count(self, item: str, value: int):
+        self.counts[item] = self.counts.get(item, 0) + value
+
+
+class Tracer:
+    """
+    Process-wide span timer with per-stage latency histograms and item counters.
+
+    Stage latencies keep the last max_samples values to compute the percentiles, the raw events
+    are kept for the JSON lines exporter. The open span is tracked per thread and per asyncio task.
+    """
+
+    def __init__(self, max_samples: int = 2048, max_events: int = 10_000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._current: ContextVar[Span | None] = ContextVar(f"tracer_span_{id(self)}", default=None)
+        self._samples: dict[str, deque] = defaultdict(lambda: deque(maxlen=self.max_samples))
+        self._calls: dict[str, int] = defaultdict(int)
+        self._seconds: dict[str, float] = defaultdict(float)
+        self._counts: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._events = deque(maxlen=max_events)
+
+    @contextmanager
+    def _frame(self, name: str) -> Iterator[Span]:
+        parent = self._current.get()
+        span = Span(name)
+        token = self._current.set(span)
+        try:
+            yield span
+        finally:
+            self._current.reset(token)
+            total = time.perf_counter() - span.start
+            # children running concurrently (tasks, threads with a copied context) may overlap
+            span.seconds = max(total - span.child_time, 0.)
+            if parent is not None:
+                parent.child_time += total
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        """
+        Times the enclosed block as one sample of the stage.
+        """
+        with self._frame(name) as span:
+            yield span
+        self.record(name, span.seconds, **span.counts)
+
+    def iter(self, name: str, iterable: Iterable, count_as: str | None = None) -> Iterator:
+        """
+        Times the production of the items of a lazy iterable as one sample of the stage.
+        """
+        iterator = iter(iterable)
+        seconds, items = 0., 0
+        try:
+            while True:
+                with self._frame(name) as span:
+                    item = next(iterator, _EXHAUSTED)
+                seconds += span.seconds
+                if item is _EXHAUSTED:
+                    break
+                items += 1
+                yield item
+        finally:
+            self.record(name, seconds, **({count_as: items} if count_as else {}))
+
+    def record(self, name: str, seconds: float, **counts: int):
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._calls[name] += 1
+            self._seconds[name] += seconds
+            for item, value in counts.items():
+                self._counts[name][item] += value
+            self._events.append({"stage": name, "seconds": seconds, "timestamp": time.time(), **counts})
+        capture = getattr(self._local, "capture", None)
+        if capture is not None:
+            capture.append((name, seconds, counts))
+
+    @contextmanager
+    def capture(self) -> Iterator[list[tuple]]:
+        """
+        Collects the samples recorded by this thread, used to send worker process timings back to the parent.
+        """
+        self._local.capture = samples = []
+        try:
+            yield samples
+        finally:
+            self._local.capture = None
+
+    def merge(self, samples: list[tuple]):
+        for name, seconds, counts in samples:
+            self.record(name, seconds, **counts)
+
+    def summary(self) -> list[dict]:
+        """
+        Returns per-stage calls, latency percentiles in seconds and item counters.
+        """
+        result = []
+        with self._lock:
+            for name, samples in self._samples.items():
+                values = sorted(samples)
+                result.append({
+                    "stage": name,
+                    "calls": self._calls[name],
+                    "total_seconds": self._seconds[name],
+                    "p50": percentile(values, 0.50),
+                    "p95": percentile(values, 0.95),
+                    "p99": percentile(values, 0.99),
+                    **{item: value for item, value in self._counts[name].items()},
+                })
+        return result
+
+    def to_jsonl(self, path: str):
+        """
+        Appends the recorded span events to a JSON lines file and forgets them.
+        """
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+        with open(path, "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    def to_prometheus(self, prefix: str = "sciart") -> str:
+        """
+        Returns the stage latencies and counters in the Prometheus text exposition format.
+        """
+        lines = [f"# TYPE {prefix}_stage_latency_seconds summary"]
+        summary = self.summary()
+        for stage in summary:
+            label = f'stage="{stage["stage"]}"'
+            for q, quantile in QUANTILES.items():
+                lines.append(f'{prefix}_stage_latency_seconds{{{label},quantile="{quantile}"}} {stage[q]}')
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{{label}}} {stage["total_seconds"]}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{{label}}} {stage["calls"]}')
+        lines.append(f"# TYPE {prefix}_stage_items_total counter")
+        for stage in summary:
+            for item, value in stage.items():
+                if item not in ["stage", "calls", "total_seconds", *QUANTILES]:
+                    lines.append(f'{prefix}_stage_items_total{{stage="{stage["stage"]}",item="{item}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def run_traced(func, *args):
+    """
+    Calls the function and returns its result with the samples it recorded. Used for process pool workers.
+    """
+    with tracer.capture() as samples:
+        result = func(*args)
+    return result, samples
+
+
+tracer = Tracer()
@@ -0,0 +1,45 @@
+import pytest
+
+from benchmarks.fakes import HashEmbeddings
+from llm_chains.answer_cache import AnswerCache
+from llm_chains.citation_styles import SummaryCitation
+
+MODEL = {"model": "fake-chat", "temperature": 0.}
+CONFIG = {"configurable": {"chunk_nums": 4}}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnswerCache(str(tmp_path / "answer_cache.sqlite"))
+
+
+def summary(answer: str) -> SummaryCitation:
+    return SummaryCitation(question="What was measured?", answer=answer)
+
+
+def test_new_corpus_version_invalidates_answers(cache):
+    version = cache.corpus_version
+    cache.put("What was measured?", CONFIG, MODEL, summary("The growth rate."), version)
+    assert cache.get("  what was MEASURED? ", CONFIG, MODEL).answer == "The growth rate."
+    assert cache.get("What was measured?", {"configurable": {"chunk_nums": 8}}, MODEL) is None
+
+    cache.bump_corpus_version()
+    assert cache.get("What was measured?", CONFIG, MODEL) is None
+
+
+def test_answer_generated_over_an_older_corpus_is_not_cached(cache):
+    version = cache.corpus_version
+    assert cache.get("What was measured?", CONFIG, MODEL, version) is None
+    # another session stores a paper while the answer is generated
+    cache.bump_corpus_version()
+    cache.put("What was measured?", CONFIG, MODEL, summary("The growth rate."), version)
+    assert cache.get("What was measured?", CONFIG, MODEL) is None
+
+
+def test_near_duplicate_questions_hit(tmp_path):
+    cache = AnswerCache(str(tmp_path / "answer_cache.sqlite"), embeddings=HashEmbeddings(),
+                        similarity_threshold=0.8)
+    cache.put("What was measured in the experiment?", CONFIG, MODEL, summary("The growth rate."),
+              cache.corpus_version)
+    assert cache.get("What was measured in the experiments?", CONFIG, MODEL).answer == "The growth rate."
+    assert cache.get("Who funded the study?", CONFIG, MODEL) is None
@@ -0,0 +1,109 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from benchmarks.corpus import iter_synthetic_pages
+from benchmarks.fakes import FakeChatModel, HashEmbeddings, temporary_chroma
+from llm_chains import batch
+from llm_chains.batch import BatchRunner, RateLimiter
+from llm_chains.rag import RAG
+from llm_chains.spendings import SpendingClient
+
+
+class FakeClock:
+    """
+    Stands in for the time module of the batch runner, asyncio.sleep advances it instead of waiting.
+    """
+
+    def __init__(self):
+        self.now = 0.
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    perf_counter = monotonic
+
+    async def sleep(self, seconds: float):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(batch, "time", clock)
+    monkeypatch.setattr(asyncio, "sleep", clock.sleep)
+    return clock
+
+
+def rate_limit_error() -> openai.RateLimitError:
+    response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class FlakyGraph:
+    """
+    Fails the first calls with a rate limit error, then answers with the real graph.
+    """
+
+    def __init__(self, graph, failures: int):
+        self.graph = graph
+        self.failures = failures
+        self.calls = 0
+
+    async def ainvoke(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise rate_limit_error()
+        return await self.graph.ainvoke(*args, **kwargs)
+
+
+@pytest.fixture
+def rag(tmp_path):
+    rag = RAG(FakeChatModel(), temporary_chroma(HashEmbeddings(), str(tmp_path / "chroma")),
+              SpendingClient(client_name="test"))
+    rag.store_pdf(iter_synthetic_pages(4), {"author": "Jane Doe", "title": "Synthetic paper", "year": "2023"})
+    return rag
+
+
+def test_buckets_refill_continuously(clock):
+    async def main():
+        limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+        for _ in range(60):
+            await limiter.acquire(100)
+        assert clock.now == 0
+        # one request and 100 tokens come back every second
+        await limiter.acquire(100)
+        assert clock.now == pytest.approx(1)
+        # a request above the bucket waits for a full bucket
+        await limiter.acquire(10_000)
+        assert clock.now == pytest.approx(61)
+        # unused estimated tokens are given back, the next request starts without waiting
+        limiter.settle(estimated=6000, actual=1000)
+        await limiter.acquire(5000)
+        assert clock.now == pytest.approx(61)
+
+    asyncio.run(main())
+
+
+def test_rate_limited_requests_are_retried_with_backoff(rag, clock):
+    graph = FlakyGraph(rag.create_graph(), failures=2)
+    runner = BatchRunner(rag, graph, base_delay=1., max_delay=60., style_name="apa")
+    result = asyncio.run(runner.run_one({"id": 1, "question": "What was measured?"}, {"chunk_nums": 2}))
+    assert "error" not in result
+    assert result["attempts"] == 3 and graph.calls == 3
+    assert result["citations"]
+    # full jitter backoff, bounded by the doubled base delay of each attempt
+    assert len(clock.slept) == 2
+    assert all(0 <= slept <= 2 ** (num + 1) for num, slept in enumerate(clock.slept))
+
+
+def test_retries_are_bounded(rag, clock):
+    graph = FlakyGraph(rag.create_graph(), failures=10)
+    runner = BatchRunner(rag, graph, max_retries=3, style_name="apa")
+    result = asyncio.run(runner.run_one({"id": 1, "question": "What was measured?"}, {"chunk_nums": 2}))
+    assert result["error"].startswith("RateLimitError")
+    assert result["attempts"] == 4 and graph.calls == 4
@@ -0,0 +1,12 @@
+from llm_chains.citation_styles import _csl_entry, csl_entry
+
+
+def test_csl_entries_are_memoized_per_paper_fields():
+    metadata = {"author": "Marie Curie", "title": "Radioactive substances", "year": "1904", "start_index": 0}
+    entry = csl_entry("test-memo", metadata)
+    # another chunk of the same paper shares the entry
+    assert csl_entry("test-memo", {**metadata, "start_index": 1200}) is entry
+    assert entry["issued"] == {"date-parts": [[1904]]}
+    # corrected metadata is not hidden behind the old entry
+    assert csl_entry("test-memo", {**metadata, "year": "1903"})["issued"] == {"date-parts": [[1903]]}
+    assert _csl_entry.cache_info().maxsize is not None
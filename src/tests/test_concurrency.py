@@ -0,0 +1,58 @@
+import asyncio
+
+from llm_chains.concurrency import ConcurrencyLimiter
+
+
+async def hold(limiter: ConcurrencyLimiter, name: str, order: list[str], release: asyncio.Event):
+    async with limiter.alimit():
+        order.append(name)
+        await release.wait()
+
+
+def test_waiters_are_served_in_arrival_order():
+    async def main():
+        limiter = ConcurrencyLimiter(1)
+        order, release = [], asyncio.Event()
+        first = asyncio.create_task(hold(limiter, "first", order, release))
+        await asyncio.sleep(0)
+        waiters = []
+        for name in ["a", "b", "c", "d"]:
+            waiters.append(asyncio.create_task(hold(limiter, name, order, release)))
+            await asyncio.sleep(0)
+        assert order == ["first"]
+        release.set()
+        await asyncio.gather(first, *waiters)
+        assert order == ["first", "a", "b", "c", "d"]
+        assert limiter.stats()["peak"] == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiters_do_not_leak_slots():
+    async def main():
+        limiter = ConcurrencyLimiter(1)
+        for resolved_first in [False, True]:
+            await limiter.aacquire()
+            waiter = asyncio.create_task(limiter.aacquire())
+            await asyncio.sleep(0)
+            limiter.release(counted=False)
+            if resolved_first:
+                # the slot reached the future, the task is cancelled before it resumes
+                await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            assert waiter.cancelled()
+            # the slot went back to the limiter, the next caller gets it without waiting
+            await asyncio.wait_for(limiter.aacquire(), timeout=1)
+            limiter.release(counted=False)
+
+        # a waiter cancelled while still queued leaves the queue
+        await limiter.aacquire()
+        waiter = asyncio.create_task(limiter.aacquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        limiter.release(counted=False)
+        await asyncio.wait_for(limiter.aacquire(), timeout=1)
+
+    asyncio.run(main())
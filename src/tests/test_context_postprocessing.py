@@ -0,0 +1,51 @@
+import random
+
+from langchain_core.documents import Document
+
+from benchmarks.corpus import synthetic_text
+from llm_chains.context_postprocessing import count_tokens, pack_context
+
+
+def chunk(meta_hash: str, section: int, start_index: int, text: str) -> Document:
+    return Document(page_content=text, metadata={"hash": meta_hash, "author": f"Author of {meta_hash}",
+                                                 "section": section, "start_index": start_index})
+
+
+def retrieved(n_papers: int, per_paper: int) -> list[Document]:
+    rng = random.Random(0)
+    docs = []
+    for num in range(per_paper):
+        for paper in range(n_papers):
+            text = " ".join(synthetic_text(rng, 2))
+            docs.append(chunk(f"paper{paper}", num, 0, text))
+    return docs
+
+
+def test_context_stays_within_the_token_budget():
+    docs = retrieved(3, 6)
+    unlimited = pack_context(docs)
+    for budget in [100, 300, 600]:
+        packed = pack_context(docs, token_budget=budget)
+        assert packed.tokens <= budget + 5
+        assert packed.chunks_used + packed.chunks_dropped == len(docs)
+        assert packed.chunks_used < unlimited.chunks_used
+    assert unlimited.chunks_dropped == 0
+
+
+def test_one_header_per_paper():
+    docs = retrieved(3, 4)
+    packed = pack_context(docs)
+    for paper in range(3):
+        assert packed.text.count(f"Hash: paper{paper}\n") == 1
+    assert packed.text.count("Source ID:") == 3
+    # the headers follow the retrieval order of the papers
+    assert packed.text.index("paper0") < packed.text.index("paper1") < packed.text.index("paper2")
+    assert packed.tokens < packed.tokens_raw
+
+
+def test_overlapping_chunks_are_merged():
+    text = "The experiment measured the growth rate of the samples over ten weeks of observation."
+    docs = [chunk("paper0", 0, 40, text[40:]), chunk("paper0", 0, 0, text[:60])]
+    packed = pack_context(docs)
+    assert text in packed.text
+    assert packed.tokens < count_tokens(docs[0].page_content + docs[1].page_content) + 30
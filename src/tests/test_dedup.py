@@ -0,0 +1,60 @@
+import pytest
+
+from benchmarks.corpus import iter_synthetic_pages
+from benchmarks.fakes import FakeChatModel, HashEmbeddings, temporary_chroma
+from llm_chains.dedup import NearDuplicateIndex
+from llm_chains.pdf_processing import make_hash_from_metadata
+from llm_chains.rag import RAG
+from llm_chains.spendings import SpendingClient
+
+
+@pytest.fixture
+def rag(tmp_path):
+    return RAG(FakeChatModel(), temporary_chroma(HashEmbeddings(), str(tmp_path / "chroma")),
+               SpendingClient(client_name="test"),
+               dedup_index=NearDuplicateIndex(str(tmp_path / "dedup_index.sqlite")))
+
+
+def test_failed_write_is_rolled_back(rag, monkeypatch):
+    preprint = {"title": "Synthetic paper", "year": "2023"}
+    published = {"title": "Synthetic paper", "year": "2024"}
+    rag.store_pdf(iter_synthetic_pages(6), preprint)
+    # the published version repeats the preprint and adds new pages, so one batch has links and new chunks
+    pages = [*iter_synthetic_pages(6, revision=1), *iter_synthetic_pages(3, seed=1)]
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("vectorstore unavailable")
+
+    monkeypatch.setattr(rag.vectorstore, "add_documents", fail)
+    with pytest.raises(RuntimeError):
+        rag.store_pdf(pages, published)
+    monkeypatch.undo()
+
+    meta_hash = make_hash_from_metadata(published)
+    assert not rag.is_stored(meta_hash)
+    rag.store_pdf(pages, published)
+    assert rag.vectorstore.get(where={"hash": meta_hash})["ids"]
+    assert rag.dedup_index.linked([meta_hash])
+
+
+def test_links_to_missing_vectors_are_dropped(rag, tmp_path):
+    preprint = {"title": "Synthetic paper", "year": "2023"}
+    published = {"title": "Synthetic paper", "year": "2024"}
+    rag.store_pdf(iter_synthetic_pages(6), preprint)
+    rag.store_pdf(iter_synthetic_pages(6, revision=1), published)
+    meta_hash = make_hash_from_metadata(published)
+    assert rag.is_stored(meta_hash)
+
+    # the vectorstore is reset, the dedup index is kept
+    rag.vectorstore = temporary_chroma(HashEmbeddings(), str(tmp_path / "new_chroma"))
+    assert not rag.is_stored(meta_hash)
+    rag.store_pdf(iter_synthetic_pages(6, revision=1), published)
+    assert rag.vectorstore.get(where={"hash": meta_hash})["ids"]
+
+
+def test_sync_clears_the_index_of_a_reset_vectorstore(rag, tmp_path):
+    rag.store_pdf(iter_synthetic_pages(6), {"title": "Synthetic paper", "year": "2023"})
+    assert rag.sync_dedup_index() == 0
+    rag.vectorstore = temporary_chroma(HashEmbeddings(), str(tmp_path / "new_chroma"))
+    assert rag.sync_dedup_index() > 0
+    assert len(rag.dedup_index) == 0
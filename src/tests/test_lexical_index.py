@@ -0,0 +1,68 @@
+import pytest
+from langchain_core.documents import Document
+
+from llm_chains.lexical_index import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+TEXTS = {
+    "a": "IL-6 levels rose after the treatment in every patient of the cohort.",
+    "b": "The cohort was followed for two years, IL-6 was measured once.",
+    "c": "Growth of the samples was measured weekly over ten weeks.",
+    "d": "IL-6 and IL-6 receptor expression, IL-6 signalling in the IL-6 knockout mice.",
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical_index.sqlite"))
+    ids = list(TEXTS)
+    index.add(ids, [Document(page_content=TEXTS[i], metadata={"hash": "paper1" if i == "d" else "paper0"})
+                    for i in ids])
+    return index
+
+
+def test_compound_terms_are_kept_whole_and_split():
+    assert tokenize("The IL-6 and BRCA1 of Ti3C2") == ["il-6", "il", "6", "brca1", "ti3c2"]
+
+
+def test_bm25_ranks_the_matching_chunks(index):
+    ranked = [chunk_id for chunk_id, _ in index.search("IL-6 knockout", k=4)]
+    # the chunk repeating the rare term ranks first, chunks without any query term are not returned
+    assert ranked[0] == "d" and sorted(ranked) == ["a", "b", "d"]
+    assert [chunk_id for chunk_id, _ in index.search("weekly growth")] == ["c"]
+    assert index.search("the of and") == []
+
+
+def test_scoped_search_keeps_the_corpus_weights(index):
+    unscoped = dict(index.search("IL-6 cohort", k=4))
+    scoped = dict(index.search("IL-6 cohort", k=4, hashes=["paper0"]))
+    assert set(scoped) == {"a", "b"}
+    assert scoped["a"] == pytest.approx(unscoped["a"])
+
+
+def test_removed_papers_are_not_returned(index):
+    index.remove_hash("paper1")
+    assert len(index) == 3
+    assert "d" not in dict(index.search("IL-6 knockout", k=4))
+
+
+def test_reciprocal_rank_fusion_order():
+    vector = ["a", "b", "c", "d"]
+    lexical = ["c", "a", "e"]
+    # a is second in one list and first in the other, c first and third, e only in one list
+    assert reciprocal_rank_fusion([vector, lexical]) == ["a", "c", "b", "e", "d"]
+    assert reciprocal_rank_fusion([vector]) == vector
+
+
+def test_corpus_statistics_are_shared_by_every_connection(index, tmp_path):
+    other = LexicalIndex(index.path)
+    before = dict(other.search("IL-6 cohort", k=4))
+    # another worker indexes a paper in the same file
+    index.add(["e", "f"], [Document(page_content="Cohort of mice without IL-6.", metadata={"hash": "paper2"}),
+                           Document(page_content="Ten weeks of growth.", metadata={"hash": "paper2"})])
+    assert len(other) == len(index) == 6
+    after = dict(other.search("IL-6 cohort", k=6))
+    assert after["a"] != pytest.approx(before["a"])
+    assert after == pytest.approx(dict(LexicalIndex(index.path).search("IL-6 cohort", k=6)))
+    other.remove_hash("paper2")
+    assert len(index) == 4
+    assert dict(index.search("IL-6 cohort", k=4)) == pytest.approx(before)
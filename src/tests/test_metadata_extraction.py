@@ -0,0 +1,45 @@
+from langchain_core.documents import Document
+
+from llm_chains.citation_styles import csl_entry
+from llm_chains.metadata_extraction import LocalMetadataExtractor, normalize_authors
+
+
+def test_single_author_family_given():
+    authors, confidence = normalize_authors("Curie, Marie")
+    assert authors == "Marie Curie"
+    assert confidence >= 0.7
+    assert csl_entry("test-single-author", {"author": authors})["author"] == [{"given": "Marie", "family": "Curie"}]
+
+
+def test_authors_separated_by_semicolons():
+    assert normalize_authors("Curie, Marie; Pierre Curie")[0] == "Marie Curie; Pierre Curie"
+
+
+def test_pdf_metadata_authors_must_be_on_first_page():
+    extractor = LocalMetadataExtractor()
+    text = "A study of radioactivity\nMarie Curie and Pierre Curie\nAbstract"
+    page = Document(page_content=text, metadata={"author": "Marie Curie; Pierre Curie"})
+    assert extractor.confident(extractor.extract(page))["author"] == "Marie Curie; Pierre Curie"
+    # the typesetter, not an author of the paper
+    page = Document(page_content=text, metadata={"author": "John Typesetter"})
+    assert "author" not in extractor.confident(extractor.extract(page))
+
+
+def test_family_given_authors_separated_by_and():
+    assert normalize_authors("Smith, John and Doe, Jane")[0] == "John Smith; Jane Doe"
+    assert normalize_authors("Smith, John; Doe, Jane & Roe, Richard")[0] == "John Smith; Jane Doe; Richard Roe"
+    assert normalize_authors("John Smith, Jane Doe and Richard Roe") == ("John Smith; Jane Doe; Richard Roe", 0.8)
+
+
+def test_doi_of_the_header_is_preferred_over_the_body():
+    extractor = LocalMetadataExtractor()
+    body = "\n".join(f"Line {num} of the introduction." for num in range(40))
+    page = Document(page_content="Journal of Tests\nhttps://doi.org/10.1000/paper.1\n" + body
+                    + "\nas shown before (doi:10.1000/cited.2)\n" + body)
+    assert extractor.confident(extractor.extract(page))["doi"] == "10.1000/paper.1"
+    # a DOI found only in the body may belong to a cited paper, it is left to the LLM
+    page = Document(page_content=body + "\nas shown before (doi:10.1000/cited.2)\n" + body)
+    assert extractor.extract(page)["doi"].value == "10.1000/cited.2"
+    assert "doi" not in extractor.confident(extractor.extract(page))
+    page = Document(page_content=body, metadata={"doi": "10.1000/paper.1"})
+    assert extractor.confident(extractor.extract(page))["doi"] == "10.1000/paper.1"
@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks.fakes import HashEmbeddings
+from llm_chains.partitioning import PartitionedVectorStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    texts = [f"Chunk {num} of paper {paper}." for paper in range(8) for num in range(5)]
+    metadatas = [{"hash": f"paper{paper}"} for paper in range(8) for _ in range(5)]
+    return PartitionedVectorStore.from_texts(texts, HashEmbeddings(), metadatas, persist_directory=str(tmp_path),
+                                             shards=4)
+
+
+@pytest.mark.parametrize("where", [None, {"hash": {"$in": ["paper1", "paper2", "paper5", "paper6"]}},
+                                   {"section": {"$ne": 1}}])
+def test_pages_cover_every_row_once(store, where):
+    everything = store.get(where=where)["ids"]
+    assert everything
+    pages = []
+    for offset in range(0, len(everything) + 7, 7):
+        pages.extend(store.get(where=where, limit=7, offset=offset)["ids"])
+    assert sorted(pages) == sorted(everything)
+    assert len(pages) == len(everything)
@@ -0,0 +1,52 @@
+import random
+
+import numpy as np
+import pytest
+
+from benchmarks.corpus import synthetic_text
+from benchmarks.fakes import HashEmbeddings
+from llm_chains.quantized_store import QuantizedVectorStore
+
+
+def chunks(n_papers: int, per_paper: int) -> tuple[list[str], list[dict]]:
+    rng = random.Random(0)
+    texts = [" ".join(synthetic_text(rng, 3)) for _ in range(n_papers * per_paper)]
+    return texts, [{"hash": f"paper{num // per_paper}"} for num in range(len(texts))]
+
+
+@pytest.fixture(scope="module")
+def texts_metadatas():
+    return chunks(200, 10)
+
+
+def test_ivf_search_scoped_to_one_paper(tmp_path, texts_metadatas):
+    texts, metadatas = texts_metadatas
+    store = QuantizedVectorStore(HashEmbeddings(), str(tmp_path), index="ivf", n_lists=40, nprobe=2,
+                                 min_train_size=1000)
+    store.add_texts(texts, metadatas)
+    assert store._centroids is not None
+    for paper in ["paper0", "paper17", "paper199"]:
+        docs = store.similarity_search("results of the experiment", k=10, filter={"hash": paper})
+        assert len(docs) == 10
+        assert {doc.metadata["hash"] for doc in docs} == {paper}
+
+
+@pytest.mark.parametrize("quantization,index", [("int8", "flat"), ("float16", "flat"), ("int8", "ivf")])
+def test_recall_against_exact_search(tmp_path, texts_metadatas, quantization, index):
+    texts, metadatas = texts_metadatas
+    embeddings = HashEmbeddings()
+    store = QuantizedVectorStore(embeddings, str(tmp_path), quantization=quantization, index=index, n_lists=40,
+                                 nprobe=8, min_train_size=1000)
+    store.add_texts(texts, metadatas)
+    rows = {text: num for num, text in enumerate(texts)}
+    matrix = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+    rng = random.Random(1)
+    k, hits, total = 10, 0, 0
+    for _ in range(20):
+        query = " ".join(synthetic_text(rng, 1))
+        truth = set(np.argsort(-(matrix @ np.asarray(embeddings.embed_query(query), dtype=np.float32)))[:k].tolist())
+        found = {rows[doc.page_content] for doc in store.similarity_search(query, k=k)}
+        hits += len(truth & found)
+        total += k
+    assert hits / total >= (0.95 if index == "flat" else 0.6)
@@ -0,0 +1,48 @@
+import asyncio
+from typing import Iterator
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+from benchmarks.corpus import iter_synthetic_pages
+from benchmarks.fakes import FakeChatModel, HashEmbeddings, temporary_chroma
+from llm_chains.loaders import PdfBuffer
+from llm_chains.rag import RAG
+from llm_chains.spendings import SpendingClient
+
+
+class PlainTextStreamModel(FakeChatModel):
+    """
+    Streams a plain text reply instead of the requested tool call, invoke still answers with the tool call.
+    """
+
+    def _stream(self, messages, stop=None, run_manager=None, tools=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        for word in ["The", " growth", " rate."]:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+
+@pytest.fixture
+def rag(tmp_path):
+    rag = RAG(PlainTextStreamModel(), temporary_chroma(HashEmbeddings(), str(tmp_path / "chroma")),
+              SpendingClient(client_name="test"))
+    rag.store_pdf(iter_synthetic_pages(4), {"author": "Jane Doe", "title": "Synthetic paper", "year": "2023"})
+    return rag
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_streamed_answer_without_tool_call_falls_back_to_invoke(rag, use_async):
+    graph = rag.create_graph()
+    config = {"configurable": {"chunk_nums": 2, "stream_answer": True}}
+    if use_async:
+        response = asyncio.run(graph.ainvoke({"question": "What was measured?"}, config=config))
+    else:
+        response = graph.invoke({"question": "What was measured?"}, config=config)
+    assert response["answer"].answer
+    assert response["answer"].citations
+
+
+def test_pdf_without_pages_is_rejected(rag, monkeypatch):
+    monkeypatch.setattr(rag.loader, "lazy_load", lambda source: iter([]))
+    with pytest.raises(ValueError, match="empty.pdf has no pages"):
+        rag.ingest_pdf(PdfBuffer(b"%PDF-1.4", name="empty.pdf"))
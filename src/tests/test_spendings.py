@@ -0,0 +1,26 @@
+from llm_chains.spendings import Spendings, SpendingsMeta, SpendingClient, spend_helper
+
+
+def spending(tokens: int) -> Spendings:
+    return Spendings(cost=SpendingsMeta(total_tokens=tokens, prompt_tokens=tokens, completion_tokens=0,
+                                        total_cost=tokens / 1e6), model="fake-chat")
+
+
+def test_rows_since_and_bounded_tail(tmp_path):
+    client = SpendingClient(client_name="test", db_path=str(tmp_path / "spendings.sqlite"))
+    other = SpendingClient(client_name="other", db_path=str(tmp_path / "spendings.sqlite"))
+    for tokens in range(1, 51):
+        client.add_spending(spending(tokens))
+        other.add_spending(spending(1000))
+
+    rows = client.rows_since(0)
+    assert [row[6] for row in rows] == list(range(1, 51))
+    assert [row[6] for row in client.rows_since(rows[-6][0])] == list(range(46, 51))
+    # with a limit only the latest rows, still in insertion order
+    assert [row[6] for row in client.rows_since(0, limit=3)] == [48, 49, 50]
+
+    tail = spend_helper(client, tail=10)
+    assert len(tail) == 10
+    assert tail["Total tokens"].tolist() == list(range(41, 51))
+    # the totals of the whole ledger come from the rollups
+    assert client.rollups()[0][3:6] == (50, 0, sum(range(1, 51)))